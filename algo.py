@@ -1,3 +1,48 @@
+import logging
+import math
+import threading
+
+import numpy as np
+
+from data_obj import MISSING
+from metrics import TRACE
+from metrics import timed
+
+
+logger = logging.getLogger(__name__)
+
+LOG_SPACE_CELLS = 1024
+
+
+def log_sum_exp(log_values, axis=None):
+    """
+    Computes log(sum(exp(log_values))) without underflowing when every value is very negative.
+    :param log_values: ndarray of log values.
+    :param axis: axis to sum over, every value when None.
+    :return: the log of the sum, as a float or ndarray.
+    """
+    log_values = np.asarray(log_values, dtype=float)
+    peak = np.max(log_values, axis=axis, keepdims=True)
+    peak = np.where(np.isfinite(peak), peak, 0)
+    summed = np.log(np.sum(np.exp(log_values - peak), axis=axis, keepdims=True)) + peak
+    if axis is None:
+        return summed.item()
+    return np.squeeze(summed, axis=axis)
+
+
+def pick_log_space(grid, log_space=None):
+    """
+    Picks whether to update in log space: on grids of more than LOG_SPACE_CELLS grid spaces the probability of most
+    grid spaces soon falls below the smallest float, which log space keeps apart.
+    :param grid: the Grid object.
+    :param log_space: whether to run in log space, or None to pick by the number of grid spaces.
+    :return: whether to run in log space.
+    """
+    if log_space is not None:
+        return log_space
+    return grid.shape[0] * grid.shape[1] > LOG_SPACE_CELLS
+
+
 class Algorithm:
     """Algorithm object
 
@@ -9,29 +54,57 @@ class Algorithm:
         grid: the grid of Tag objects.
         config: a config object that holds all relevant information from the config file.
         prob_grid: a 2d array of all current probabilities.
+        log_space: whether the update is computed with log-priors and log-likelihoods.
+        log_prob_grid: a 2d array of all current normalized log probabilities (log_space only).
+        metrics: Metrics object timing the update and normalize stages, or None.
+        motion: MotionModel predicting the grid before every update, or None for a static target.
 
+    The read tags of every facing are traced at DEBUG level and the r/v1..v5 counts of every grid space at TRACE.
     """
-    def __init__(self, grid, config):
+    def __init__(self, grid, config, log_space=False, metrics=None, motion=None):
         self.readings = []
         self.grid = grid
         self.config = config
         self.prob_grid = []
+        self.log_space = log_space
+        self.metrics = metrics
+        self.motion = motion
+        self.log_prob_grid = []
+        if log_space:
+            self.log_prob_grid = [[math.log(probability) for probability in row] for row in grid.probabilities]
 
     def __getattr__(self, item):
         if item is 'probabilities':
-            prob_grid = []
-            for row in self.grid:
-                temp_row = []
-                for tag in row:
-                    temp_row.append(tag.probability)
-                prob_grid.append(temp_row)
-            return prob_grid
+            return self.grid.probabilities
+        elif item == 'log_probabilities':
+            return self.log_prob_grid
 
     def main(self, readings):
         self.readings = readings
-        self.update_probability_grid()
-        sum_of_probability_grid = self.find_probability_grid_sum()
-        self.finalize_probability_grid(sum_of_probability_grid)
+        if self.motion is not None:
+            with timed(self.metrics, 'predict'):
+                if self.log_space:
+                    self.log_prob_grid = self.motion.log_predict(np.array(self.log_prob_grid)).tolist()
+                else:
+                    self.grid.update_probabilities(self.motion.predict(self.grid.probabilities))
+        if self.log_space:
+            with timed(self.metrics, 'update'):
+                self.update_log_probability_grid()
+            with timed(self.metrics, 'normalize'):
+                self.finalize_log_probability_grid()
+            return
+        with timed(self.metrics, 'update'):
+            self.update_probability_grid()
+        with timed(self.metrics, 'normalize'):
+            sum_of_probability_grid = self.find_probability_grid_sum()
+            self.finalize_probability_grid(sum_of_probability_grid)
+
+    def finalize_log_probability_grid(self):
+        log_denominator = log_sum_exp(self.prob_grid)
+        self.log_prob_grid = [[log_probability - log_denominator for log_probability in row]
+                              for row in self.prob_grid]
+        self.grid.update_probabilities([[math.exp(log_probability) for log_probability in row]
+                                        for row in self.log_prob_grid])
 
     def finalize_probability_grid(self, denominator_sum):
         temp_grid = []
@@ -43,18 +116,13 @@ class Algorithm:
         self.grid.update_probabilities(temp_grid)
 
     def find_probability_grid_sum(self):
-        prob_sum = 0
-        for row in self.grid:
-            for tag in row:
-                prob_sum = prob_sum + tag.probability
-        return prob_sum
+        return float(self.grid.values.sum())
 
     def update_probability_grid(self):
-        for reading1,expected1 in zip(self.readings, self.config.vision_profile):
-            print(f'expected tags : {expected1}, read tags : ', end='')
-            for tag1 in reading1:
-                print(f'{self.grid[tag1]}, ', end='')
-            print(' ', end='\n')
+        if logger.isEnabledFor(logging.DEBUG):
+            for reading1, expected1 in zip(self.readings, self.config.vision_cells):
+                logger.debug('expected tags : %s, read tags : %s', expected1,
+                             ', '.join(str(self.grid[tag1]) for tag1 in reading1))
 
         x = 0
         temp_grid = []
@@ -64,7 +132,7 @@ class Algorithm:
             for tag in row:
                 if not isinstance(tag, str):
                     prob_sum = 0
-                    for reading, expected in zip(self.readings, self.config.vision_profile):
+                    for reading, expected in zip(self.readings, self.config.vision_cells):
                         prob = self.final_probability(reading, (x, y), tag, expected)
                         prob_sum = prob_sum + prob
                     temp_row.append(tag.probability*prob_sum*(1/16))
@@ -73,38 +141,782 @@ class Algorithm:
             x = x+1
         self.prob_grid = temp_grid
 
+    def update_log_probability_grid(self):
+        temp_grid = []
+        for x, (row, log_row) in enumerate(zip(self.grid, self.log_prob_grid)):
+            temp_row = []
+            for y, (tag, log_prior) in enumerate(zip(row, log_row)):
+                log_probs = [self.log_final_probability(reading, (x, y), tag, expected)
+                             for reading, expected in zip(self.readings, self.config.vision_cells)]
+                temp_row.append(log_prior + log_sum_exp(log_probs))
+            temp_grid.append(temp_row)
+        self.prob_grid = temp_grid
+
     def final_probability(self, reading, current_tag_location, current_tag, expected):
         p1 = self.config.p1
         p2 = self.config.p2
+        r, v1, v2, v3, v4, v5 = self.observation_counts(reading, current_tag_location, current_tag, expected)
+
+        probability = ((p1 ** (r * v1)) * ((1 - p1) ** ((1 - r) * v1)) * (p2 ** (r * (1-v1))) *
+                       ((1 - p2) ** ((1 - r) * (1 - v1))) * (p1 ** v2) * ((1 - p1) ** v4) *
+                       (p2 ** v3) * ((1 - p2) ** v5))
+
+        if logger.isEnabledFor(TRACE):
+            logger.log(TRACE, 'r = %d, v1 = %d, v2 = %d, v3 = %d, v4 = %d, v5 = %d', r, v1, v2, v3, v4, v5)
+
+        return probability
+
+    def log_final_probability(self, reading, current_tag_location, current_tag, expected):
+        log_p1 = math.log(self.config.p1)
+        log_q1 = math.log(1 - self.config.p1)
+        log_p2 = math.log(self.config.p2)
+        log_q2 = math.log(1 - self.config.p2)
+        r, v1, v2, v3, v4, v5 = self.observation_counts(reading, current_tag_location, current_tag, expected)
+        return ((r * v1) * log_p1 + ((1 - r) * v1) * log_q1 + (r * (1 - v1)) * log_p2 +
+                ((1 - r) * (1 - v1)) * log_q2 + v2 * log_p1 + v4 * log_q1 + v3 * log_p2 + v5 * log_q2)
+
+    def observation_counts(self, reading, current_tag_location, current_tag, expected):
         r = 0
         if current_tag in reading:
             r = 1
         v1 = 0
-        if str(current_tag_location) in expected:
+        if current_tag_location in expected:
             v1 = 1
         v2 = 0
         v3 = 0
+        read_locations = set()
         for tag in reading:
-            if self.grid[tag] in expected:
+            location = self.grid.location(tag)
+            if location in expected:
                 v2 = v2+1
-            elif self.grid[tag] not in expected and tag is not 'none' and tag is not 'target':
+            elif tag is not MISSING and tag != 'target':
                 v3 = v3+1
-        v4 = 0
-        for location in expected:
-            is_in = 0
-            for tag in reading:
-                if self.grid[tag] == location:
-                    is_in = 1
-                    break
-            if not is_in:
-                v4 = v4+1
+            read_locations.add(location)
+        v4 = len(expected - read_locations)
 
         v5 = len(self.grid) - (v2+v3+v4)
+        return r, v1, v2, v3, v4, v5
 
-        probability = ((p1 ** (r * v1)) * ((1 - p1) ** ((1 - r) * v1)) * (p2 ** (r * (1-v1))) *
-                       ((1 - p2) ** ((1 - r) * (1 - v1))) * (p1 ** v2) * ((1 - p1) ** v4) *
-                       (p2 ** v3) * ((1 - p2) ** v5))
 
-        print(f'r = {r}, v1 = {v1}, v2 = {v2}, v3 = {v3}, v4 = {v4}, v5 = {v5}')
+class VectorizedAlgorithm:
+    """Vectorized Algorithm object
 
-        return probability
+    Array-backed drop-in alternative to Algorithm. The prior is held as a 2d ndarray and the
+    vision profile as a boolean mask tensor of shape (facings, rows, cols), so the r/v1..v5 counts
+    and the likelihood product are computed for every grid space at once.
+
+    Attributes:
+        readings: the current readings from the rfid reader in question.
+        grid: the grid of Tag objects.
+        config: a config object that holds all relevant information from the config file.
+        prior: 2d ndarray of the current normalized probabilities.
+        log_prior: 2d ndarray of the current normalized log probabilities (log_space only).
+        log_space: whether the update is computed with log-priors and log-likelihoods.
+        vision_masks: boolean ndarray of the expected grid spaces for each facing.
+        read_probability: float ndarray of shape (facings, rows, cols) of the probability of reading the tag of each
+            grid space at each facing, or None when the config only has the scalar p1/p2.
+        sweep_likelihood: 2d ndarray of the (log) likelihood accumulated over the facings of the current sweep.
+        sweep_log_scale: float of the log of the factor the linear sweep_likelihood is scaled down by.
+        sweep_facings: set of the indexes of the facings observed in the current sweep.
+        lock: lock guarding the prior and the sweep state, so estimates can be read from other threads.
+        metrics: Metrics object timing the update and normalize stages, or None.
+        motion: MotionModel predicting the prior once per cycle, or None for a static target. main() is a whole
+            cycle and predicts before its update, the streaming updates (commit, observe_sweep) never do: call
+            predict() once at the start of every cycle instead.
+    """
+    split_targets = False
+
+    def __init__(self, grid, config, log_space=False, metrics=None, motion=None):
+        self.readings = []
+        self.grid = grid
+        self.config = config
+        self.log_space = log_space
+        self.metrics = metrics
+        self.motion = motion
+        self.shape = grid.shape
+        self.prior = np.array(grid.probabilities, dtype=float)
+        self.prior = self.prior / self.prior.sum()
+        if log_space:
+            self.log_prior = np.log(self.prior)
+        self.vision_masks = config.vision_masks
+        self.read_probability = self.build_read_probability()
+        if self.read_probability is not None:
+            self.log_read_probability = np.log(self.read_probability)
+            self.log_miss_probability = np.log1p(-self.read_probability)
+        self.sweep_likelihood = None
+        self.sweep_log_scale = 0.0
+        self.sweep_facings = set()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, item):
+        if item == 'probabilities':
+            return self.prior
+        elif item == 'log_probabilities':
+            if self.log_space:
+                return self.log_prior
+            with np.errstate(divide='ignore'):
+                return np.log(self.prior)
+        raise AttributeError(item)
+
+    def build_read_probability(self):
+        """
+        Combines the detection and false detection tensors of the config with the vision masks. A missing tensor
+        falls back on the scalar p1 or p2.
+        :return: float ndarray of shape (facings, rows, cols), or None when the config has neither tensor.
+        """
+        detection = getattr(self.config, 'detection', None)
+        false_detection = getattr(self.config, 'false_detection', None)
+        if detection is None and false_detection is None:
+            return None
+        if detection is None:
+            detection = self.config.p1
+        if false_detection is None:
+            false_detection = self.config.p2
+        return np.where(self.vision_masks, detection, false_detection)
+
+    def facing_tensors(self, tensor, count, facings=None):
+        if facings is None:
+            return tensor[:count]
+        return tensor[facings]
+
+    def build_read_masks(self, readings):
+        """
+        Builds the boolean mask tensor of the grid spaces whose tags were read at each facing.
+        :param readings: list of parsed readings (Tag objects, 'target' or 'none') or of raw tag ids, one per facing.
+        :return: boolean ndarray of shape (facings, rows, cols).
+        """
+        masks = np.zeros((len(readings),) + self.shape, dtype=bool)
+        for facing, reading in enumerate(readings):
+            for tag in reading:
+                location = self.grid.location(tag)
+                if location is not MISSING:
+                    masks[(facing,) + location] = True
+        return masks
+
+    def main(self, readings):
+        self.readings = readings
+        with timed(self.metrics, 'update'):
+            if self.log_space:
+                likelihood = self.log_likelihood(readings)
+            else:
+                likelihood = self.likelihood(readings)
+        self.apply_likelihood(likelihood, predict=True)
+
+    def apply_likelihood(self, likelihood, predict=False):
+        """
+        Multiplies the prior by a likelihood grid, normalizes it and writes it back to the grid.
+        :param likelihood: 2d ndarray of likelihoods, or of log likelihoods in log_space.
+        :param predict: run the predict step of the motion model on the prior first.
+        :return: None
+        """
+        if predict and self.motion is not None:
+            self.predict_prior()
+        with timed(self.metrics, 'normalize'):
+            if self.log_space:
+                self.log_prior = self.log_normalize(self.log_prior + likelihood)
+                self.prior = np.exp(self.log_prior)
+            else:
+                self.prior = self.normalize(self.prior * likelihood)
+            self.update_grid()
+
+    def predicted_prior(self):
+        """
+        Runs the predict step of the motion model on the prior, without changing it.
+        :return: ndarray of the predicted prior, or of the predicted log prior in log_space.
+        """
+        if self.log_space:
+            if self.motion is None:
+                return self.log_prior
+            return self.log_normalize(self.motion.log_predict(self.log_prior))
+        if self.motion is None:
+            return self.prior
+        return self.normalize(self.motion.predict(self.prior))
+
+    def predict_prior(self):
+        with timed(self.metrics, 'predict'):
+            if self.log_space:
+                self.log_prior = self.predicted_prior()
+                self.prior = np.exp(self.log_prior)
+            else:
+                self.prior = self.predicted_prior()
+
+    def predict(self):
+        """
+        Runs the predict step of the motion model on the prior and writes it back to the grid. main() already
+        predicts, the streaming updates (observe, commit, observe_sweep) need this once at the start of every cycle.
+        :return: None
+        """
+        if self.motion is None:
+            return
+        with self.lock:
+            self.predict_prior()
+            self.update_grid()
+
+    def normalize(self, posterior):
+        return posterior / posterior.sum()
+
+    def log_normalize(self, log_posterior):
+        return log_posterior - log_sum_exp(log_posterior)
+
+    def update_grid(self):
+        self.grid.update_probabilities(self.prior)
+
+    def accumulate(self, facing_index, reading):
+        """
+        Folds the reading of a single facing into the likelihood of the current sweep, so facings can be
+        processed as soon as they are read. commit() applies the sweep to the prior.
+        :param facing_index: index of the facing in the search profile.
+        :param reading: the parsed reading taken at that facing.
+        :return: None
+        """
+        if self.sweep_likelihood is None:
+            self.readings = []
+        with timed(self.metrics, 'update'):
+            if self.log_space:
+                likelihood = self.log_likelihood([reading], [facing_index])
+                if self.sweep_likelihood is not None:
+                    likelihood = np.logaddexp(self.sweep_likelihood, likelihood)
+            else:
+                likelihood, log_scale = self.scaled_likelihood([reading], [facing_index])
+                if self.sweep_likelihood is not None:
+                    peak = max(self.sweep_log_scale, log_scale)
+                    likelihood = (self.sweep_likelihood * math.exp(self.sweep_log_scale - peak)
+                                  + likelihood * math.exp(log_scale - peak))
+                    log_scale = peak
+                self.sweep_log_scale = log_scale
+        self.sweep_likelihood = likelihood
+        self.readings.append(reading)
+
+    def commit(self):
+        """
+        Applies the likelihood accumulated by accumulate() to the prior and starts a new sweep.
+        Gives the same grid as main() called with the readings of the whole sweep.
+        :return: None
+        """
+        with self.lock:
+            if self.sweep_likelihood is not None:
+                self.apply_likelihood(self.sweep_likelihood)
+            self.sweep_likelihood = None
+            self.sweep_facings = set()
+
+    def observe(self, facing_index, tags_read):
+        """
+        Streaming update: folds the reading of a single facing in right away. The sweep is committed once every
+        facing of the vision profile has been observed, or when a facing is observed a second time.
+        estimate() and argmax() reflect the observation as soon as this returns.
+        :param facing_index: index of the facing in the search profile.
+        :param tags_read: the parsed reading or the raw tag ids read at that facing.
+        :return: None
+        """
+        if facing_index in self.sweep_facings:
+            self.commit()
+        with self.lock:
+            self.accumulate(facing_index, tags_read)
+            self.sweep_facings.add(facing_index)
+        if len(self.sweep_facings) == len(self.vision_masks):
+            self.commit()
+
+    def observe_sweep(self, readings, facings):
+        """
+        Folds in a whole sweep of one reader station as an independent likelihood factor: the facings of the sweep
+        are mixed as in main(), and the sweeps of different stations multiply. The likelihood is computed outside of
+        the lock, so stations running in their own threads only serialize on applying it.
+        The motion model is not applied here, call predict() once per cycle before the sweeps of the stations.
+        :param readings: list of parsed readings, one per facing of the sweep.
+        :param facings: indexes of the facings the readings were taken at.
+        :return: None
+        """
+        if not readings:
+            return
+        with timed(self.metrics, 'update'):
+            if self.log_space:
+                likelihood = self.log_likelihood(readings, facings)
+            else:
+                likelihood = self.likelihood(readings, facings)
+        with self.lock:
+            self.apply_likelihood(likelihood)
+
+    def estimate(self):
+        """
+        Gives the current normalized grid, including the facings observed so far in the current sweep.
+        :return: 2d ndarray of probabilities.
+        """
+        with self.lock:
+            if self.sweep_likelihood is None:
+                return self.prior.copy()
+            if self.log_space:
+                return np.exp(self.log_normalize(self.log_prior + self.sweep_likelihood))
+            return self.normalize(self.prior * self.sweep_likelihood)
+
+    def argmax(self):
+        """
+        Gives the most likely grid space of the current estimate.
+        :return: tuple of the (row, col) coordinate.
+        """
+        return tuple(int(index) for index in np.unravel_index(np.argmax(self.estimate()), self.shape))
+
+    def observation_counts(self, readings, facings=None):
+        """
+        Computes the r/v1 masks and the v2..v5 counts of every facing.
+        :param readings: list of parsed readings, one per facing.
+        :param facings: indexes of the facings the readings were taken at, the first len(readings) when None.
+        :return: tuple of the read masks, the expected masks and the v2, v3, v4, v5 count arrays.
+        """
+        read = self.build_read_masks(readings)
+        if facings is None:
+            expected = self.vision_masks[:len(readings)]
+        else:
+            expected = self.vision_masks[facings]
+        v2 = np.count_nonzero(read & expected, axis=(1, 2))
+        v3 = np.count_nonzero(read & ~expected, axis=(1, 2))
+        v4 = np.count_nonzero(expected & ~read, axis=(1, 2))
+        v5 = len(self.grid) - (v2 + v3 + v4)
+        return read, expected, v2, v3, v4, v5
+
+    def likelihood(self, readings, facings=None):
+        """
+        Computes the summed likelihood of the readings over every facing for all grid spaces, up to a common factor
+        (see scaled_likelihood), which normalizing the posterior cancels.
+        :param readings: list of parsed readings, one per facing.
+        :param facings: indexes of the facings the readings were taken at, the first len(readings) when None.
+        :return: ndarray of likelihoods, 2d (3d with one grid per target).
+        """
+        return self.scaled_likelihood(readings, facings)[0]
+
+    def scale_facing_terms(self, log_facing_term):
+        """
+        Brings the v2..v5 terms of the facings back from log space, scaled so the largest one is 1. The terms are
+        products over every grid tag, which underflow to 0 on large grids, while only their ratios matter.
+        :param log_facing_term: float ndarray of the log facing terms.
+        :return: tuple of the float ndarray of the scaled facing terms and the float log of the scale.
+        """
+        log_scale = np.max(log_facing_term)
+        if not np.isfinite(log_scale):
+            log_scale = 0.0
+        return np.exp(log_facing_term - log_scale), float(log_scale)
+
+    def scaled_likelihood(self, readings, facings=None):
+        """
+        Computes the summed likelihood of the readings over every facing for all grid spaces.
+        Mirrors Algorithm.final_probability: r and v1 vary per grid space, v2..v5 per facing. With a per grid space
+        read probability the v2..v5 term becomes the product of the probabilities of every grid tag's read state.
+        The v2..v5 terms are computed in log space and scaled down by the largest one, so they never underflow.
+        :param readings: list of parsed readings, one per facing.
+        :param facings: indexes of the facings the readings were taken at, the first len(readings) when None.
+        :return: tuple of the 2d ndarray of scaled likelihoods and the float log of the scale.
+        """
+        if self.read_probability is not None:
+            read = self.build_read_masks(readings)
+            probability = self.facing_tensors(self.read_probability, len(readings), facings)
+            cell_term = np.where(read, probability, 1 - probability)
+            log_facing_term = np.where(read, self.facing_tensors(self.log_read_probability, len(readings), facings),
+                                       self.facing_tensors(self.log_miss_probability, len(readings), facings)
+                                       ).sum(axis=(1, 2))
+        else:
+            p1 = self.config.p1
+            p2 = self.config.p2
+            read, expected, v2, v3, v4, v5 = self.observation_counts(readings, facings)
+            log_facing_term = v2 * np.log(p1) + v4 * np.log(1 - p1) + v3 * np.log(p2) + v5 * np.log(1 - p2)
+            cell_term = np.where(expected, np.where(read, p1, 1 - p1), np.where(read, p2, 1 - p2))
+        facing_term, log_scale = self.scale_facing_terms(log_facing_term)
+        return np.einsum('f,fxy->xy', facing_term, cell_term), log_scale
+
+    def log_likelihood(self, readings, facings=None):
+        """
+        Computes the log of the summed likelihood of the readings over every facing for all grid spaces.
+        :param readings: list of parsed readings, one per facing.
+        :param facings: indexes of the facings the readings were taken at, the first len(readings) when None.
+        :return: 2d ndarray of log likelihoods.
+        """
+        if self.read_probability is not None:
+            read = self.build_read_masks(readings)
+            cell_term = np.where(read, self.facing_tensors(self.log_read_probability, len(readings), facings),
+                                 self.facing_tensors(self.log_miss_probability, len(readings), facings))
+            facing_term = cell_term.sum(axis=(1, 2))
+            return log_sum_exp(facing_term[:, None, None] + cell_term, axis=0)
+        log_p1 = np.log(self.config.p1)
+        log_q1 = np.log(1 - self.config.p1)
+        log_p2 = np.log(self.config.p2)
+        log_q2 = np.log(1 - self.config.p2)
+        read, expected, v2, v3, v4, v5 = self.observation_counts(readings, facings)
+        facing_term = v2 * log_p1 + v4 * log_q1 + v3 * log_p2 + v5 * log_q2
+        cell_term = np.where(expected, np.where(read, log_p1, log_q1), np.where(read, log_p2, log_q2))
+        return log_sum_exp(facing_term[:, None, None] + cell_term, axis=0)
+
+
+class MultiTargetAlgorithm(VectorizedAlgorithm):
+    """Multi Target Algorithm object
+
+    Keeps one posterior per target tag id, stacked in a single (targets, rows, cols) array, all updated from the
+    same reads. The per grid space term uses whether that target was read at the facing, so every target gets its
+    own estimate, while the v2..v5 facing term is computed once and shared by every target.
+
+    Readings must keep the target ids apart (parse_reading with split_targets), instead of the 'target' token.
+
+    Attributes:
+        targets: tuple of the target tag ids, one posterior each.
+        target_index: dict of target tag id to its index in the stacked posterior.
+        prior: 3d ndarray of the current normalized probabilities of every target.
+    """
+    split_targets = True
+
+    def __init__(self, grid, config, targets=None, log_space=False, metrics=None, motion=None):
+        super().__init__(grid, config, log_space, metrics, motion)
+        self.targets = tuple(config.target if targets is None else targets)
+        self.target_index = {target: index for index, target in enumerate(self.targets)}
+        self.prior = np.repeat(self.prior[None], len(self.targets), axis=0)
+        if log_space:
+            self.log_prior = np.log(self.prior)
+
+    def normalize(self, posterior):
+        return posterior / posterior.sum(axis=(1, 2), keepdims=True)
+
+    def log_normalize(self, log_posterior):
+        return log_posterior - log_sum_exp(log_posterior, axis=(1, 2))[:, None, None]
+
+    def update_grid(self):
+        """
+        The Grid holds a single probability per grid space, so it is left untouched.
+        Use probabilities, estimate() or argmax() for the per target grids.
+        """
+
+    def build_target_reads(self, readings):
+        """
+        Builds the detections of every target at each facing.
+        :param readings: list of parsed readings (split_targets) or of raw tag ids, one per facing.
+        :return: boolean ndarray of shape (targets, facings).
+        """
+        detected = np.zeros((len(self.targets), len(readings)), dtype=bool)
+        for facing, reading in enumerate(readings):
+            for tag in reading:
+                if isinstance(tag, str) and tag in self.target_index:
+                    detected[self.target_index[tag], facing] = True
+        return detected
+
+    def scaled_likelihood(self, readings, facings=None):
+        """
+        Computes the summed likelihood of the readings over every facing for all grid spaces of every target, with
+        the v2..v5 terms scaled down by the largest one (see VectorizedAlgorithm.scaled_likelihood).
+        :param readings: list of parsed readings, one per facing.
+        :param facings: indexes of the facings the readings were taken at, the first len(readings) when None.
+        :return: tuple of the 3d ndarray of scaled likelihoods and the float log of the scale.
+        """
+        detected = self.build_target_reads(readings)
+        if self.read_probability is not None:
+            read = self.build_read_masks(readings)
+            probability = self.facing_tensors(self.read_probability, len(readings), facings)
+            log_facing_term = np.where(read, self.facing_tensors(self.log_read_probability, len(readings), facings),
+                                       self.facing_tensors(self.log_miss_probability, len(readings), facings)
+                                       ).sum(axis=(1, 2))
+            facing_term, log_scale = self.scale_facing_terms(log_facing_term)
+            base = np.einsum('f,fxy->xy', facing_term, 1 - probability)
+            return base[None] + np.einsum('kf,fxy->kxy', detected * facing_term, 2 * probability - 1), log_scale
+        p1 = self.config.p1
+        p2 = self.config.p2
+        read, expected, v2, v3, v4, v5 = self.observation_counts(readings, facings)
+        log_facing_term = v2 * np.log(p1) + v4 * np.log(1 - p1) + v3 * np.log(p2) + v5 * np.log(1 - p2)
+        facing_term, log_scale = self.scale_facing_terms(log_facing_term)
+        in_view = np.where(detected, p1, 1 - p1)
+        out_of_view = np.where(detected, p2, 1 - p2)
+        base = (facing_term * out_of_view).sum(axis=1)
+        return base[:, None, None] + np.einsum('kf,fxy->kxy', facing_term * (in_view - out_of_view),
+                                               expected.astype(float)), log_scale
+
+    def log_likelihood(self, readings, facings=None):
+        """
+        Computes the log of the summed likelihood of the readings over every facing for all grid spaces of every target.
+        :param readings: list of parsed readings, one per facing.
+        :param facings: indexes of the facings the readings were taken at, the first len(readings) when None.
+        :return: 3d ndarray of log likelihoods.
+        """
+        detected = self.build_target_reads(readings)
+        if self.read_probability is not None:
+            read = self.build_read_masks(readings)
+            log_read = self.facing_tensors(self.log_read_probability, len(readings), facings)
+            log_miss = self.facing_tensors(self.log_miss_probability, len(readings), facings)
+            facing_term = np.where(read, log_read, log_miss).sum(axis=(1, 2))
+            cell_term = np.where(detected[:, :, None, None], log_read[None], log_miss[None])
+            return log_sum_exp(facing_term[None, :, None, None] + cell_term, axis=1)
+        log_p1 = np.log(self.config.p1)
+        log_q1 = np.log(1 - self.config.p1)
+        log_p2 = np.log(self.config.p2)
+        log_q2 = np.log(1 - self.config.p2)
+        read, expected, v2, v3, v4, v5 = self.observation_counts(readings, facings)
+        facing_term = v2 * log_p1 + v4 * log_q1 + v3 * log_p2 + v5 * log_q2
+        in_view = np.where(detected, log_p1, log_q1)[:, :, None, None]
+        out_of_view = np.where(detected, log_p2, log_q2)[:, :, None, None]
+        cell_term = np.where(expected[None], in_view, out_of_view)
+        return log_sum_exp(facing_term[None, :, None, None] + cell_term, axis=1)
+
+    def argmax(self):
+        """
+        Gives the most likely grid space of every target.
+        :return: dict of target tag id to the tuple of its (row, col) coordinate.
+        """
+        estimate = self.estimate()
+        locations = {}
+        for index, target in enumerate(self.targets):
+            flat_index = np.argmax(estimate[index])
+            locations[target] = tuple(int(i) for i in np.unravel_index(flat_index, self.shape))
+        return locations
+
+
+class SparseAlgorithm(MultiTargetAlgorithm):
+    """Sparse Algorithm object
+
+    Active set form of MultiTargetAlgorithm for very large grids. Every target keeps the log probabilities of its
+    active grid spaces in compact arrays, while every other grid space is held in a rest mass split by vision
+    pattern. Grid spaces with the same read probability at every facing (with the scalar p1/p2, the ones expected at
+    the same facings) have the same likelihood for any sweep, so the rest mass of each pattern is updated with one
+    term per facing, spread evenly over its grid spaces. A sweep only touches the active grid spaces and the patterns,
+    and after every sweep the grid spaces whose probability fell below the floor are pruned into the rest mass of
+    their pattern, so the active set only ever holds the grid spaces that stood out.
+
+    The rest mass only pays off while few patterns cover many grid spaces. With per facing and grid space detection
+    tensors (e.g. calibrated ones) nearly every grid space has a pattern of its own, so a sweep costs about as much as
+    the dense update of MultiTargetAlgorithm; a warning is logged when there are more patterns than half the grid
+    spaces.
+
+    With a uniform prior the posterior matches MultiTargetAlgorithm in log space, and with a floor of 0 it does for
+    any prior. Pruning spreads a pruned grid space's probability over the other rest grid spaces of its pattern.
+    There is no motion model, since a predict step would spread every active set over the whole grid.
+
+    Attributes:
+        floor: float of the probability below which a grid space is pruned into the rest mass.
+        cells: int of the number of grid spaces.
+        cell_pattern: int ndarray of the vision pattern of every flat grid space index.
+        pattern_log_read: float ndarray of shape (patterns, facings) of the log probability of reading a tag of each
+            pattern at every facing.
+        pattern_log_miss: float ndarray of the log probability of not reading it.
+        total_log_miss: float ndarray of the log probability of every facing reading no grid tag at all.
+        active: list of int ndarrays of the flat indexes of the active grid spaces of every target.
+        active_log_probability: list of float ndarrays of their normalized log probabilities.
+        rest_log_mass: float ndarray of shape (targets, patterns) of the log of the rest mass of every pattern.
+        rest_count: int ndarray of shape (targets, patterns) of the number of rest grid spaces of every pattern.
+        pending: list of tuples of the facing index and reading of the current sweep.
+    """
+
+    def __init__(self, grid, config, targets=None, floor=1e-8, metrics=None):
+        super().__init__(grid, config, targets, log_space=True, metrics=metrics)
+        self.floor = floor
+        self.cells = self.shape[0] * self.shape[1]
+        facings = len(self.vision_masks)
+        if self.read_probability is None:
+            flat_read = np.where(self.vision_masks, self.config.p1, self.config.p2).reshape(facings, self.cells)
+        else:
+            flat_read = self.read_probability.reshape(facings, self.cells)
+        patterns, self.cell_pattern = np.unique(flat_read.T, axis=0, return_inverse=True)
+        self.cell_pattern = self.cell_pattern.reshape(-1)
+        if len(patterns) > self.cells / 2:
+            logger.warning('%d vision patterns for %d grid spaces, the sparse posterior saves little over the dense '
+                           'one', len(patterns), self.cells)
+        self.pattern_log_read = np.log(patterns)
+        self.pattern_log_miss = np.log1p(-patterns)
+        pattern_count = np.bincount(self.cell_pattern, minlength=len(patterns))
+        self.total_log_miss = pattern_count @ self.pattern_log_miss
+        self.active = []
+        self.active_log_probability = []
+        self.rest_log_mass = np.full((len(self.targets), len(patterns)), -np.inf)
+        self.rest_count = np.zeros((len(self.targets), len(patterns)), dtype=int)
+        log_prior = self.log_prior.reshape(len(self.targets), self.cells)
+        for target, target_log_prior in enumerate(log_prior):
+            if np.all(target_log_prior == target_log_prior[0]):
+                self.active.append(np.zeros(0, dtype=np.intp))
+                self.active_log_probability.append(np.zeros(0))
+                self.rest_log_mass[target] = np.log(pattern_count / self.cells)
+                self.rest_count[target] = pattern_count
+            else:
+                state = self.prune(np.arange(self.cells), target_log_prior, self.rest_log_mass[target],
+                                   self.rest_count[target])
+                self.active.append(state[0])
+                self.active_log_probability.append(state[1])
+                self.rest_log_mass[target] = state[2]
+                self.rest_count[target] = state[3]
+        del self.prior
+        del self.log_prior
+        self.pending = []
+
+    def __getattr__(self, item):
+        if item == 'prior':
+            return self.dense_posterior()
+        elif item == 'log_prior':
+            with np.errstate(divide='ignore'):
+                return np.log(self.dense_posterior())
+        return super().__getattr__(item)
+
+    def prune(self, cells, log_probability, rest_log_mass, rest_count):
+        """
+        Moves the grid spaces whose probability is below the floor into the rest mass of their pattern.
+        :return: tuple of the kept cells, their log probabilities, the rest log masses and the rest counts.
+        """
+        if self.floor <= 0:
+            return cells, log_probability, rest_log_mass, rest_count
+        keep = log_probability >= math.log(self.floor)
+        if np.all(keep):
+            return cells, log_probability, rest_log_mass, rest_count
+        pruned = log_probability[~keep]
+        pruned_pattern = self.cell_pattern[cells[~keep]]
+        patterns = len(rest_count)
+        peak = pruned.max()
+        if np.isfinite(peak):
+            mass = np.bincount(pruned_pattern, weights=np.exp(pruned - peak), minlength=patterns)
+            with np.errstate(divide='ignore'):
+                rest_log_mass = np.logaddexp(rest_log_mass, np.log(mass) + peak)
+        rest_count = rest_count + np.bincount(pruned_pattern, minlength=patterns)
+        return cells[keep], log_probability[keep], rest_log_mass, rest_count
+
+    def cell_log_probabilities(self, facing, cells):
+        """
+        Looks up the log probability of reading and of not reading the tags of some grid spaces at a facing.
+        :param facing: index of the facing in the search profile.
+        :param cells: int ndarray of flat grid space indexes.
+        :return: tuple of the float ndarrays of the log read and log miss probabilities.
+        """
+        pattern = self.cell_pattern[cells]
+        return self.pattern_log_read[pattern, facing], self.pattern_log_miss[pattern, facing]
+
+    def facing_log_terms(self, observations):
+        """
+        Computes the v2..v5 term of every observed facing from the grid spaces whose tags were read, without
+        building dense read masks.
+        :param observations: list of tuples of the facing index and the reading taken there.
+        :return: float ndarray of the log facing terms.
+        """
+        cols = self.shape[1]
+        terms = np.empty(len(observations))
+        for index, (facing, reading) in enumerate(observations):
+            read = set()
+            for tag in reading:
+                location = self.grid.location(tag)
+                if location is not MISSING:
+                    read.add(location[0] * cols + location[1])
+            read = np.fromiter(read, dtype=np.intp, count=len(read))
+            log_read, log_miss = self.cell_log_probabilities(facing, read)
+            terms[index] = self.total_log_miss[facing] + (log_read - log_miss).sum()
+        return terms
+
+    def advance(self, observations, prune=True):
+        """
+        Computes the sparse state after a sweep, without changing the current one.
+        :param observations: list of tuples of the facing index and the reading taken there.
+        :param prune: whether grid spaces below the floor are pruned into the rest mass.
+        :return: tuple of the active cells, their log probabilities, the rest log masses and the rest counts.
+        """
+        if not observations:
+            return self.active, self.active_log_probability, self.rest_log_mass, self.rest_count
+        facings = np.array([facing for facing, _ in observations])
+        facing_terms = self.facing_log_terms(observations)
+        detected = self.build_target_reads([reading for _, reading in observations])
+        pattern_log_read = self.pattern_log_read[:, facings].T
+        pattern_log_miss = self.pattern_log_miss[:, facings].T
+        states = ([], [], np.empty(self.rest_log_mass.shape), np.empty(self.rest_count.shape, dtype=int))
+        for target in range(len(self.targets)):
+            cells = self.active[target]
+            target_read = detected[target][:, None]
+            pattern = self.cell_pattern[cells]
+            log_probability = self.active_log_probability[target] + log_sum_exp(
+                facing_terms[:, None] + np.where(target_read, pattern_log_read[:, pattern],
+                                                 pattern_log_miss[:, pattern]), axis=0)
+            rest_log_mass = self.rest_log_mass[target] + log_sum_exp(
+                facing_terms[:, None] + np.where(target_read, pattern_log_read, pattern_log_miss), axis=0)
+            total = log_sum_exp(np.concatenate([log_probability, rest_log_mass]))
+            log_probability = log_probability - total
+            rest_log_mass = rest_log_mass - total
+            rest_count = self.rest_count[target]
+            if prune:
+                cells, log_probability, rest_log_mass, rest_count = self.prune(cells, log_probability,
+                                                                               rest_log_mass, rest_count)
+            states[0].append(cells)
+            states[1].append(log_probability)
+            states[2][target] = rest_log_mass
+            states[3][target] = rest_count
+        return states
+
+    def rest_cell_log_probability(self, rest_log_mass, rest_count):
+        """
+        Spreads the rest mass of every pattern evenly over its rest grid spaces.
+        :param rest_log_mass: float ndarray of the rest log mass of every pattern.
+        :param rest_count: int ndarray of the number of rest grid spaces of every pattern.
+        :return: float ndarray of the log probability of a rest grid space of every pattern, -inf when it has none.
+        """
+        with np.errstate(divide='ignore'):
+            return np.where(rest_count > 0, rest_log_mass - np.log(np.maximum(rest_count, 1)), -np.inf)
+
+    def dense_posterior(self, state=None):
+        """
+        Expands a sparse state into the full grids, with the rest mass of every pattern spread evenly over its grid
+        spaces.
+        :param state: tuple returned by advance(), the current state when None.
+        :return: 3d ndarray of the probabilities of every target.
+        """
+        if state is None:
+            state = (self.active, self.active_log_probability, self.rest_log_mass, self.rest_count)
+        cells, log_probabilities, rest_log_masses, rest_counts = state
+        dense = np.empty((len(self.targets), self.cells))
+        for target in range(len(self.targets)):
+            rest = np.exp(self.rest_cell_log_probability(rest_log_masses[target], rest_counts[target]))
+            dense[target] = rest[self.cell_pattern]
+            dense[target, cells[target]] = np.exp(log_probabilities[target])
+        return dense.reshape((len(self.targets),) + self.shape)
+
+    def main(self, readings):
+        self.readings = readings
+        with self.lock, timed(self.metrics, 'update'):
+            self.set_state(self.advance(list(enumerate(readings))))
+
+    def set_state(self, state):
+        self.active, self.active_log_probability, self.rest_log_mass, self.rest_count = state
+
+    def accumulate(self, facing_index, reading):
+        """
+        Adds the reading of a single facing to the current sweep, applied by commit().
+        :param facing_index: index of the facing in the search profile.
+        :param reading: the parsed reading taken at that facing.
+        :return: None
+        """
+        if not self.pending:
+            self.readings = []
+        self.pending.append((facing_index, reading))
+        self.readings.append(reading)
+
+    def observe_sweep(self, readings, facings):
+        if not readings:
+            return
+        with self.lock, timed(self.metrics, 'update'):
+            self.set_state(self.advance(list(zip(facings, readings))))
+
+    def commit(self):
+        with self.lock:
+            if self.pending:
+                with timed(self.metrics, 'update'):
+                    self.set_state(self.advance(self.pending))
+            self.pending = []
+            self.sweep_facings = set()
+
+    def estimate(self):
+        """
+        Gives the current normalized grids, including the facings observed so far in the current sweep.
+        :return: 3d ndarray of probabilities.
+        """
+        with self.lock:
+            return self.dense_posterior(self.advance(self.pending, prune=False))
+
+    def argmax(self):
+        """
+        Gives the most likely grid space of every target, without expanding the posterior.
+        :return: dict of target tag id to the tuple of its (row, col) coordinate.
+        """
+        with self.lock:
+            cells, log_probabilities, rest_log_masses, rest_counts = self.advance(self.pending, prune=False)
+        locations = {}
+        for index, target in enumerate(self.targets):
+            rest = self.rest_cell_log_probability(rest_log_masses[index], rest_counts[index])
+            pattern = int(np.argmax(rest))
+            if len(cells[index]) and log_probabilities[index].max() >= rest[pattern]:
+                best = int(cells[index][np.argmax(log_probabilities[index])])
+            else:
+                candidates = self.cell_pattern == pattern
+                candidates[cells[index]] = False
+                best = int(np.argmax(candidates))
+            locations[target] = tuple(int(i) for i in np.unravel_index(best, self.shape))
+        return locations
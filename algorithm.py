@@ -1,15 +1,27 @@
+import math
+
+import numpy as np
+
+from algo import log_sum_exp
+from data_obj import Tag
+
+
 class BayesianAlgorithm:
-    def __init__(self, history, arduino, mercury, config, grid):
+    def __init__(self, history, arduino, mercury, config, grid, log_space=False):
         self.readings = []
         self.config = config
         self.history = history
         self.grid = grid
         self.arduino = arduino
         self.mercury = mercury
+        self.log_space = log_space
+        self.log_prior = None
 
     def search_algorithm(self):
         self.readings = self.make_readings()
         prob_of_t_given_prior_data = self.history.most_recent_grid
+        if self.log_space:
+            return self.log_search_algorithm(prob_of_t_given_prior_data)
         prob_solution_of_all_numerators = self.find_numerator(prob_of_t_given_prior_data)
         prob_solution_of_all_denominators = self.find_denominator(prob_of_t_given_prior_data)
         prob_grid = []
@@ -19,24 +31,46 @@ class BayesianAlgorithm:
                 temp_row.append(numerator / prob_solution_of_all_denominators)
             prob_grid.append(temp_row)
         self.grid.update_probabilities(prob_grid)
-        self.history.append(self.grid)
+        self.history.append(self.grid, self.readings)
+        return self.grid
+
+    def log_search_algorithm(self, prob_of_t_given_prior_data):
+        """
+        Log-domain version of the update: keeps the log-priors between cycles and normalizes with log-sum-exp,
+        so long sessions on large grids do not underflow to an all zero grid.
+        :param prob_of_t_given_prior_data: the most recent grid, only used to seed the log-priors.
+        :return: the updated grid.
+        """
+        if self.log_prior is None:
+            with np.errstate(divide='ignore'):
+                self.log_prior = np.log(np.array(prob_of_t_given_prior_data.probabilities, dtype=float))
+        log_numerators = self.log_prior + self.log_prob_of_z_given_t()
+        self.log_prior = log_numerators - log_sum_exp(log_numerators)
+        self.grid.update_probabilities(np.exp(self.log_prior))
+        self.history.append(self.grid, self.readings)
         return self.grid
 
     def make_readings(self):
         readings = []
         for angles in self.config.search_profile:
             self.arduino.send_angles(angles)
-
-            readings.append(self.parse_reading(self.mercury.make_read(base_read_power=2800)))
+            self.mercury.set_read_power(2800)
+            readings.append(self.parse_reading(self.mercury.make_read()))
         return readings
 
     def parse_reading(self, reading):
         tags_read = []
+        seen = set()
         for tag in reading:
-            if tag in self.config.target and 'target' not in tags_read:
+            if tag in self.config.target and 'target' not in seen:
+                seen.add('target')
                 tags_read.append('target')
-            elif self.grid[tag] not in tags_read:
-                tags_read.append(self.grid[tag])
+                continue
+            grid_tag = self.grid[tag]
+            key = grid_tag.id if isinstance(grid_tag, Tag) else grid_tag
+            if key not in seen:
+                seen.add(key)
+                tags_read.append(grid_tag)
         return tags_read
 
     def find_numerator(self, prob_of_t_given_prior_data):
@@ -68,6 +102,12 @@ class BayesianAlgorithm:
             probability_sum = probability_sum + (self.prob_of_z_given_t_and_f(reading, sight) * prob_of_f_n)
         return probability_sum
 
+    def log_prob_of_z_given_t(self):
+        log_prob_of_f_n = -math.log(len(self.readings))
+        log_probabilities = [self.log_prob_of_z_given_t_and_f(reading) + log_prob_of_f_n
+                             for reading, sight in zip(self.readings, self.config.vision_profile)]
+        return log_sum_exp(log_probabilities)
+
     def prob_of_z_given_t_and_f(self, reading, expected):
         """
         ##@param reading is the current reading made
@@ -84,3 +124,13 @@ class BayesianAlgorithm:
             r = 1
         probability = (p1**r) * ((1-p1)**(1-r)) * (p2**r) * ((1-p2)**(1-r)) * p1 * (1-p1) * p2 * (1-p2)
         return probability
+
+    def log_prob_of_z_given_t_and_f(self, reading):
+        log_p1 = math.log(self.config.p1)
+        log_q1 = math.log(1 - self.config.p1)
+        log_p2 = math.log(self.config.p2)
+        log_q2 = math.log(1 - self.config.p2)
+        r = 0
+        if 'target' in reading:
+            r = 1
+        return r * log_p1 + (1 - r) * log_q1 + r * log_p2 + (1 - r) * log_q2 + log_p1 + log_q1 + log_p2 + log_q2
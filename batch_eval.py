@@ -0,0 +1,151 @@
+import argparse
+import concurrent.futures
+import copy
+import csv
+import itertools
+import time
+
+import numpy as np
+
+from algo import MultiTargetAlgorithm
+from data_obj import Config
+from data_obj import Grid
+from recorder import load_cycles
+from recorder import load_manifest
+from run_bayesian import parse_reading
+
+
+_configs = {}
+
+
+def load_config(config_path):
+    """
+    Loads a config once per worker process.
+    :param config_path: the config file the sessions were recorded with.
+    :return: the config object.
+    """
+    if config_path not in _configs:
+        _configs[config_path] = Config(config_path)
+    return _configs[config_path]
+
+
+def evaluate_session(session_path, target_cell, config_path, p1, p2, facings, max_reads):
+    """
+    Replays one recorded session with one parameter combination.
+    :param session_path: the line-delimited JSON file written by ReadRecorder.
+    :param target_cell: tuple of the true (row, col) of every target tag id.
+    :param config_path: the config file the session was recorded with.
+    :param p1: float of p1 for the algorithm.
+    :param p2: float of p2 for the algorithm.
+    :param facings: tuple of the indexes of the search profile facings to use, every facing when None.
+    :param max_reads: int of the readings per burst to use, every reading when None.
+    :return: dictionary of the metrics of the session.
+    """
+    config = copy.copy(load_config(config_path))
+    config.p1 = p1
+    config.p2 = p2
+    config.detection = None
+    config.false_detection = None
+    grid = Grid(config.tag_ids, config.grid_size)
+    algorithm = MultiTargetAlgorithm(grid, config, log_space=True)
+    facing_indexes = {tuple(facing): index for index, facing in enumerate(config.search_profile)}
+    update_times = []
+    cycles_to_correct = None
+    cycles = load_cycles(session_path, max_reads)
+    for cycle, recorded_cycle in enumerate(cycles, start=1):
+        start = time.perf_counter()
+        for sweep in recorded_cycle:
+            observations = [(facing_indexes[angles], reading) for angles, reading in sweep]
+            observations = [(facing_index, parse_reading(reading, grid, config, split_targets=True))
+                            for facing_index, reading in observations if facings is None or facing_index in facings]
+            if observations:
+                algorithm.observe_sweep([reading for _, reading in observations],
+                                        [facing_index for facing_index, _ in observations])
+        update_times.append(time.perf_counter() - start)
+        correct = [location == target_cell for location in algorithm.argmax().values()]
+        if cycles_to_correct is None and all(correct):
+            cycles_to_correct = cycle
+    estimate = algorithm.estimate()
+    return {
+        'correct': float(np.mean(correct)) if cycles else 0.0,
+        'target_probability': float(np.mean(estimate[(slice(None),) + target_cell])),
+        'cycles_to_correct': cycles_to_correct,
+        'update_ms': float(np.median(update_times)) * 1000 if update_times else 0.0,
+    }
+
+
+def parameter_grid(p1_values, p2_values, profiles, max_reads_values):
+    """
+    Builds every parameter combination of the sweep.
+    :return: list of dictionaries of p1, p2, facings and max_reads.
+    """
+    return [{'p1': p1, 'p2': p2, 'facings': facings, 'max_reads': max_reads}
+            for p1, p2, facings, max_reads in itertools.product(p1_values, p2_values, profiles, max_reads_values)]
+
+
+def run_batch(sessions, combinations, config_path='config.yaml', workers=None):
+    """
+    Evaluates every session with every parameter combination, sharded across a process pool.
+    :param sessions: list of tuples of the session path and the target cell.
+    :param combinations: list of dictionaries of p1, p2, facings and max_reads.
+    :param config_path: the config file the sessions were recorded with.
+    :param workers: int of the number of processes, every core when None.
+    :return: list of dictionaries of the aggregated metrics of every combination.
+    """
+    results = {index: [] for index in range(len(combinations))}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for index, combination in enumerate(combinations):
+            for session_path, target_cell in sessions:
+                future = pool.submit(evaluate_session, session_path, target_cell, config_path, combination['p1'],
+                                     combination['p2'], combination['facings'], combination['max_reads'])
+                futures[future] = index
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]].append(future.result())
+    table = []
+    for index, combination in enumerate(combinations):
+        session_results = results[index]
+        reached = [result['cycles_to_correct'] for result in session_results if result['cycles_to_correct'] is not None]
+        table.append({
+            'p1': combination['p1'],
+            'p2': combination['p2'],
+            'facings': 'all' if combination['facings'] is None else ','.join(map(str, combination['facings'])),
+            'max_reads': 'all' if combination['max_reads'] is None else combination['max_reads'],
+            'sessions': len(session_results),
+            'accuracy': float(np.mean([result['correct'] for result in session_results])),
+            'target_probability': float(np.mean([result['target_probability'] for result in session_results])),
+            'median_cycles_to_correct': float(np.median(reached)) if reached else None,
+            'update_ms': float(np.median([result['update_ms'] for result in session_results])),
+        })
+    return table
+
+
+def parse_profile(profile):
+    if profile == 'all':
+        return None
+    return tuple(int(index) for index in profile.split(','))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scores parameter sweeps on recorded sessions.')
+    parser.add_argument('manifest', help='JSON list of {"session": log file, "target_cell": [row, col]}')
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--p1', type=float, nargs='+', default=[0.8])
+    parser.add_argument('--p2', type=float, nargs='+', default=[0.2])
+    parser.add_argument('--profiles', nargs='+', default=['all'],
+                        help='facing subsets of the search profile, as comma separated indexes or all')
+    parser.add_argument('--max-reads', type=int, nargs='+', default=[None], help='readings per burst to use')
+    parser.add_argument('--workers', type=int, help='number of processes, every core when missing')
+    parser.add_argument('--output', default='batch_results.csv')
+    args = parser.parse_args()
+    batch_table = run_batch(load_manifest(args.manifest),
+                            parameter_grid(args.p1, args.p2, [parse_profile(profile) for profile in args.profiles],
+                                           args.max_reads),
+                            config_path=args.config, workers=args.workers)
+    with open(args.output, 'w', newline='') as output:
+        writer = csv.DictWriter(output, fieldnames=list(batch_table[0].keys()))
+        writer.writeheader()
+        writer.writerows(batch_table)
+    for row in batch_table:
+        print(row)
+    print(f'results saved to {args.output}')
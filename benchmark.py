@@ -0,0 +1,261 @@
+import argparse
+import contextlib
+import io
+import json
+import time
+
+import numpy as np
+
+from algo import Algorithm
+from algo import MultiTargetAlgorithm
+from algo import SparseAlgorithm
+from algo import VectorizedAlgorithm
+from algorithm import BayesianAlgorithm
+from data_obj import Config
+from data_obj import Grid
+from history import PosteriorHistory
+from run_bayesian import normalize_probabilities
+from run_bayesian import parse_reading
+from simulation import SimulatedArduinoHandler
+from simulation import SimulatedMercuryHandler
+
+
+def synthetic_config(rows, cols, facings=8, p1=0.8, p2=0.2, seed=0):
+    """
+    Generates a config object for a synthetic rows x cols grid (see synthetic_config_data).
+    :return: the config object.
+    """
+    return Config.from_dict(synthetic_config_data(rows, cols, facings, p1, p2, seed))
+
+
+def synthetic_config_data(rows, cols, facings=8, p1=0.8, p2=0.2, seed=0):
+    """
+    Generates the config data of a synthetic rows x cols grid, with two tag ids per grid space, four target ids
+    and one rectangular vision window covering about a quarter of the grid per facing.
+    :param rows: int of the number of rows of the grid.
+    :param cols: int of the number of columns of the grid.
+    :param facings: int of the number of facings of the search profile.
+    :param p1: float of p1 for the algorithm.
+    :param p2: float of p2 for the algorithm.
+    :param seed: seed of the random vision windows.
+    :return: dictionary with the same layout as the config file.
+    """
+    rng = np.random.default_rng(seed)
+    grid_tags = {}
+    for x in range(rows):
+        grid_tags[f'row_{x}'] = [(f'E2{x:06d}{y:06d}A', f'E2{x:06d}{y:06d}B') for y in range(cols)]
+    vision_profile = []
+    for facing in range(facings):
+        height = max(1, rows // 2)
+        width = max(1, cols // 2)
+        top = int(rng.integers(rows - height + 1))
+        left = int(rng.integers(cols - width + 1))
+        vision_profile.append(tuple(f'{(x, y)}' for x in range(top, top + height) for y in range(left, left + width)))
+    return {
+        'ips': {'arduino': None, 'mercury': None},
+        'cycles': 1,
+        'probabilities': {'p1': p1, 'p2': p2},
+        'tags': {
+            'grid_size': rows * cols,
+            'target_tag': tuple(f'E3{index:022d}' for index in range(4)),
+            'grid_tags': grid_tags,
+        },
+        'search_profile': [(facing, facing) for facing in range(facings)],
+        'vision_profile': vision_profile,
+    }
+
+
+def take_raw_readings(arduino, mercury, config):
+    """
+    Takes one simulated sweep of the search profile.
+    :param arduino: SimulatedArduinoHandler object
+    :param mercury: SimulatedMercuryHandler object
+    :param config: the config object
+    :return: list of the raw tag ids read at each facing.
+    """
+    raw_readings = []
+    for facing in config.search_profile:
+        arduino.send_angles(facing)
+        raw_readings.append(mercury.make_read())
+    return raw_readings
+
+
+def latency_summary(latencies, cells):
+    """
+    Summarizes the latencies of a stage.
+    :param latencies: list of latencies (in sec), one per cycle.
+    :param cells: int of the number of grid spaces.
+    :return: dictionary of the p50/p99 latency (in millisec) and the cells/sec at the median latency.
+    """
+    latencies = np.array(latencies)
+    p50 = float(np.percentile(latencies, 50))
+    return {
+        'p50_ms': p50 * 1000,
+        'p99_ms': float(np.percentile(latencies, 99)) * 1000,
+        'cells_per_sec': cells / p50 if p50 > 0 else float('inf'),
+    }
+
+
+def benchmark_stages(rows, cols, cycles=20, legacy_max_cells=256, seed=0):
+    """
+    Times every stage of the update per cycle on a synthetic grid.
+    :param rows: int of the number of rows of the grid.
+    :param cols: int of the number of columns of the grid.
+    :param cycles: int of the number of cycles to time.
+    :param legacy_max_cells: largest grid Algorithm.main is timed on, it scales with the square of the grid spaces.
+    :param seed: seed of the synthetic config and the simulated reads.
+    :return: dictionary of the latency summary of every stage.
+    """
+    config = synthetic_config(rows, cols, seed=seed)
+    cells = rows * cols
+    arduino = SimulatedArduinoHandler()
+    mercury = SimulatedMercuryHandler(config, (rows // 2, cols // 2), arduino, seed=seed)
+    grid = Grid(config.tag_ids, config.grid_size)
+    vectorized = VectorizedAlgorithm(grid, config, log_space=True)
+    legacy = None
+    if cells <= legacy_max_cells:
+        legacy = Algorithm(Grid(config.tag_ids, config.grid_size), config)
+    bayesian_grid = Grid(config.tag_ids, config.grid_size)
+    bayesian_history = PosteriorHistory(bayesian_grid, capacity=cycles + 1)
+    bayesian = BayesianAlgorithm(bayesian_history, arduino, mercury, config, bayesian_grid, log_space=True)
+    multi_target = MultiTargetAlgorithm(Grid(config.tag_ids, config.grid_size), config, log_space=True)
+    sparse = SparseAlgorithm(Grid(config.tag_ids, config.grid_size), config)
+    timings = {'parse_reading': [], 'VectorizedAlgorithm.main': [], 'MultiTargetAlgorithm.main': [],
+               'SparseAlgorithm.main': [], 'normalize_probabilities': [], 'BayesianAlgorithm.search_algorithm': []}
+    if legacy is not None:
+        timings['Algorithm.main'] = []
+    for cycle in range(cycles):
+        raw_readings = take_raw_readings(arduino, mercury, config)
+        start = time.perf_counter()
+        readings = [parse_reading(reading, grid, config) for reading in raw_readings]
+        timings['parse_reading'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        vectorized.main(readings)
+        timings['VectorizedAlgorithm.main'].append(time.perf_counter() - start)
+        split_readings = [parse_reading(reading, grid, config, split_targets=True) for reading in raw_readings]
+        start = time.perf_counter()
+        multi_target.main(split_readings)
+        timings['MultiTargetAlgorithm.main'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        sparse.main(split_readings)
+        timings['SparseAlgorithm.main'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        normalize_probabilities(vectorized.probabilities)
+        timings['normalize_probabilities'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        bayesian.search_algorithm()
+        timings['BayesianAlgorithm.search_algorithm'].append(time.perf_counter() - start)
+        if legacy is not None:
+            legacy_readings = [parse_reading(reading, legacy.grid, config) for reading in raw_readings]
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                legacy.main(legacy_readings)
+            timings['Algorithm.main'].append(time.perf_counter() - start)
+    return {stage: latency_summary(latencies, cells) for stage, latencies in timings.items()}
+
+
+def vision_error(config, target):
+    """
+    Gives the error the vision profile allows at a target: every grid space expected at the same facings as the
+    target is read alike, so no number of sweeps can tell them apart.
+    :param config: the config object
+    :param target: tuple of the (row, col) coordinate of the target.
+    :return: float of the distance (in grid spaces) from the target to the farthest grid space with its vision pattern.
+    """
+    masks = config.vision_masks
+    alike = np.all(masks == masks[:, target[0], target[1]][:, None, None], axis=0)
+    rows, cols = np.nonzero(alike)
+    return float(np.max(np.hypot(rows - target[0], cols - target[1])))
+
+
+def localization_error(rows, cols, trials=10, max_cycles=50, tolerance=1.0, seed=0):
+    """
+    Runs simulated sessions end to end and tracks the distance from the argmax of every target id to the simulated
+    target, with MultiTargetAlgorithm (the single target engines do not use the target reads). The random vision
+    windows of the synthetic config leave groups of grid spaces with the same vision pattern, so the exact grid space
+    is often out of reach; the error is compared to the one the vision allows instead.
+    :param rows: int of the number of rows of the grid.
+    :param cols: int of the number of columns of the grid.
+    :param trials: int of the number of sessions, each with a random target.
+    :param max_cycles: int of the maximum number of sweeps per session.
+    :param tolerance: float of the distance (in grid spaces) past the vision error a session counts as localized at.
+    :param seed: seed of the synthetic config, the targets and the simulated reads.
+    :return: dictionary of the error (in grid spaces) after the last sweep, the median error after every sweep, the
+        sweeps until localized (max_cycles + 1 when never) and the wall time per session.
+    """
+    config = synthetic_config(rows, cols, seed=seed)
+    rng = np.random.default_rng(seed)
+    errors = []
+    vision_errors = []
+    cycles_needed = []
+    session_times = []
+    for trial in range(trials):
+        target = (int(rng.integers(rows)), int(rng.integers(cols)))
+        arduino = SimulatedArduinoHandler()
+        mercury = SimulatedMercuryHandler(config, target, arduino, seed=seed + trial)
+        grid = Grid(config.tag_ids, config.grid_size)
+        algorithm = MultiTargetAlgorithm(grid, config, log_space=True)
+        allowed = vision_error(config, target)
+        trial_errors = []
+        needed = max_cycles + 1
+        start = time.perf_counter()
+        for cycle in range(1, max_cycles + 1):
+            raw_readings = take_raw_readings(arduino, mercury, config)
+            algorithm.main([parse_reading(reading, grid, config, split_targets=True) for reading in raw_readings])
+            error = max(float(np.hypot(row - target[0], col - target[1]))
+                        for row, col in algorithm.argmax().values())
+            trial_errors.append(error)
+            if needed > max_cycles and error <= allowed + tolerance:
+                needed = cycle
+        session_times.append(time.perf_counter() - start)
+        errors.append(trial_errors)
+        vision_errors.append(allowed)
+        cycles_needed.append(needed)
+    errors = np.array(errors)
+    return {
+        'final_error': errors[:, -1].tolist(),
+        'median_final_error': float(np.median(errors[:, -1])),
+        'median_vision_error': float(np.median(vision_errors)),
+        'median_error_per_cycle': np.median(errors, axis=0).tolist(),
+        'cycles_needed': cycles_needed,
+        'median_cycles': float(np.median(cycles_needed)),
+        'localized_fraction': float(np.mean([needed <= max_cycles for needed in cycles_needed])),
+        'median_session_sec': float(np.median(session_times)),
+    }
+
+
+def run_benchmarks(sizes, cycles=20, trials=10, max_cycles=50, seed=0):
+    """
+    Runs the stage timings and the end to end localization metric for every grid size.
+    :param sizes: list of ints of the side length of the square grids.
+    :param cycles: int of the number of timed cycles per size.
+    :param trials: int of the number of end to end sessions per size.
+    :param max_cycles: int of the maximum number of sweeps per end to end session.
+    :param seed: seed of everything random.
+    :return: dictionary of the results.
+    """
+    results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'sizes': {}}
+    for size in sizes:
+        print(f'benchmarking {size}x{size}')
+        results['sizes'][f'{size}x{size}'] = {
+            'cells': size * size,
+            'stages': benchmark_stages(size, size, cycles=cycles, seed=seed),
+            'localization': localization_error(size, size, trials=trials, max_cycles=max_cycles, seed=seed),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the posterior update and the localization latency.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 16, 64, 256])
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--trials', type=int, default=10)
+    parser.add_argument('--max-cycles', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+    benchmark_results = run_benchmarks(args.sizes, cycles=args.cycles, trials=args.trials,
+                                       max_cycles=args.max_cycles, seed=args.seed)
+    with open(args.output, 'w') as output:
+        json.dump(benchmark_results, output, indent=2)
+    print(f'results saved to {args.output}')
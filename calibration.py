@@ -0,0 +1,164 @@
+import argparse
+import os
+
+import numpy as np
+import yaml
+
+from data_obj import Config
+from data_obj import Grid
+from data_obj import MISSING
+from recorder import load_manifest
+from recorder import load_session
+
+
+def count_detections(sessions, config, include_grid_tags=True):
+    """
+    Counts, for every facing and grid space, how often a tag there could have been read and how often it was.
+    Every grid tag is a trial at every visit of a facing, and so is every target tag id at its labelled grid space.
+    :param sessions: list of tuples of the session path and the target cell.
+    :param config: the config object the sessions were recorded with.
+    :param include_grid_tags: count the grid tags as well as the targets.
+    :return: tuple of float ndarrays of shape (facings, rows, cols) of the trials and of the detections.
+    """
+    grid = Grid(config.tag_ids, config.grid_size)
+    shape = config.vision_masks.shape
+    facing_indexes = {tuple(facing): index for index, facing in enumerate(config.search_profile)}
+    visits = np.zeros(shape[0])
+    grid_reads = np.zeros(shape)
+    target_trials = np.zeros(shape)
+    target_reads = np.zeros(shape)
+    for session_path, target_cell in sessions:
+        for sweep in load_session(session_path):
+            for angles, reading in sweep:
+                facing = facing_indexes[angles]
+                visits[facing] = visits[facing] + 1
+                read = np.zeros(shape[1:], dtype=bool)
+                targets_read = set()
+                for epc in reading:
+                    if epc in config.target:
+                        targets_read.add(epc)
+                        continue
+                    location = grid.location(epc)
+                    if location is not MISSING:
+                        read[location] = True
+                grid_reads[facing] = grid_reads[facing] + read
+                target_trials[(facing,) + target_cell] += len(config.target)
+                target_reads[(facing,) + target_cell] += len(targets_read)
+    trials = target_trials
+    detections = target_reads
+    if include_grid_tags:
+        trials = trials + visits[:, None, None]
+        detections = detections + grid_reads
+    return trials, detections
+
+
+def pooled_rate(trials, detections, mask, default):
+    total = trials[mask].sum()
+    if total == 0:
+        return default
+    return float(detections[mask].sum() / total)
+
+
+def smoothed_rate(trials, detections, pooled, prior_strength):
+    total = trials + prior_strength
+    return np.where(total > 0, (detections + prior_strength * pooled) / np.where(total > 0, total, 1), pooled)
+
+
+def estimate_detection_model(trials, detections, vision_masks, mode='global', prior_strength=1.0,
+                             defaults=(0.8, 0.2), epsilon=1e-3):
+    """
+    Estimates p1 (detection in a facing's vision profile) and p2 (detection outside of it).
+    The global p1/p2 are the maximum likelihood pooled detection rates. The estimate of each facing or grid space is
+    smoothed: its detection rate pulled towards the pooled rate by prior_strength pseudo trials (the posterior mean
+    under a Beta prior centered on the pooled rate), so that grid spaces with few trials stay sensible. A
+    prior_strength of 0 gives the maximum likelihood rates, with the pooled rate where there are no trials.
+    :param trials: float ndarray of shape (facings, rows, cols) of the trials.
+    :param detections: float ndarray of shape (facings, rows, cols) of the detections.
+    :param vision_masks: boolean ndarray of shape (facings, rows, cols) of the expected grid spaces.
+    :param mode: 'global' for scalar p1/p2, 'facing' for one p1/p2 per facing, 'cell' for one per facing and grid space.
+    :param prior_strength: float of the pseudo trials of the pooled rate, 0 for no smoothing.
+    :param defaults: tuple of the p1/p2 used when there are no trials at all.
+    :param epsilon: float keeping the estimates away from 0 and 1, so log-likelihoods stay finite.
+    :return: dictionary of the scalar p1 and p2 and, unless global, the detection and false_detection tensors.
+    """
+    in_view = vision_masks
+    p1 = pooled_rate(trials, detections, in_view, defaults[0])
+    p2 = pooled_rate(trials, detections, ~in_view, defaults[1])
+    model = {'p1': float(np.clip(p1, epsilon, 1 - epsilon)), 'p2': float(np.clip(p2, epsilon, 1 - epsilon))}
+    if mode == 'global':
+        return model
+    if mode == 'facing':
+        in_trials = np.where(in_view, trials, 0).sum(axis=(1, 2))
+        out_trials = np.where(in_view, 0, trials).sum(axis=(1, 2))
+        in_detections = np.where(in_view, detections, 0).sum(axis=(1, 2))
+        out_detections = np.where(in_view, 0, detections).sum(axis=(1, 2))
+        facing_p1 = smoothed_rate(in_trials, in_detections, p1, prior_strength)
+        facing_p2 = smoothed_rate(out_trials, out_detections, p2, prior_strength)
+        detection = np.broadcast_to(facing_p1[:, None, None], trials.shape)
+        false_detection = np.broadcast_to(facing_p2[:, None, None], trials.shape)
+    elif mode == 'cell':
+        detection = smoothed_rate(trials, detections, p1, prior_strength)
+        false_detection = smoothed_rate(trials, detections, p2, prior_strength)
+        detection = np.where(in_view, detection, p1)
+        false_detection = np.where(in_view, p2, false_detection)
+    else:
+        raise ValueError(f'unknown calibration mode {mode}')
+    model['detection'] = np.clip(detection, epsilon, 1 - epsilon)
+    model['false_detection'] = np.clip(false_detection, epsilon, 1 - epsilon)
+    return model
+
+
+def write_config(config_path, model, output_path, model_path=None):
+    """
+    Writes a copy of the config with the calibrated p1/p2, and the per facing or grid space tensors next to it.
+    :param config_path: the config file the sessions were recorded with.
+    :param model: dictionary returned by estimate_detection_model.
+    :param output_path: path of the calibrated config file.
+    :param model_path: path of the .npz of the tensors, next to the output config when None.
+    :return: None
+    """
+    with open(config_path) as config:
+        config_data = yaml.load(config, Loader=yaml.FullLoader)
+    config_data['probabilities']['p1'] = model['p1']
+    config_data['probabilities']['p2'] = model['p2']
+    config_data['probabilities'].pop('detection_model', None)
+    if 'detection' in model:
+        if model_path is None:
+            model_path = os.path.splitext(output_path)[0] + '_detection.npz'
+        np.savez_compressed(model_path, detection=model['detection'], false_detection=model['false_detection'])
+        config_data['probabilities']['detection_model'] = os.path.relpath(model_path,
+                                                                          os.path.dirname(os.path.abspath(output_path)))
+    with open(output_path, 'w') as output:
+        yaml.dump(config_data, output, default_flow_style=None)
+
+
+def calibrate(manifest_path, config_path='config.yaml', mode='global', prior_strength=1.0, include_grid_tags=True):
+    """
+    Estimates the detection model from the labelled sessions of a manifest.
+    :param manifest_path: JSON list of {"session": log file, "target_cell": [row, col]}.
+    :param config_path: the config file the sessions were recorded with.
+    :param mode: 'global', 'facing' or 'cell'.
+    :param prior_strength: float of the pseudo trials of the pooled rate smoothing the per facing or grid space
+        estimates, 0 for no smoothing.
+    :param include_grid_tags: count the grid tags as well as the targets.
+    :return: dictionary returned by estimate_detection_model.
+    """
+    config = Config(config_path)
+    trials, detections = count_detections(load_manifest(manifest_path), config, include_grid_tags)
+    return estimate_detection_model(trials, detections, config.vision_masks, mode, prior_strength,
+                                    defaults=(config.p1, config.p2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calibrates p1/p2 from labelled recorded sessions.')
+    parser.add_argument('manifest', help='JSON list of {"session": log file, "target_cell": [row, col]}')
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--mode', choices=['global', 'facing', 'cell'], default='global')
+    parser.add_argument('--prior-strength', type=float, default=1.0,
+                        help='pseudo trials smoothing the facing / cell estimates towards the pooled rate, 0 for none')
+    parser.add_argument('--targets-only', action='store_true', help='only count the target tags')
+    parser.add_argument('--output', default='config_calibrated.yaml')
+    args = parser.parse_args()
+    calibrated = calibrate(args.manifest, args.config, args.mode, args.prior_strength, not args.targets_only)
+    write_config(args.config, calibrated, args.output)
+    print(f"p1 = {calibrated['p1']:.4f}, p2 = {calibrated['p2']:.4f}, saved to {args.output}")
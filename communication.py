@@ -1,76 +1,388 @@
-import mercury
 import socket
 import time
 
 
+def socket_alive(connection):
+    """
+    Checks, without blocking or consuming data, that the peer has not closed a socket.
+    :param connection: a connected socket.
+    :return: boolean of whether the socket is still usable.
+    """
+    timeout = connection.gettimeout()
+    connection.setblocking(False)
+    try:
+        return connection.recv(1, socket.MSG_PEEK) != b''
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        connection.settimeout(timeout)
+
+
+class ConnectionManager:
+    """Connection Manager object
+
+    Owns the connection to one device. Connects lazily, drops the connection when a health check fails, and retries
+    a failed command on a fresh connection, backing off exponentially between attempts, up to max_retries times.
+
+    Attributes:
+        name: String of the name of the device, used in errors.
+        connect: callable opening a new connection.
+        disconnect: callable closing a connection, or None.
+        health_check: callable returning whether a connection is still usable, or None.
+        max_retries: An integer of the reconnects attempted for a single command.
+        backoff: A float of the delay before the first reconnect (in sec), doubled for every further one.
+        max_backoff: A float of the longest delay between reconnects (in sec).
+        errors: tuple of the exception types that mean the connection is broken.
+        connection: the current connection, or None.
+        reconnects: An integer of the reconnects made so far.
+    """
+
+    def __init__(self, name, connect, disconnect=None, health_check=None, max_retries=5, backoff=0.5,
+                 max_backoff=10.0, errors=(OSError,)):
+        """
+        Initializes the manager, without connecting yet.
+        :param name: String of the name of the device, used in errors.
+        :param connect: callable opening a new connection.
+        :param disconnect: callable closing a connection, or None.
+        :param health_check: callable returning whether a connection is still usable, or None.
+        :param max_retries: integer of the reconnects attempted for a single command.
+        :param backoff: float of the delay before the first reconnect (in sec), doubled for every further one.
+        :param max_backoff: float of the longest delay between reconnects (in sec).
+        :param errors: tuple of the exception types that mean the connection is broken.
+        """
+        self.name = name
+        self.connect = connect
+        self.disconnect = disconnect
+        self.health_check = health_check
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.errors = errors
+        self.connection = None
+        self.reconnects = 0
+
+    def get(self):
+        """
+        Access the connection, connecting first if needed.
+        :return: the connection.
+        """
+        if self.connection is None:
+            self.connection = self.connect()
+        return self.connection
+
+    def check(self):
+        """
+        Runs the health check on the current connection and drops it when it fails, so the next command reconnects.
+        :return: boolean of whether the connection was healthy.
+        """
+        if self.connection is None:
+            return False
+        if self.health_check is None:
+            return True
+        try:
+            healthy = self.health_check(self.connection)
+        except self.errors:
+            healthy = False
+        if not healthy:
+            self.reset()
+        return healthy
+
+    def reset(self):
+        """
+        Closes and forgets the current connection.
+        :return: None
+        """
+        if self.connection is not None and self.disconnect is not None:
+            try:
+                self.disconnect(self.connection)
+            except self.errors:
+                pass
+        self.connection = None
+
+    def call(self, command):
+        """
+        Runs a command on the connection, reconnecting with backoff and retrying it when the connection breaks.
+        Commands are retried as a whole, so they should be safe to repeat.
+        :param command: callable taking the connection.
+        :return: the result of the command.
+        """
+        attempt = 0
+        while True:
+            try:
+                return command(self.get())
+            except self.errors as error:
+                self.reset()
+                if attempt >= self.max_retries:
+                    raise ConnectionError(f'{self.name} is unreachable after {attempt} reconnects') from error
+                time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+                attempt = attempt + 1
+                self.reconnects = self.reconnects + 1
+
+    def close(self):
+        self.reset()
+
+
 class ArduinoHandler:
     """Arduino Communication object
 
     Establishes and handles all communication with the ESP8266 via LAN.
+    Every angle is sent whole and the move is complete as soon as the device confirms it by echoing the angle on a
+    line (with echo False, any text ending in a newline confirms it). A device that does not confirm is given
+    ack_timeout, the worst case move time, instead. Whatever the device sent before a command, e.g. the late
+    confirmation of a move that timed out, is discarded before the command is sent, so it cannot confirm the wrong
+    move. A broken connection is reopened with backoff and the move is sent again.
 
     Attributes:
         connection: A socket connected to the ESP-8266.
         port: An integer value of the ESP-8266 Wifi Server's Port.
         host: A String of the ESP-8266's IP.
         move_time: An integer of the default time delay for a servo to move (in sec)
+        ack_timeout: A float of the longest wait for the device to confirm a move (in sec).
+        connect_timeout: A float of the longest wait for the connection to open (in sec).
+        echo: A boolean of whether a confirmation must echo the angle.
+        manager: the ConnectionManager of the socket.
+        acks: An integer of the moves the device confirmed.
     """
 
-    def __init__(self, host, port=80, move_time=2):
+    def __init__(self, host, port=80, move_time=2, ack_timeout=None, connect_timeout=5, max_retries=5, backoff=0.5,
+                 echo=True):
         """
         Initializes with a given host and port. The port is 80 by default.
         :param host: String of Local IP of the ESP-8266.
         :param port: integer of the port containing the ESP-8366 Wifi Server.
-        :param move_time: integer of the time (in millisec) given to the servos to move
+        :param move_time: integer of the time (in sec) given to the servos to move
+        :param ack_timeout: float of the longest wait for a move to be confirmed (in sec), move_time when None
+        :param connect_timeout: float of the longest wait for the connection to open (in sec)
+        :param max_retries: integer of the reconnects attempted for a single move
+        :param backoff: float of the delay before the first reconnect (in sec)
+        :param echo: boolean of whether a confirmation must echo the angle, any line confirms a move when False
         """
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connection.connect((host, port))
+        self.host = host
+        self.port = port
         self.move_time = move_time
+        self.ack_timeout = move_time if ack_timeout is None else ack_timeout
+        self.connect_timeout = connect_timeout
+        self.echo = echo
+        self.buffer = b''
+        self.acks = 0
+        self.manager = ConnectionManager('arduino', self.open_connection, lambda connection: connection.close(),
+                                         socket_alive, max_retries, backoff)
+        self.manager.call(lambda connection: None)
+
+    @property
+    def connection(self):
+        return self.manager.get()
+
+    def open_connection(self):
+        connection = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        connection.settimeout(None)
+        self.buffer = b''
+        return connection
 
     def send_angles(self, angles):
         """
-        Sends angles to the ESP-8266 to relay to the Arduino.
+        Sends angles to the ESP-8266 to relay to the Arduino, returning once every move is confirmed.
         :param angles: tuple of angles to be sent.
         """
+        self.manager.check()
+        self.manager.call(lambda connection: self.move(connection, angles))
+
+    def move(self, connection, angles):
         for angle in angles:
-            self.connection.send((str(angle)+'\r').encode('utf-8'))
-            time.sleep(self.move_time/2)
-        time.sleep(self.move_time)
+            command = str(angle).encode('utf-8')
+            self.drain(connection)
+            connection.sendall(command + b'\r')
+            if self.wait_for_ack(connection, self.ack_timeout, command if self.echo else None):
+                self.acks = self.acks + 1
+
+    def drain(self, connection):
+        """
+        Discards, without blocking, everything the device sent so far.
+        :param connection: the connected socket.
+        :return: None
+        """
+        self.buffer = b''
+        connection.setblocking(False)
+        try:
+            while True:
+                if not connection.recv(4096):
+                    raise ConnectionError('arduino closed the connection')
+        except BlockingIOError:
+            pass
+        finally:
+            connection.settimeout(None)
+
+    def wait_for_ack(self, connection, timeout, command=None):
+        """
+        Waits for the device to confirm the last command with a line, skipping the lines that do not echo it.
+        :param connection: the connected socket.
+        :param timeout: float of the longest wait (in sec).
+        :param command: bytes of the command the line must echo, or None to accept any line.
+        :return: boolean of whether the command was confirmed, False once the timeout elapsed.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                line, newline, rest = self.buffer.partition(b'\n')
+                if newline:
+                    self.buffer = rest
+                    if command is None or line.strip() == command:
+                        return True
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                connection.settimeout(remaining)
+                try:
+                    data = connection.recv(64)
+                except socket.timeout:
+                    return False
+                if not data:
+                    raise ConnectionError('arduino closed the connection')
+                self.buffer = self.buffer + data
+        finally:
+            connection.settimeout(None)
+
+    def close(self):
+        self.manager.close()
 
 
 class MercuryHandler:
     """Mercury RFID Reader Object
 
     Establishes and handles all communication with the Mercury RFID Reader.
+    A reader that stops answering is reopened with backoff, the read power is restored and the read is made again.
 
     Attributes:
         port: A String of the Mercury's IP.
+        uri: A String of the reader's URI.
+        read_power: An integer of the read power set, restored after a reconnect.
+        manager: the ConnectionManager of the mercury.Reader.
         base_read_power: An integer of the base read power if not overridden.
+        read_timeout: An integer of the duration of a single read (in millisec).
+        read_delay: A float of the delay after every read (in sec).
+        max_reads: An integer of the maximum number of reads in a burst.
+        patience: An integer of consecutive reads without new tag IDs that end a burst early, or None.
+        min_target_reads: An integer of target read counts that end a burst early, or None.
+        min_target_rssi: An integer of the target RSSI (in dBm) that ends a burst early, or None.
+        reads_used: An integer of the number of reads the last burst used.
+        last_tag_reads: A list of tuples of the tag ID, read count, RSSI and reading index of the last burst's reads.
     """
 
-    def __init__(self, host, base_read_power=2500):
+    def __init__(self, host, base_read_power=2500, read_timeout=500, read_delay=0.5, max_reads=6, patience=None,
+                 min_target_reads=None, min_target_rssi=None, max_retries=5, backoff=0.5):
         """
         Initializes the MercuryHandler object with given port.
         :param: host: A String of the local IP.
         :param: base_read_power: integer of the base read power of the reader (in dB)
+        :param: read_timeout: integer of the duration of a single read (in millisec)
+        :param: read_delay: float of the delay after every read (in sec)
+        :param: max_reads: integer of the maximum number of reads in a burst
+        :param: patience: integer of consecutive reads without new tag IDs that end a burst, None to never stop early
+        :param: min_target_reads: integer of target read counts that end a burst, None to ignore
+        :param: min_target_rssi: integer of the target RSSI (in dBm) that ends a burst, None to ignore
+        :param: max_retries: integer of the reconnects attempted for a single command
+        :param: backoff: float of the delay before the first reconnect (in sec)
         """
-        self.reader = mercury.Reader(f'tmr://{host}')
-        self.reader.set_read_powers([1], [base_read_power])
+        self.uri = f'tmr://{host}'
+        self.read_power = base_read_power
+        self.manager = ConnectionManager('mercury', self.open_reader, health_check=self.reader_alive,
+                                         max_retries=max_retries, backoff=backoff, errors=(OSError, RuntimeError))
+        self.manager.call(lambda reader: None)
+        self.read_timeout = read_timeout
+        self.read_delay = read_delay
+        self.max_reads = max_reads
+        self.patience = patience
+        self.min_target_reads = min_target_reads
+        self.min_target_rssi = min_target_rssi
+        self.reads_used = 0
+        self.last_tag_reads = []
+
+    @property
+    def reader(self):
+        return self.manager.get()
+
+    def open_reader(self):
+        import mercury
+        reader = mercury.Reader(self.uri)
+        reader.set_read_powers([1], [self.read_power])
+        return reader
+
+    @staticmethod
+    def reader_alive(reader):
+        reader.get_model()
+        return True
+
+    def check_connection(self):
+        """
+        Health checks the reader, so a dead reader is reopened before the next burst rather than during it.
+        :return: boolean of whether the reader was healthy.
+        """
+        return self.manager.check()
 
     def set_read_power(self, read_power):
         """
         Sets the read_power of the Mercury RFID Reader.
         :param read_power: Integer of the new Read Power (in dB)
         """
-        self.reader.set_read_powers([1], [read_power])
+        self.read_power = read_power
+        self.manager.call(lambda reader: reader.set_read_powers([1], [read_power]))
+
+    def read_tag_objects(self):
+        """
+        Instructs the Mercury RFID Reader to make a reading.
+        :return: List of the mercury tag read objects (epc, rssi and read_count)
+        """
+        identified_tag_objs = self.manager.call(lambda reader: reader.read(timeout=self.read_timeout))
+        time.sleep(self.read_delay)
+        return identified_tag_objs
 
     def make_read(self):
         """
         Instructs the Mercury RFID Reader to make a reading.
         :return: List of tuples containing the tag IDs and # of reads
         """
-        identified_tag_objs = self.reader.read(timeout=500)
-        time.sleep(0.5)
         identified_tags = []
-        for tag_obj in identified_tag_objs:
+        for tag_obj in self.read_tag_objects():
             identified_tags.append(tag_obj.epc.decode())
         return identified_tags
+
+    def make_read_burst(self, target=()):
+        """
+        Makes up to max_reads readings, stopping early once patience consecutive readings add no new tag IDs,
+        or once the target has been read min_target_reads times or at min_target_rssi.
+        :param target: tuple of the target tag IDs.
+        :return: tuple of the list of tag IDs read (in read order, across every reading) and the number of readings used
+        """
+        identified_tags = []
+        seen = set()
+        target_reads = 0
+        target_rssi = None
+        reads_without_new_tags = 0
+        self.reads_used = 0
+        self.last_tag_reads = []
+        self.check_connection()
+        while self.reads_used < self.max_reads:
+            new_tags = 0
+            for tag_obj in self.read_tag_objects():
+                epc = tag_obj.epc.decode()
+                identified_tags.append(epc)
+                self.last_tag_reads.append((epc, tag_obj.read_count, tag_obj.rssi, self.reads_used))
+                if epc not in seen:
+                    seen.add(epc)
+                    new_tags = new_tags + 1
+                if epc in target:
+                    target_reads = target_reads + tag_obj.read_count
+                    if target_rssi is None or tag_obj.rssi > target_rssi:
+                        target_rssi = tag_obj.rssi
+            self.reads_used = self.reads_used + 1
+            reads_without_new_tags = 0 if new_tags else reads_without_new_tags + 1
+            if self.patience is not None and reads_without_new_tags >= self.patience:
+                break
+            if self.min_target_reads is not None and target_reads >= self.min_target_reads:
+                break
+            if self.min_target_rssi is not None and target_rssi is not None and target_rssi >= self.min_target_rssi:
+                break
+        return identified_tags, self.reads_used
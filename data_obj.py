@@ -1,37 +1,62 @@
-import yaml
+import ast
+import hashlib
+import os
+import pickle
 
+import numpy as np
+
+
+class _Missing:
+    """Miss sentinel.
+
+    Returned by Grid lookups for ids and tags that are not on the grid. Falsy, and prints as 'none'.
+    """
+
+    def __repr__(self):
+        return 'none'
+
+    def __bool__(self):
+        return False
+
+
+MISSING = _Missing()
 
 class Tag:
     """Tag data object.
 
     Data type which contains the ids contained in a grid-space and the current f(X=current) probability.
+    Tags of a Grid are views: their probability lives in the Grid's probability array, at their cell.
 
     Attributes:
         id: the ids of the grid_tags in the current_grid space.
         probability: the probability that the target tag is near this tag.
+        values: flat float ndarray holding the probability.
+        cell: int index of the probability in values.
     """
+    __slots__ = ('id', 'values', 'cell')
 
-    def __init__(self, tag_id, initial_prob):
+    def __init__(self, tag_id, initial_prob, values=None, cell=0):
         """
         Initializes with given id and probability.
         :param tag_id: the ids of the tag.
         :param initial_prob: double of initial probability (based on the number of tags total).
+        :param values: flat float ndarray to keep the probability in, a standalone one when None.
+        :param cell: int index of the probability in values.
         """
         self.id = tag_id
-        self.probability = initial_prob
+        if values is None:
+            values = np.array([initial_prob], dtype=float)
+            cell = 0
+        self.values = values
+        self.cell = cell
 
-    def __getattr__(self, item):
-        """
-        Allows accessing the values of attributes.
-        :param item: string of the object being accessed.
-        :return: the value of the value being asked for.
-        """
-        if item is 'id':
-            return self.id
-        elif item is 'probability':
-            return self.probability
-        else:
-            raise AttributeError
+    @property
+    def probability(self):
+        return float(self.values[self.cell])
+
+    @probability.setter
+    def probability(self, new_prob):
+        self.values[self.cell] = new_prob
 
     def __eq__(self, other):
         """
@@ -77,10 +102,19 @@ class Grid:
     """Grid object.
 
     Data type which contains a 2d array of tag objects in their real-world locations.
+    The probabilities of every grid space are kept in a single contiguous array, row by row, which the Tag objects
+    view into, and the tag ids of every grid space in a flat table in the same order.
 
     Attributes:
         grid: 2d array of tag objects.
         grid_size: int of total number of spaces.
+        shape: tuple of the number of rows and columns.
+        ids: list of the tag ids tuple of every grid space, row by row.
+        values: flat float ndarray of the probability of every grid space, row by row.
+        probabilities: 2d float ndarray view of values.
+        index: dict of every tag id to the (row, col) coordinate of its grid space.
+        tag_index: dict of every tag id to the Tag object of its grid space.
+        id_index: dict of the ids tuple of every Tag object to the (row, col) coordinate of its grid space.
     """
 
     def __init__(self, tags, grid_size):
@@ -89,73 +123,84 @@ class Grid:
         :param tags: the RFID tags to populate the grid.
         :param grid_size: the total number of grid spaces.
         """
-        self.grid = self.generate_grid(tags, grid_size)
         self.grid_size = grid_size
+        self.shape = (len(tags), len(tags[0]) if tags else 0)
+        self.ids = [tag_id for row in tags for tag_id in row]
+        self.values = np.full(len(self.ids), 1 / grid_size)
+        self.grid = self.generate_grid(tags, grid_size)
+        self.index, self.tag_index, self.id_index = self.generate_index(self.grid)
 
     def generate_grid(self, tag_list, grid_size):
         """
-        Generates the 2d array of Tag objects using the tag ids given .
+        Generates the 2d array of Tag objects using the tag ids given, viewing into the probability array.
         :param tag_list: list of tag ids.
         :param grid_size: int of total number of grid spaces.
         :return: 2d list grid populated with tag objects.
         """
+        if self.shape[0] * self.shape[1] != len(self.ids):
+            raise ValueError('every row of grid_tags must have the same number of grid spaces')
         temp_grid = []
-        for row in tag_list:
-            temp_row = []
-            for tag in row:
-                temp_row.append(Tag(tag, 1 / grid_size))
-            temp_grid.append(temp_row)
+        cols = self.shape[1]
+        for x, row in enumerate(tag_list):
+            temp_grid.append([Tag(tag, 1 / grid_size, self.values, x * cols + y) for y, tag in enumerate(row)])
         return temp_grid
 
+    def generate_index(self, grid):
+        """
+        Generates the hash indexes used for constant time lookups.
+        :param grid: 2d list grid populated with tag objects.
+        :return: tuple of dicts: tag id to coordinate, tag id to Tag, Tag ids to coordinate.
+        """
+        index = {}
+        tag_index = {}
+        id_index = {}
+        for x, row in enumerate(grid):
+            for y, tag in enumerate(row):
+                for tag_id in tag.id:
+                    index[tag_id] = (x, y)
+                    tag_index[tag_id] = tag
+                id_index[tag.id] = (x, y)
+        return index, tag_index, id_index
+
+    @property
+    def probabilities(self):
+        """
+        Zero-copy 2d view of the probabilities of every grid space.
+        :return: 2d float ndarray.
+        """
+        return self.values.reshape(self.shape)
+
+    def location(self, item):
+        """
+        Access the coordinate of a tag object or of a tag id.
+        :param item: Tag id or a Tag object.
+        :return: tuple of the (row, col) coordinate, or MISSING.
+        """
+        if type(item) is Tag:
+            return self.id_index.get(item.id, MISSING)
+        return self.index.get(item, MISSING)
+
     def update_probabilities(self, new_probability_grid):
         """
-        Updates the probabilities of every tag object in the grid.
+        Updates the probabilities of every tag object in the grid, in place.
         :param new_probability_grid: grid of probabilities to update all tags.
         :return: None
         """
-        for prob_row, row in zip(new_probability_grid, self.grid):
-            for prob_value, tag in zip(prob_row, row):
-                tag.set_prob(prob_value)
-
-    def __getattr__(self, item):
-        """
-        Allows for accessing the nested probabilities of every tag in the grid.
-        :param item: String of the name of the attribute being accessed.
-        :return: 2d array of the probabilities of tags.
-        """
-        if item is 'probabilities':
-            temp_grid = []
-            for row in self.grid:
-                temp_row = []
-                for tag in row:
-                    temp_row.append(tag.probability)
-                temp_grid.append(temp_row)
-            return temp_grid
-        else:
-            raise AttributeError
+        self.probabilities[...] = new_probability_grid
 
     def __getitem__(self, item):
         """
         Access the coordinate of a tag object or the tag object from a tag id.
+        The coordinate is returned in its string form for backward compatibility, use location() for tuples.
         :param item: Tag id or a Tag object.
-        :return: String of tuple of coordinate or tag object.
+        :return: String of tuple of coordinate or tag object, or MISSING.
         """
         if type(item) is Tag:
-            x = 0
-            for row in self.grid:
-                y = 0
-                for tag in row:
-                    if item == tag:
-                        return f'{(x,y)}'
-                    y = y + 1
-                x = x + 1
-            return 'none'
-        else:
-            for row in self.grid:
-                for tags in row:
-                    if item in tags:
-                        return tags
-            return 'none'
+            location = self.id_index.get(item.id, MISSING)
+            if location is MISSING:
+                return MISSING
+            return f'{location}'
+        return self.tag_index.get(item, MISSING)
 
     def __len__(self):
         """
@@ -178,30 +223,136 @@ class Config:
         ips: the ips to connect to the arduino and reader.
         cycles: the number of cycles to run the algorithm.
         grid_size: the size of the grid.
-        search_profile: list of the angles to take readings.
+        search_profile: list of the angles to take readings, the facings of every station one after the other.
         vision_profile: the expected tags at each search profile.
+        stations: list of dicts of the name, ips and facings (indexes into search_profile) of every reader station.
+        grid_shape: tuple of the number of rows and columns of the grid.
+        vision_cells: list of frozensets of the (row, col) coordinates expected at each search profile.
+        vision_masks: boolean ndarray of shape (facings, rows, cols) of the expected grid spaces.
         p1: p1 for the algorithm.
         p2: p2 for the algorithm.
+        detection: float ndarray of shape (facings, rows, cols) of the probability of reading a tag in the vision
+            profile, or None to use p1 everywhere.
+        false_detection: float ndarray of shape (facings, rows, cols) of the probability of reading a tag outside
+            of the vision profile, or None to use p2 everywhere.
         target: target tag ids.
+        detection_model_path: the path of the detection model file the tensors were loaded from, or None.
+        motion: dictionary of the motion model of moving targets (stay, radius, sigma, kernel), or None for static ones.
+        burst: dictionary of the reader settings of every reading burst (read_timeout, read_delay, max_reads, patience,
+            min_target_reads, min_target_rssi, see MercuryHandler), empty for the defaults of the readers.
     """
+    cache_version = 4
+    burst_options = ('read_timeout', 'read_delay', 'max_reads', 'patience', 'min_target_reads', 'min_target_rssi')
 
-    def __init__(self, location):
+    def __init__(self, location, use_cache=True):
         """
         Initializes the the config object.
+        The parsed and validated config is cached in a binary file next to the config file, and reused for as long as
+        the config file (and the detection model file it names) are unchanged.
         :param location: the url of the config file.
+        :param use_cache: read and write the cache, parse the config file every time when False.
+        """
+        with open(location, 'rb') as config:
+            raw = config.read()
+        key = hashlib.sha256(raw).hexdigest()
+        cache_path = self.cache_path(location)
+        if use_cache and self.load_cache(cache_path, key):
+            return
+        import yaml
+        config_data = yaml.load(raw, Loader=getattr(yaml, 'CFullLoader', yaml.FullLoader))
+        self.load(config_data, os.path.dirname(os.path.abspath(location)))
+        if use_cache:
+            self.save_cache(cache_path, key)
+
+    @staticmethod
+    def cache_path(location):
+        directory, name = os.path.split(os.path.abspath(location))
+        return os.path.join(directory, f'.{name}.cache')
+
+    @staticmethod
+    def file_stamp(path):
+        if path is None:
+            return None
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def load_cache(self, cache_path, key):
+        """
+        Restores the config from its cache, if the cache is of the same config file.
+        :param cache_path: path of the cache file.
+        :param key: String of the hash of the config file.
+        :return: whether the config was restored.
+        """
+        try:
+            with open(cache_path, 'rb') as cache:
+                cached = pickle.load(cache)
+            if cached['version'] != self.cache_version or cached['key'] != key:
+                return False
+            state = cached['state']
+            if self.file_stamp(state['detection_model_path']) != cached['detection_model_stamp']:
+                return False
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError, AttributeError):
+            return False
+        self.__dict__.update(state)
+        return True
+
+    def save_cache(self, cache_path, key):
+        """
+        Writes the cache of the config, ignoring a directory that cannot be written to.
+        :param cache_path: path of the cache file.
+        :param key: String of the hash of the config file.
+        :return: None
+        """
+        cached = {'version': self.cache_version, 'key': key, 'state': dict(self.__dict__),
+                  'detection_model_stamp': self.file_stamp(self.detection_model_path)}
+        temporary_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(temporary_path, 'wb') as cache:
+                pickle.dump(cached, cache, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, cache_path)
+        except OSError:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    @classmethod
+    def from_dict(cls, config_data, base_path='.'):
+        """
+        Builds a config object from already parsed config data, e.g. for synthetic grids.
+        :param config_data: dictionary with the same layout as the config file.
+        :param base_path: directory relative paths of the config data are taken from.
+        :return: the config object.
+        """
+        config = cls.__new__(cls)
+        config.load(config_data, base_path)
+        return config
+
+    def load(self, config_data, base_path='.'):
+        """
+        Loads and validates the parsed config data.
+        :param config_data: dictionary with the same layout as the config file.
+        :param base_path: directory relative paths of the config data are taken from.
+        :return: None
         """
-        with open(location) as config:
-            config_data = yaml.load(config)
-            self.tag_ids = self.get_tags(config_data['tags']['grid_tags'])
+        self.tag_ids = self.get_tags(config_data['tags']['grid_tags'])
+        self.cycles = config_data['cycles']
+        self.grid_size = config_data['tags']['grid_size']
+        if config_data.get('stations'):
+            self.search_profile, self.vision_profile, self.stations = self.get_stations(config_data)
+            self.ips = config_data.get('ips') or self.stations[0]['ips']
+        else:
             self.ips = config_data['ips']
-            self.cycles = config_data['cycles']
-            self.grid_size = config_data['tags']['grid_size']
             self.search_profile = config_data['search_profile']
             self.vision_profile = config_data['vision_profile']
-            self.p1 = config_data['probabilities']['p1']
-            self.p2 = config_data['probabilities']['p2']
-            self.target = config_data['tags']['target_tag']
-            config.close()
+            self.stations = [{'name': 'station_0', 'ips': self.ips, 'facings': list(range(len(self.search_profile)))}]
+        self.p1 = config_data['probabilities']['p1']
+        self.p2 = config_data['probabilities']['p2']
+        self.target = config_data['tags']['target_tag']
+        self.grid_shape = (len(self.tag_ids), len(self.tag_ids[0]))
+        self.vision_cells = self.get_vision_cells(self.vision_profile)
+        self.vision_masks = self.get_vision_masks(self.vision_cells)
+        self.detection, self.false_detection = self.get_detection_model(config_data['probabilities'], base_path)
+        self.motion = config_data.get('motion')
+        self.burst = self.get_burst(config_data.get('burst'))
 
     def __getattr__(self, item):
         """
@@ -232,6 +383,41 @@ class Config:
         else:
             raise AttributeError
 
+    def get_stations(self, config_data):
+        """
+        Combines the search and vision profiles of every reader station into one, keeping track of which facings
+        belong to which station.
+        :param config_data: dictionary with the same layout as the config file.
+        :return: tuple of the combined search profile, the combined vision profile and the list of station dicts.
+        """
+        search_profile = []
+        vision_profile = []
+        stations = []
+        for number, station in enumerate(config_data['stations']):
+            name = station.get('name', f'station_{number}')
+            if len(station['search_profile']) != len(station['vision_profile']):
+                raise ValueError(f'station {name} has {len(station["search_profile"])} facings '
+                                 f'but {len(station["vision_profile"])} vision profiles')
+            first = len(search_profile)
+            search_profile.extend(station['search_profile'])
+            vision_profile.extend(station['vision_profile'])
+            stations.append({'name': name, 'ips': station.get('ips', config_data.get('ips')),
+                             'facings': list(range(first, len(search_profile)))})
+        return search_profile, vision_profile, stations
+
+    def get_burst(self, burst):
+        """
+        Validates the reader settings of the burst section.
+        :param burst: the burst section of the config data, or None.
+        :return: dictionary of the reader settings.
+        """
+        burst = dict(burst or {})
+        unknown = sorted(set(burst) - set(self.burst_options))
+        if unknown:
+            raise ValueError(f'unknown burst settings {", ".join(unknown)}, '
+                             f'expected some of {", ".join(self.burst_options)}')
+        return burst
+
     def get_tags(self, config_data):
         """
         Pulls the tags from the config data for the grid.
@@ -246,3 +432,70 @@ class Config:
             grid.append(row)
         return grid
 
+    def get_vision_cells(self, vision_profile):
+        """
+        Parses the stringified coordinates of the vision profile and validates them against the grid.
+        :param vision_profile: list of tuples of stringified coordinates, one tuple per search profile.
+        :return: list of frozensets of (row, col) coordinates.
+        """
+        rows, cols = self.grid_shape
+        if rows * cols != self.grid_size:
+            raise ValueError(f'grid_size is {self.grid_size} but the grid_tags form a {rows}x{cols} grid')
+        if len(vision_profile) != len(self.search_profile):
+            raise ValueError(f'search_profile has {len(self.search_profile)} facings '
+                             f'but vision_profile has {len(vision_profile)}')
+        vision_cells = []
+        for facing, expected in enumerate(vision_profile):
+            cells = set()
+            for location in expected:
+                x, y = ast.literal_eval(location)
+                if not (0 <= x < rows and 0 <= y < cols):
+                    raise ValueError(f'vision_profile facing {facing} expects {location}, '
+                                     f'which is outside the {rows}x{cols} grid')
+                cells.add((x, y))
+            vision_cells.append(frozenset(cells))
+        return vision_cells
+
+    def get_vision_masks(self, vision_cells):
+        """
+        Builds the dense boolean masks of the expected grid spaces, aligned with the search profile.
+        :param vision_cells: list of frozensets of (row, col) coordinates.
+        :return: boolean ndarray of shape (facings, rows, cols).
+        """
+        masks = np.zeros((len(vision_cells),) + self.grid_shape, dtype=bool)
+        for facing, cells in enumerate(vision_cells):
+            for cell in cells:
+                masks[(facing,) + cell] = True
+        return masks
+
+    def get_detection_model(self, probabilities, base_path='.'):
+        """
+        Loads the optional per facing and grid space detection probabilities, either inline as nested lists under
+        detection / false_detection, or from the .npz file named by detection_model (e.g. written by calibration.py).
+        Inline values take precedence over the file.
+        :param probabilities: the probabilities section of the config data.
+        :param base_path: directory a relative detection_model path is taken from.
+        :return: tuple of the detection and false_detection ndarrays, each None when missing.
+        """
+        tensors = {'detection': None, 'false_detection': None}
+        self.detection_model_path = None
+        if probabilities.get('detection_model'):
+            self.detection_model_path = os.path.abspath(os.path.join(base_path, probabilities['detection_model']))
+            with np.load(self.detection_model_path) as model:
+                for name in tensors:
+                    if name in model:
+                        tensors[name] = model[name]
+        for name in tensors:
+            if probabilities.get(name) is not None:
+                tensors[name] = probabilities[name]
+        for name, tensor in tensors.items():
+            if tensor is None:
+                continue
+            tensor = np.asarray(tensor, dtype=float)
+            if tensor.shape != self.vision_masks.shape:
+                raise ValueError(f'{name} has shape {tensor.shape} but the search profile and grid need '
+                                 f'{self.vision_masks.shape}')
+            if not np.all((tensor > 0) & (tensor < 1)):
+                raise ValueError(f'{name} probabilities must be strictly between 0 and 1')
+            tensors[name] = tensor
+        return tensors['detection'], tensors['false_detection']
@@ -0,0 +1,228 @@
+import copy
+import json
+
+import numpy as np
+
+from data_obj import Grid
+from data_obj import MISSING
+from data_obj import Tag
+
+
+class PosteriorHistory:
+    """Posterior History object
+
+    Keeps the posterior of every cycle as a float32 snapshot in a preallocated ring buffer (optionally memory-mapped
+    to a .npy file), together with the parsed readings of that cycle. Once capacity cycles are stored the oldest
+    cycle is evicted. The readings of a cycle are kept as its sweeps, each a list of (facing index, reading) pairs,
+    so cycles of reader stations (one sweep per station) and adaptive cycles (one sweep per facing) replay as run.
+
+    Attributes:
+        shape: tuple of the shape of a single snapshot.
+        capacity: int of the number of cycles retained.
+        count: int of the number of cycles appended so far (including evicted ones).
+        snapshots: float32 ndarray (or memmap) of shape (capacity,) + shape holding the ring buffer.
+        readings: list of the sweeps of (facing index, reading) pairs of each slot of the ring buffer, or None.
+        template: deep copy of the grid, refreshed with the latest snapshot by most_recent_grid.
+    """
+
+    def __init__(self, grid=None, capacity=1024, memmap_path=None, initial=None, shape=None):
+        """
+        Initializes the history, recording the initial posterior as the first cycle.
+        :param grid: the Grid of the session, used to encode readings and for most_recent_grid.
+        :param capacity: int of the number of cycles retained.
+        :param memmap_path: path of a .npy file to memory-map the snapshots to, kept in memory when None.
+        :param initial: ndarray of the initial posterior (e.g. stacked per target), the grid's probabilities when None.
+        :param shape: tuple of the shape of a single snapshot, only needed without a grid or an initial posterior.
+        """
+        if initial is None:
+            initial = grid
+        if initial is not None:
+            shape = self.as_array(initial).shape
+        self.shape = tuple(shape)
+        self.capacity = capacity
+        self.count = 0
+        if memmap_path is None:
+            self.snapshots = np.zeros((capacity,) + self.shape, dtype=np.float32)
+        else:
+            self.snapshots = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=np.float32,
+                                                       shape=(capacity,) + self.shape)
+        self.readings = [None] * capacity
+        self.template = None
+        if grid is not None:
+            self.template = copy.deepcopy(grid)
+        if initial is not None:
+            self.append(initial)
+
+    @staticmethod
+    def as_array(grid):
+        if isinstance(grid, Grid):
+            return grid.probabilities.astype(np.float32)
+        return np.asarray(grid, dtype=np.float32)
+
+    def append(self, grid, readings=None, sweeps=None):
+        """
+        Stores a snapshot of the posterior, evicting the oldest cycle once the history is full.
+        :param grid: the Grid or ndarray of the posterior probabilities.
+        :param readings: the parsed readings of a cycle of a single sweep over the search profile, one per facing
+            (lists of Tag objects, 'target', target ids or MISSING).
+        :param sweeps: the sweeps of the cycle instead, each a list of (facing index, parsed reading) pairs.
+        :return: None
+        """
+        if sweeps is None and readings is not None:
+            sweeps = [list(enumerate(readings))]
+        slot = self.count % self.capacity
+        self.snapshots[slot] = self.as_array(grid)
+        self.readings[slot] = sweeps
+        self.count = self.count + 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def slot(self, index):
+        """
+        Maps an index of the retained cycles (oldest first, negative from the latest) to its ring buffer slot.
+        :param index: int index.
+        :return: int slot.
+        """
+        if index < 0:
+            index = index + len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('history index out of range')
+        return (self.count - len(self) + index) % self.capacity
+
+    def __getitem__(self, index):
+        """
+        Access the snapshot of a retained cycle.
+        :param index: int index, oldest first, negative from the latest.
+        :return: float32 ndarray view of the snapshot.
+        """
+        return self.snapshots[self.slot(index)]
+
+    def latest(self):
+        """
+        Access the latest snapshot without copying.
+        :return: float32 ndarray view of the snapshot.
+        """
+        return self[-1]
+
+    def __getattr__(self, item):
+        """
+        Allows accessing the latest posterior as a Grid, as BayesianAlgorithm expects.
+        :param item: String of the name of the attribute being accessed.
+        :return: the template Grid holding the latest probabilities.
+        """
+        if item == 'most_recent_grid':
+            if self.template is None:
+                raise AttributeError('most_recent_grid needs a history created from a Grid')
+            self.template.update_probabilities(self.latest())
+            return self.template
+        raise AttributeError(item)
+
+    def ordered_snapshots(self):
+        """
+        Copies the retained snapshots out of the ring buffer.
+        :return: float32 ndarray of the snapshots, oldest first.
+        """
+        slots = [self.slot(index) for index in range(len(self))]
+        return np.asarray(self.snapshots[slots])
+
+    def encode_readings(self, sweeps):
+        """
+        Converts the sweeps of a cycle into JSON friendly lists of [facing index, reading] pairs: Tag objects become
+        their [row, col], MISSING None.
+        """
+        if sweeps is None:
+            return None
+        encoded = []
+        for sweep in sweeps:
+            encoded_sweep = []
+            for facing_index, reading in sweep:
+                encoded_reading = []
+                for tag in reading:
+                    if isinstance(tag, Tag):
+                        encoded_reading.append(list(self.template.location(tag)))
+                    elif tag is MISSING:
+                        encoded_reading.append(None)
+                    else:
+                        encoded_reading.append(tag)
+                encoded_sweep.append([int(facing_index), encoded_reading])
+            encoded.append(encoded_sweep)
+        return encoded
+
+    def decode_readings(self, encoded, grid):
+        """
+        Converts sweeps encoded by encode_readings back into sweeps of parsed readings of the given grid.
+        """
+        if encoded is None:
+            return None
+        sweeps = []
+        for encoded_sweep in encoded:
+            sweep = []
+            for facing_index, encoded_reading in encoded_sweep:
+                reading = []
+                for tag in encoded_reading:
+                    if isinstance(tag, list):
+                        reading.append(grid.grid[tag[0]][tag[1]])
+                    elif tag is None:
+                        reading.append(MISSING)
+                    else:
+                        reading.append(tag)
+                sweep.append((facing_index, reading))
+            sweeps.append(sweep)
+        return sweeps
+
+    def save(self, path):
+        """
+        Saves the retained cycles to a compressed .npz file.
+        :param path: path of the file.
+        :return: None
+        """
+        encoded = [self.encode_readings(self.readings[self.slot(index)]) for index in range(len(self))]
+        np.savez_compressed(path, snapshots=self.ordered_snapshots(), first_cycle=self.count - len(self),
+                            readings=json.dumps(encoded), readings_format=2)
+
+    @classmethod
+    def load(cls, path, grid=None, capacity=None):
+        """
+        Loads cycles saved by save(). Files saved before the sweeps were kept load every cycle as one sweep over
+        the first facings of the search profile.
+        :param path: path of the file.
+        :param grid: the Grid the session ran on, needed to decode readings and for most_recent_grid.
+        :param capacity: int of the number of cycles retained, the number of saved cycles when None.
+        :return: the PosteriorHistory object.
+        """
+        with np.load(path) as data:
+            snapshots = data['snapshots']
+            first_cycle = int(data['first_cycle'])
+            encoded = json.loads(str(data['readings']))
+            if 'readings_format' not in data:
+                encoded = [None if readings is None else [list(enumerate(readings))] for readings in encoded]
+        history = cls(capacity=capacity or max(len(snapshots), 1), shape=snapshots.shape[1:])
+        if grid is not None:
+            history.template = copy.deepcopy(grid)
+        history.count = first_cycle
+        for snapshot, encoded_readings in zip(snapshots, encoded):
+            readings = None
+            if grid is not None:
+                readings = history.decode_readings(encoded_readings, grid)
+            history.append(snapshot, sweeps=readings)
+        return history
+
+    def replay(self, algorithm):
+        """
+        Feeds the recorded readings of every retained cycle through an algorithm, e.g. with new p1/p2. Every cycle
+        predicts once and then applies each of its sweeps as its own likelihood factor, as during the run, also when
+        it took no reading at all (e.g. adaptive mode with the stop rule met).
+        :param algorithm: a VectorizedAlgorithm (or subclass) object.
+        :return: list of the estimates after every replayed cycle.
+        """
+        estimates = []
+        for index in range(len(self)):
+            sweeps = self.readings[self.slot(index)]
+            if sweeps is not None:
+                algorithm.predict()
+                for sweep in sweeps:
+                    algorithm.observe_sweep([reading for _, reading in sweep],
+                                            [facing_index for facing_index, _ in sweep])
+                estimates.append(algorithm.estimate())
+        return estimates
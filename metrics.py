@@ -0,0 +1,203 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+
+def configure_tracing(level):
+    """
+    Sends the tracing of every module to stderr.
+    :param level: String of the level: 'info', 'debug' or 'trace' (every grid space of every update).
+    :return: None
+    """
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s',
+                        level=TRACE if level == 'trace' else getattr(logging, level.upper()))
+
+
+def series_name(name, labels):
+    """
+    Formats a metric name and its labels the Prometheus way, e.g. reads_total{facing="3"}.
+    :param name: String of the metric name.
+    :param labels: tuple of the (label, value) pairs.
+    :return: String of the series name.
+    """
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}'
+
+
+class Metrics:
+    """Metrics object
+
+    Collects the timing of every stage of a cycle (servo move, read burst, parse, update, normalize), counters
+    (e.g. reads per facing, unknown EPCs) and gauges (e.g. the posterior entropy). Every end_cycle() appends the
+    cycle to a line-delimited JSON file:
+    {"cycle": cycle number, "t": timestamp, "stages": {stage: sec}, "counters": {series: total}, "gauges": {series: value}}
+    or rewrites a Prometheus text file, which node_exporter's textfile collector can pick up.
+    Stages, counters and gauges may be recorded from several threads.
+
+    Attributes:
+        path: String of the path of the metrics file, or None to only keep them in memory.
+        format: String of the format of the metrics file, 'jsonl' or 'prometheus'.
+        prefix: String prepended to every Prometheus metric name.
+        stages: dict of stage to the list of its count, total time and longest time (in sec).
+        counters: dict of (name, labels) to the total counted.
+        gauges: dict of (name, labels) to the last value set.
+        cycle: int of the number of cycles ended.
+        cycle_stages: dict of stage to its total time (in sec) in the current cycle.
+    """
+
+    def __init__(self, path=None, format='jsonl', prefix='rfid_'):
+        """
+        Initializes empty metrics.
+        :param path: String of the path of the metrics file, or None to only keep them in memory.
+        :param format: String of the format of the metrics file, 'jsonl' or 'prometheus'.
+        :param prefix: String prepended to every Prometheus metric name.
+        """
+        if format not in ('jsonl', 'prometheus'):
+            raise ValueError(f'unknown metrics format {format}')
+        self.path = path
+        self.format = format
+        self.prefix = prefix
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.cycle = 0
+        self.cycle_stages = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Times the enclosed block as a stage.
+        :param stage: String of the stage name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        """
+        Records one run of a stage.
+        :param stage: String of the stage name.
+        :param seconds: float of the time it took (in sec).
+        :return: None
+        """
+        with self.lock:
+            count, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = [count + 1, total + seconds, max(longest, seconds)]
+            self.cycle_stages[stage] = self.cycle_stages.get(stage, 0.0) + seconds
+
+    def count(self, name, amount=1, **labels):
+        """
+        Adds to a counter.
+        :param name: String of the counter name.
+        :param amount: number added.
+        :param labels: the labels of the counter, e.g. facing=3.
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        """
+        Sets a gauge.
+        :param name: String of the gauge name.
+        :param value: float of the value.
+        :param labels: the labels of the gauge, e.g. target='E200...'.
+        :return: None
+        """
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = float(value)
+
+    def snapshot(self):
+        """
+        Gives the totals so far.
+        :return: dictionary of the stage totals, the counters and the gauges, keyed by series name.
+        """
+        with self.lock:
+            return {
+                'stages': {stage: {'count': count, 'sum': total, 'max': longest}
+                           for stage, (count, total, longest) in self.stages.items()},
+                'counters': {series_name(name, labels): value for (name, labels), value in self.counters.items()},
+                'gauges': {series_name(name, labels): value for (name, labels), value in self.gauges.items()},
+            }
+
+    def end_cycle(self):
+        """
+        Ends the current cycle and writes the metrics file.
+        :return: dictionary of the stage times of the cycle.
+        """
+        with self.lock:
+            self.cycle = self.cycle + 1
+            cycle_stages = self.cycle_stages
+            self.cycle_stages = {}
+        if self.path is not None:
+            if self.format == 'jsonl':
+                snapshot = self.snapshot()
+                event = {'cycle': self.cycle, 't': time.time(), 'stages': cycle_stages,
+                         'counters': snapshot['counters'], 'gauges': snapshot['gauges']}
+                with open(self.path, 'a') as log:
+                    log.write(json.dumps(event) + '\n')
+            else:
+                self.write_prometheus(self.path)
+        return cycle_stages
+
+    def prometheus(self):
+        """
+        Formats the metrics in the Prometheus text exposition format.
+        :return: String of the metrics.
+        """
+        lines = []
+        with self.lock:
+            stage_name = f'{self.prefix}stage_seconds'
+            lines.append(f'# TYPE {stage_name} summary')
+            for stage, (count, total, longest) in sorted(self.stages.items()):
+                labels = (('stage', stage),)
+                lines.append(f'{series_name(stage_name + "_count", labels)} {count}')
+                lines.append(f'{series_name(stage_name + "_sum", labels)} {total:.9g}')
+            lines.append(f'# TYPE {self.prefix}stage_seconds_max gauge')
+            for stage, (count, total, longest) in sorted(self.stages.items()):
+                lines.append(f'{series_name(stage_name + "_max", (("stage", stage),))} {longest:.9g}')
+            lines.append(f'# TYPE {self.prefix}cycles_total counter')
+            lines.append(f'{self.prefix}cycles_total {self.cycle}')
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in typed:
+                        typed.add(name)
+                        lines.append(f'# TYPE {self.prefix}{name} {kind}')
+                    lines.append(f'{series_name(self.prefix + name, labels)} {value:.9g}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Rewrites a Prometheus text file atomically, so a scraper never reads half of it.
+        :param path: String of the path of the text file.
+        :return: None
+        """
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as text:
+            text.write(self.prometheus())
+        os.replace(temporary, path)
+
+
+def timed(metrics, stage):
+    """
+    Times a block as a stage of metrics, or does nothing without metrics.
+    :param metrics: Metrics object, or None.
+    :param stage: String of the stage name.
+    :return: a context manager.
+    """
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.timer(stage)
@@ -0,0 +1,99 @@
+import numpy as np
+
+
+class MotionModel:
+    """Motion Model object
+
+    Predict step of a tracking filter, for targets that may move between two updates. The target stays in its grid
+    space with probability stay and otherwise takes a step drawn from the kernel. The kernel is separable, the same
+    1d step distribution along the rows and along the cols, so the prediction is two 1d convolutions over the
+    probability array, linear in the number of grid spaces. Steps past the edge of the grid are reflected back into it,
+    so no probability is lost.
+
+    Attributes:
+        stay: float of the probability of the target staying in its grid space.
+        kernel: float ndarray of odd length of the probability of every step along one axis, centered on no step.
+        radius: int of the longest step along one axis.
+    """
+
+    def __init__(self, stay=0.9, radius=1, sigma=None, kernel=None):
+        """
+        Initializes the motion model.
+        :param stay: float of the probability of the target staying in its grid space.
+        :param radius: int of the longest step along one axis, used when kernel is None.
+        :param sigma: float of the standard deviation (in grid spaces) of a gaussian step, a uniform step when None.
+        :param kernel: sequence of odd length of the weights of every step along one axis, centered on no step.
+        """
+        if not 0 <= stay <= 1:
+            raise ValueError(f'stay probability {stay} is not in [0, 1]')
+        if kernel is None:
+            offsets = np.arange(-radius, radius + 1)
+            kernel = np.ones(len(offsets)) if sigma is None else np.exp(-0.5 * (offsets / sigma) ** 2)
+        kernel = np.asarray(kernel, dtype=float)
+        if kernel.ndim != 1 or len(kernel) % 2 == 0 or np.any(kernel < 0) or kernel.sum() <= 0:
+            raise ValueError('the motion kernel must be 1d, of odd length and non negative')
+        self.stay = float(stay)
+        self.kernel = kernel / kernel.sum()
+        self.radius = len(kernel) // 2
+
+    @classmethod
+    def from_config(cls, motion):
+        """
+        Builds the motion model of the motion section of a config.
+        :param motion: dictionary of the stay, radius, sigma and/or kernel, or None.
+        :return: MotionModel object, or None without a motion section.
+        """
+        if not motion:
+            return None
+        return cls(**motion)
+
+    def convolve(self, values, axis):
+        """
+        Spreads every value along one axis by the kernel, folding the steps past an edge back into the grid, so the
+        sum of the values is kept.
+        :param values: float ndarray.
+        :param axis: int of the axis.
+        :return: float ndarray of the same shape.
+        """
+        radius = self.radius
+        if radius == 0:
+            return values
+        values = np.moveaxis(values, axis, -1)
+        length = values.shape[-1]
+        spread = np.zeros(values.shape[:-1] + (length + 2 * radius,))
+        for offset, weight in enumerate(self.kernel):
+            spread[..., offset:offset + length] += weight * values
+        if radius <= length:
+            folded = spread[..., radius:radius + length].copy()
+            folded[..., :radius] += spread[..., radius - 1::-1]
+            folded[..., length - radius:] += spread[..., :length + radius - 1:-1]
+        else:
+            positions = np.arange(-radius, length + radius) % (2 * length)
+            folded = np.zeros(values.shape)
+            np.add.at(np.moveaxis(folded, -1, 0), np.minimum(positions, 2 * length - 1 - positions),
+                      np.moveaxis(spread, -1, 0))
+        return np.moveaxis(folded, -1, axis)
+
+    def predict(self, posterior):
+        """
+        Predicts the probabilities of the next update from the current posterior.
+        :param posterior: float ndarray of the probabilities, over the last two axes (one grid, or one per target).
+        :return: float ndarray of the predicted probabilities.
+        """
+        if self.stay == 1 or self.radius == 0:
+            return posterior
+        moved = self.convolve(self.convolve(posterior, -1), -2)
+        return self.stay * posterior + (1 - self.stay) * moved
+
+    def log_predict(self, log_posterior):
+        """
+        Predicts the log probabilities of the next update from the current log posterior.
+        :param log_posterior: float ndarray of the log probabilities, over the last two axes.
+        :return: float ndarray of the predicted log probabilities.
+        """
+        if self.stay == 1 or self.radius == 0:
+            return log_posterior
+        peak = np.max(log_posterior, axis=(-2, -1), keepdims=True)
+        peak = np.where(np.isfinite(peak), peak, 0)
+        with np.errstate(divide='ignore'):
+            return np.log(self.predict(np.exp(log_posterior - peak))) + peak
@@ -0,0 +1,149 @@
+import json
+import os
+import time
+
+
+class ReadRecorder:
+    """Read Recorder object
+
+    Appends every read burst to a line-delimited JSON file, one line per facing:
+    {"t": timestamp, "cycle": cycle number, "sweep": sweep number, "angles": [servo angles],
+     "reads": [[epc, read_count, rssi, reading], ...]}
+    where reading is the index of the reading of the burst the tag was read in. A facing without any read still gets
+    its line, since not reading a tag is an observation too. The facings of a sweep are mixed into one likelihood
+    factor, the sweeps of a cycle (e.g. one per reader station) are independent factors applied after one predict step.
+    Every cycle starts with a {"t": timestamp, "cycle": cycle number} line, so a cycle without any facing (e.g. in
+    adaptive mode once the stop rule is met) still predicts on replay.
+
+    Attributes:
+        path: String of the path of the log file.
+        cycle: int of the current cycle number.
+        sweep: int of the current sweep number.
+        log: the open log file.
+    """
+
+    def __init__(self, path):
+        """
+        Opens the log file for appending.
+        :param path: String of the path of the log file.
+        """
+        self.path = path
+        self.cycle = 0
+        self.sweep = 0
+        self.log = open(path, 'a')
+
+    def new_cycle(self):
+        """
+        Starts a new cycle, the sweeps of a cycle follow a single predict step of the motion model on replay.
+        :return: None
+        """
+        self.cycle = self.cycle + 1
+        self.log.write(json.dumps({'t': time.time(), 'cycle': self.cycle}) + '\n')
+        self.log.flush()
+
+    def new_sweep(self):
+        """
+        Starts a new sweep, the facings of a sweep are folded into the posterior together on replay.
+        :return: None
+        """
+        self.sweep = self.sweep + 1
+
+    def record(self, angles, tag_reads, t=None):
+        """
+        Appends the reads of one facing.
+        :param angles: tuple of the servo angles of the facing.
+        :param tag_reads: list of tuples of the tag ID, read count, RSSI and reading index of every read.
+        :param t: float timestamp of the reads, now when None (e.g. for reads written after the fact).
+        :return: None
+        """
+        event = {
+            't': time.time() if t is None else t,
+            'cycle': self.cycle,
+            'sweep': self.sweep,
+            'angles': list(angles),
+            'reads': [[epc, int(read_count), float(rssi), int(reading)]
+                      for epc, read_count, rssi, reading in tag_reads],
+        }
+        self.log.write(json.dumps(event) + '\n')
+        self.log.flush()
+
+    def close(self):
+        self.log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_session(path, max_reads=None):
+    """
+    Loads a log written by ReadRecorder.
+    :param path: String of the path of the log file.
+    :param max_reads: int to keep only the reads of the first max_reads readings of every burst, all reads when None.
+    :return: list of sweeps, each a list of tuples of the facing angles and the list of tag IDs read.
+    """
+    sweeps = []
+    current_sweep = None
+    with open(path) as log:
+        for line in log:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if 'angles' not in event:
+                continue
+            if event['sweep'] != current_sweep:
+                current_sweep = event['sweep']
+                sweeps.append([])
+            reading = [read[0] for read in event['reads'] if max_reads is None or read[3] < max_reads]
+            sweeps[-1].append((tuple(event['angles']), reading))
+    return sweeps
+
+
+def load_cycles(path, max_reads=None):
+    """
+    Loads a log written by ReadRecorder, keeping the sweeps of every cycle together, including cycles without any
+    facing. A log written before cycles were recorded has one sweep per cycle.
+    :param path: String of the path of the log file.
+    :param max_reads: int to keep only the reads of the first max_reads readings of every burst, all reads when None.
+    :return: list of cycles, each a list of sweeps, each a list of tuples of the facing angles and the list of tag IDs
+        read.
+    """
+    cycles = []
+    current_cycle = None
+    current_sweep = None
+    with open(path) as log:
+        for line in log:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if 'angles' not in event:
+                current_cycle = event['cycle']
+                current_sweep = None
+                cycles.append([])
+                continue
+            cycle = event.get('cycle', event['sweep'])
+            if cycle != current_cycle:
+                current_cycle = cycle
+                current_sweep = None
+                cycles.append([])
+            if event['sweep'] != current_sweep:
+                current_sweep = event['sweep']
+                cycles[-1].append([])
+            reading = [read[0] for read in event['reads'] if max_reads is None or read[3] < max_reads]
+            cycles[-1][-1].append((tuple(event['angles']), reading))
+    return cycles
+
+
+def load_manifest(path):
+    """
+    Loads the labelled sessions of a manifest, e.g. to evaluate (batch_eval.py) or calibrate (calibration.py) on.
+    :param path: JSON file of a list of {"session": log file, "target_cell": [row, col]}, relative paths are taken
+        from the manifest's directory.
+    :return: list of tuples of the session path and the target cell.
+    """
+    with open(path) as manifest:
+        entries = json.load(manifest)
+    base = os.path.dirname(os.path.abspath(path))
+    return [(os.path.join(base, entry['session']), tuple(entry['target_cell'])) for entry in entries]
@@ -1,32 +1,151 @@
-import plotly
-import plotly.graph_objs as go
+import argparse
+import logging
+import queue
+import threading
+import time
 
-from algo import Algorithm
+from algo import MultiTargetAlgorithm
+from algo import SparseAlgorithm
+from algo import LOG_SPACE_CELLS
+from algo import VectorizedAlgorithm
+from algo import pick_log_space
 from communication import ArduinoHandler
 from communication import MercuryHandler
 from data_obj import Config
 from data_obj import Grid
+from data_obj import MISSING
+from data_obj import Tag
+from history import PosteriorHistory
+from metrics import Metrics
+from metrics import configure_tracing
+from motion import MotionModel
+from recorder import ReadRecorder
+from recorder import load_cycles
+from scheduler import InformationGainScheduler
+from scheduler import entropy
+from simulation import SimulatedArduinoHandler
+from simulation import SimulatedMercuryHandler
+from station import build_stations
+from station import read_facing
+from stream import HeatmapStream
 
 
-def run():
+logger = logging.getLogger(__name__)
+
+
+def run(pipelined=True, adaptive=False, loops=None, simulated_target=None, multi_target=False, history_path=None,
+		record_path=None, sparse_floor=None, stream=None, plot=True, metrics=None, motion=None, log_space=None,
+		burst=None):
 	"""
 	Runs the core program
+	:param pipelined: overlap the servo moves and reads with the posterior update (see take_readings_pipelined)
+	:param adaptive: pick each facing by expected information gain instead of sweeping the search profile, always
+		with one posterior per target tag id, since the scheduler scores the facings by the target detections
+	:param loops: the number of times to run the algorithm, asked for when None
+	:param simulated_target: (row, col) of a simulated target, runs on the simulated hardware instead of the real one
+	:param multi_target: keep one posterior per target tag id instead of a single one for every target
+	:param history_path: .npz file to save the posterior and readings of every cycle to, not saved when None
+	:param record_path: line-delimited JSON file every raw read is appended to (see replay), not recorded when None
+	:param sparse_floor: keep an active set posterior per target tag id (see SparseAlgorithm), pruning grid spaces
+		below this probability, dense when None
+	:param stream: HeatmapStream the posterior is published to after every update (every facing or station sweep
+		folded in), or None
+	:param plot: write the plotly heatmap html file(s) at the end
+	:param metrics: Metrics object collecting the stage timings, read counters and posterior entropy of every
+		cycle, or None
+	:param motion: MotionModel tracking moving targets, the motion section of the config when None
+	:param log_space: run the algorithm in log space, picked by the size of the grid when None (see pick_log_space)
+	:param burst: dictionary of reader burst settings overriding the burst section of the config, e.g. patience
+		(see MercuryHandler). The simulated readers only take the stop rules, not read_timeout / read_delay.
 	:return: None
+	With several reader stations in the config every station sweeps its own facings concurrently instead
+	(see take_readings_stations), and pipelined / adaptive do not apply.
 	"""
 	config = Config('config.yaml')
-	arduino = ArduinoHandler(config.arduino)
-	mercury = MercuryHandler(config.mercury, base_read_power=2900)
+	burst_options = dict(config.burst)
+	if burst is not None:
+		burst_options.update(burst)
+	stop_rules = {name: value for name, value in burst_options.items() if name not in ('read_timeout', 'read_delay')}
+	stations = None
+	if len(config.stations) > 1:
+		if simulated_target is None:
+			stations = build_stations(config, base_read_power=2900, **burst_options)
+		else:
+			stations = build_stations(config, simulated_target, **stop_rules)
+	elif simulated_target is None:
+		arduino = ArduinoHandler(config.arduino)
+		mercury = MercuryHandler(config.mercury, base_read_power=2900, **burst_options)
+	else:
+		arduino = SimulatedArduinoHandler()
+		mercury = SimulatedMercuryHandler(config, simulated_target, arduino, **stop_rules)
 	grid = Grid(config.tag_ids, config.grid_size)
-	algorithm = Algorithm(grid, config)
-	print("how many times would you like to run the algorithm? : ")
-	loops = int(input())
-	for x in range(loops):
-		readings = []
-		for facing in config.search_profile:
-			readings.append(take_reading(arduino, mercury, facing, grid, config))
-		algorithm.main(readings)
-	normalized_probability_grid = normalize_probabilities(algorithm.probabilities)
-	plot_data(normalized_probability_grid)
+	if motion is None:
+		motion = MotionModel.from_config(config.motion)
+	if adaptive and stations is None:
+		multi_target = True
+	if sparse_floor is not None:
+		if motion is not None:
+			logger.warning('the sparse posterior has no motion model, targets are assumed static')
+		algorithm = SparseAlgorithm(grid, config, floor=sparse_floor, metrics=metrics)
+		multi_target = True
+	elif multi_target:
+		algorithm = MultiTargetAlgorithm(grid, config, log_space=pick_log_space(grid, log_space), metrics=metrics,
+										 motion=motion)
+	else:
+		algorithm = VectorizedAlgorithm(grid, config, log_space=pick_log_space(grid, log_space), metrics=metrics,
+										motion=motion)
+	if loops is None:
+		print("how many times would you like to run the algorithm? : ")
+		loops = int(input())
+	scheduler = InformationGainScheduler(config)
+	history = PosteriorHistory(grid, capacity=loops + 1, initial=algorithm.prior)
+	recorder = None
+	if record_path is not None:
+		recorder = ReadRecorder(record_path)
+	try:
+		for x in range(loops):
+			if recorder is not None:
+				recorder.new_cycle()
+			if stations is not None:
+				sweeps = take_readings_stations(stations, grid, config, algorithm, recorder=recorder, metrics=metrics,
+												stream=stream)
+			elif adaptive:
+				sweeps = take_readings_adaptive(arduino, mercury, grid, config, algorithm, scheduler,
+												recorder=recorder, metrics=metrics, stream=stream)
+				logger.info('fix %s after %d facings', algorithm.argmax(), len(sweeps))
+			elif pipelined:
+				sweeps = take_readings_pipelined(arduino, mercury, grid, config, algorithm, recorder=recorder,
+												 metrics=metrics, stream=stream)
+			else:
+				if recorder is not None:
+					recorder.new_sweep()
+				readings = []
+				for facing in config.search_profile:
+					readings.append(take_reading(arduino, mercury, facing, grid, config, algorithm.split_targets,
+												 recorder, metrics))
+				algorithm.main(readings)
+				if stream is not None:
+					stream.publish(algorithm.estimate())
+				sweeps = [list(enumerate(readings))]
+			history.append(algorithm.prior, sweeps=sweeps)
+			if metrics is not None:
+				record_cycle(metrics, algorithm)
+	finally:
+		if recorder is not None:
+			recorder.close()
+		if stream is not None:
+			stream.flush()
+	if history_path is not None:
+		history.save(history_path)
+	if multi_target:
+		for target, target_grid, location in zip(algorithm.targets, algorithm.estimate(), algorithm.argmax().values()):
+			print(f'target {target} : {location}')
+			if plot:
+				plot_data(target_grid.tolist(), filename=f'heatMap_{target}.html')
+		return
+	if plot:
+		normalized_probability_grid = normalize_probabilities(algorithm.probabilities)
+		plot_data(normalized_probability_grid)
 
 
 def normalize_probabilities(probabilities):
@@ -49,7 +168,210 @@ def normalize_probabilities(probabilities):
 	return normalized
 
 
-def take_reading(arduino, mercury, angle, grid, config):
+def replay(session_path, multi_target=False, log_space=None, config_path='config.yaml', sparse_floor=None,
+		   metrics=None, motion=None):
+	"""
+	Feeds a session recorded with ReadRecorder through the algorithm at full CPU speed, without any hardware.
+	Every recorded cycle predicts once and then applies each of its sweeps as its own likelihood factor (see
+	observe_sweep), as during the recorded run: one sweep per cycle, one per reader station, or one per facing in
+	adaptive mode.
+	:param session_path: the line-delimited JSON file written by ReadRecorder
+	:param multi_target: keep one posterior per target tag id instead of a single one for every target
+	:param log_space: run the algorithm in log space, picked by the size of the grid when None (see pick_log_space)
+	:param config_path: the config file the session was recorded with (p1/p2 can be changed in it)
+	:param sparse_floor: replay with an active set posterior pruning grid spaces below this probability, dense when None
+	:param metrics: Metrics object collecting the parse / update timings and posterior entropy of every sweep, or None
+	:param motion: MotionModel tracking moving targets, the motion section of the config when None
+	:return: the algorithm holding the final posterior
+	"""
+	config = Config(config_path)
+	grid = Grid(config.tag_ids, config.grid_size)
+	if motion is None:
+		motion = MotionModel.from_config(config.motion)
+	if sparse_floor is not None:
+		algorithm = SparseAlgorithm(grid, config, floor=sparse_floor, metrics=metrics)
+	elif multi_target:
+		algorithm = MultiTargetAlgorithm(grid, config, log_space=pick_log_space(grid, log_space), metrics=metrics,
+										 motion=motion)
+	else:
+		algorithm = VectorizedAlgorithm(grid, config, log_space=pick_log_space(grid, log_space), metrics=metrics,
+										motion=motion)
+	facing_indexes = {tuple(facing): index for index, facing in enumerate(config.search_profile)}
+	for cycle in load_cycles(session_path):
+		algorithm.predict()
+		for sweep in cycle:
+			facings = [facing_indexes[angles] for angles, reading in sweep]
+			readings = [parse_reading(reading, grid, config, algorithm.split_targets, metrics)
+						for angles, reading in sweep]
+			algorithm.observe_sweep(readings, facings)
+		if metrics is not None:
+			record_cycle(metrics, algorithm)
+	return algorithm
+
+
+def record_cycle(metrics, algorithm):
+	"""
+	Sets the posterior entropy gauge (per target tag id with several posteriors) and ends the cycle of the metrics.
+	:param metrics: Metrics object
+	:param algorithm: VectorizedAlgorithm holding the posterior
+	:return: None
+	"""
+	estimate = algorithm.estimate()
+	if estimate.ndim == 3:
+		for target, target_grid in zip(algorithm.targets, estimate):
+			metrics.gauge('posterior_entropy_bits', entropy(target_grid), target=target)
+	else:
+		metrics.gauge('posterior_entropy_bits', entropy(estimate))
+	stages = metrics.end_cycle()
+	if logger.isEnabledFor(logging.INFO):
+		logger.info('cycle %d : %s', metrics.cycle,
+					', '.join(f'{stage} {seconds * 1000:.1f} ms' for stage, seconds in stages.items()))
+
+
+def take_readings_pipelined(arduino, mercury, grid, config, algorithm, queue_size=2, recorder=None, metrics=None,
+							stream=None):
+	"""
+	Takes the readings of one sweep of the search profile while a worker thread parses each facing's reading and
+	folds it into the algorithm, so the update of facing N runs while the servo moves to facing N+1. The motion model
+	predicts once, before the sweep.
+	Gives the same grid as taking every reading first and then calling algorithm.main.
+	:param arduino: arduino handling object
+	:param mercury: mercury RFID reader handling object
+	:param grid: known grid setup for understanding which tag spaces were read
+	:param config: used to access the search profile and the target tag ids
+	:param algorithm: VectorizedAlgorithm to fold the readings into
+	:param queue_size: maximum number of raw readings waiting to be folded in before acquisition blocks
+	:param recorder: ReadRecorder to log the raw reads to, or None
+	:param metrics: Metrics object timing the stages and counting the reads, or None
+	:param stream: HeatmapStream the estimate is published to after every facing folded in, or None
+	:return: list of the single sweep of (facing index, parsed reading) pairs
+	"""
+	raw_readings = queue.Queue(maxsize=queue_size)
+	errors = []
+	sweep = []
+
+	def fold_readings():
+		while True:
+			item = raw_readings.get()
+			if item is None:
+				return
+			facing_index, reading = item
+			try:
+				reading = parse_reading(reading, grid, config, algorithm.split_targets, metrics)
+				algorithm.observe(facing_index, reading)
+				sweep.append((facing_index, reading))
+				if stream is not None:
+					stream.publish(algorithm.estimate())
+			except Exception as error:
+				errors.append(error)
+
+	algorithm.predict()
+	worker = threading.Thread(target=fold_readings, daemon=True)
+	worker.start()
+	if recorder is not None:
+		recorder.new_sweep()
+	try:
+		for facing_index, facing in enumerate(config.search_profile):
+			reading, reads_used = read_facing(arduino, mercury, facing, config.target, metrics)
+			if recorder is not None:
+				recorder.record(facing, mercury.last_tag_reads)
+			raw_readings.put((facing_index, reading))
+	finally:
+		raw_readings.put(None)
+		worker.join()
+	if errors:
+		raise errors[0]
+	algorithm.commit()
+	return [sweep]
+
+
+def take_readings_stations(stations, grid, config, algorithm, recorder=None, metrics=None, stream=None):
+	"""
+	Sweeps every reader station at the same time, one thread per station. As soon as a station's sweep is done it is
+	parsed and folded into the shared posterior as its own likelihood factor (see observe_sweep), so the sweep time
+	is that of the slowest station rather than the sum over stations. The motion model predicts once per cycle, before
+	the sweeps.
+	:param stations: list of Station objects
+	:param grid: known grid setup for understanding which tag spaces were read
+	:param config: used to access the target tag ids
+	:param algorithm: VectorizedAlgorithm to fold the readings into
+	:param recorder: ReadRecorder to log the raw reads to (one sweep per station), or None
+	:param metrics: Metrics object timing the stages and counting the reads, or None
+	:param stream: HeatmapStream the estimate is published to after every station sweep folded in, or None
+	:return: list of the sweeps of (facing index, parsed reading) pairs, one per station
+	"""
+	sweeps = [[] for station in stations]
+	errors = []
+	algorithm.predict()
+
+	def sweep(number, station):
+		try:
+			raw_readings = station.take_sweep(config.target, metrics)
+			station_readings = [parse_reading(reading, grid, config, algorithm.split_targets, metrics)
+								for reading in raw_readings]
+			algorithm.observe_sweep(station_readings, station.facings)
+			sweeps[number] = list(zip(station.facings, station_readings))
+			if stream is not None:
+				stream.publish(algorithm.estimate())
+		except Exception as error:
+			errors.append(error)
+
+	workers = [threading.Thread(target=sweep, args=(number, station), daemon=True)
+			   for number, station in enumerate(stations)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	if recorder is not None:
+		for station in stations:
+			recorder.new_sweep()
+			for t, angles, tag_reads in station.tag_reads:
+				recorder.record(angles, tag_reads, t)
+	if errors:
+		raise errors[0]
+	return sweeps
+
+
+def take_readings_adaptive(arduino, mercury, grid, config, algorithm, scheduler, max_facings=None, recorder=None,
+						   metrics=None, stream=None):
+	"""
+	Takes readings one facing at a time, each at the facing the scheduler expects to reduce the posterior's entropy
+	the most, until the scheduler's stop rule is met. The motion model predicts once, before the first facing, so the
+	stop rule is tested on the predicted posterior.
+	:param arduino: arduino handling object
+	:param mercury: mercury RFID reader handling object
+	:param grid: known grid setup for understanding which tag spaces were read
+	:param config: used to access the search profile and the target tag ids
+	:param algorithm: MultiTargetAlgorithm to fold the readings into, whose likelihood is the target detection model
+		the scheduler scores the facings with
+	:param scheduler: InformationGainScheduler picking the facings
+	:param max_facings: maximum number of facings to read, the length of the search profile when None
+	:param recorder: ReadRecorder to log the raw reads to (one sweep per facing), or None
+	:param metrics: Metrics object timing the stages and counting the reads, or None
+	:param stream: HeatmapStream the estimate is published to after every facing folded in, or None
+	:return: list of the sweeps of (facing index, parsed reading) pairs, one per facing read
+	"""
+	if max_facings is None:
+		max_facings = len(config.search_profile)
+	algorithm.predict()
+	sweeps = []
+	while len(sweeps) < max_facings:
+		facing_index = scheduler.next_facing(algorithm.estimate())
+		if facing_index is None:
+			break
+		angle = config.search_profile[facing_index]
+		if recorder is not None:
+			recorder.new_sweep()
+		reading = take_reading(arduino, mercury, angle, grid, config, algorithm.split_targets, recorder, metrics)
+		algorithm.observe(facing_index, reading)
+		algorithm.commit()
+		sweeps.append([(facing_index, reading)])
+		if stream is not None:
+			stream.publish(algorithm.estimate())
+	return sweeps
+
+
+def take_reading(arduino, mercury, angle, grid, config, split_targets=False, recorder=None, metrics=None):
 	"""
 	Handles communication with the sensors and servos to take a reading
 	:param arduino: arduino handling object
@@ -57,43 +379,130 @@ def take_reading(arduino, mercury, angle, grid, config):
 	:param angle: angle to pass to the arduino for movement
 	:param grid: known grid setup for understanding which tag spaces were read
 	:param config: used only to access the target tag ids
+	:param split_targets: passed on to parse_reading
+	:param recorder: ReadRecorder to log the raw reads to, or None
+	:param metrics: Metrics object timing the stages and counting the reads, or None
 	:return: returns a call to parse_reading which returns the tag objects read
 	"""
-	print('before sending')
-	arduino.send_angles(angle)
-	print('after sending')
-	reading = []
-	for i in range(6):
-		reading.extend(mercury.make_read())
-	return parse_reading(reading, grid, config)
+	reading, reads_used = read_facing(arduino, mercury, angle, config.target, metrics)
+	logger.debug('%d reads at %s', reads_used, angle)
+	if recorder is not None:
+		recorder.record(angle, mercury.last_tag_reads)
+	return parse_reading(reading, grid, config, split_targets, metrics)
 
 
-def parse_reading(reading, grid, config):
+def parse_reading(reading, grid, config, split_targets=False, metrics=None):
 	"""
 	Parses the raw reading taken by the mercury RFID reader.
 	:param reading: the raw reading taken (the tag ids that were read)
 	:param grid: the known grid setup which allows to match ids to gridspaces
 	:param config: used to access the target tag id
+	:param split_targets: keep every target tag id read instead of collapsing them into a single 'target'
+	:param metrics: Metrics object timing the parse and counting the EPCs that are neither grid tags nor targets, or None
 	:return: a list of the tag objects read
 	"""
+	start = time.perf_counter()
+	unknown = 0
 	tags_read = []
+	seen = set()
 	for tag in reading:
-		if tag in config.target and 'target' not in tags_read:
+		if split_targets and tag in config.target:
+			if tag not in seen:
+				seen.add(tag)
+				tags_read.append(tag)
+			continue
+		if tag in config.target and 'target' not in seen:
+			seen.add('target')
 			tags_read.append('target')
-		elif grid[tag] not in tags_read:
-			tags_read.append(grid[tag])
+			continue
+		grid_tag = grid[tag]
+		if grid_tag is MISSING and tag not in config.target:
+			unknown = unknown + 1
+		key = grid_tag.id if isinstance(grid_tag, Tag) else grid_tag
+		if key not in seen:
+			seen.add(key)
+			tags_read.append(grid_tag)
+	if metrics is not None:
+		metrics.record('parse', time.perf_counter() - start)
+		metrics.count('unknown_epcs_total', unknown)
 	return tags_read
 
 
-def plot_data(data):
+def plot_data(data, filename='heatMap.html'):
 	"""
 	plots data into an html heatmap using the free service plotly
+	plotly is only imported here, so headless runs never load it.
 	:param data: the 2d array of probability values to read
+	:param filename: the html file to write
 	:return: None
 	"""
+	import plotly
+	import plotly.graph_objs as go
 	graph = [go.Heatmap(z=data)]
-	plotly.offline.plot(graph, filename='heatMap.html')
+	plotly.offline.plot(graph, filename=filename)
 
 	
 if __name__ == '__main__':
-	run()
+	parser = argparse.ArgumentParser(description='Localizes the target tags on the tag grid.')
+	parser.add_argument('--replay', metavar='SESSION', help='replay a recorded session instead of running the hardware')
+	parser.add_argument('--record', metavar='SESSION', help='append every raw read to this line-delimited JSON file')
+	parser.add_argument('--history', metavar='NPZ', help='save the posterior of every cycle to this file')
+	parser.add_argument('--loops', type=int, help='the number of times to run the algorithm, asked for when missing')
+	parser.add_argument('--simulate', type=int, nargs=2, metavar=('ROW', 'COL'), help='run on simulated hardware')
+	parser.add_argument('--multi-target', action='store_true', help='keep one posterior per target tag id')
+	parser.add_argument('--adaptive', action='store_true', help='pick the facings by expected information gain')
+	parser.add_argument('--sequential', action='store_true', help='do not overlap the reads with the update')
+	parser.add_argument('--log-space', dest='log_space', action='store_true', default=None,
+						help=f'update in log space, the default on grids of more than {LOG_SPACE_CELLS} grid spaces')
+	parser.add_argument('--linear-space', dest='log_space', action='store_false',
+						help='update in linear space, the default on smaller grids')
+	parser.add_argument('--sparse', type=float, metavar='FLOOR',
+						help='active set posterior per target tag id, pruning grid spaces below FLOOR')
+	parser.add_argument('--stream-port', type=int, metavar='PORT',
+						help='serve the live heatmap on http://127.0.0.1:PORT/')
+	parser.add_argument('--stream-file', metavar='FRAMES', help='append the live heatmap frames to this file')
+	parser.add_argument('--stream-fps', type=float, default=5.0, help='maximum live heatmap frames per second')
+	parser.add_argument('--no-plot', action='store_true', help='do not write the plotly heatmap at the end')
+	parser.add_argument('--max-reads', type=int, help='maximum readings per facing, 6 unless set in the config')
+	parser.add_argument('--patience', type=int,
+						help='end a burst after this many readings in a row without new tag ids')
+	parser.add_argument('--min-target-reads', type=int, help='end a burst once the target was read this many times')
+	parser.add_argument('--min-target-rssi', type=int, metavar='DBM',
+						help='end a burst once the target was read at this RSSI')
+	parser.add_argument('--read-timeout', type=int, metavar='MS', help='duration of a single reading')
+	parser.add_argument('--read-delay', type=float, metavar='SEC', help='delay after every reading')
+	parser.add_argument('--stay', type=float, metavar='P',
+						help='track moving targets, staying in their grid space with probability P between updates')
+	parser.add_argument('--trace', choices=['info', 'debug', 'trace'],
+						help='log cycle timings (info), read tags (debug) or every grid space of the update (trace)')
+	parser.add_argument('--metrics', metavar='FILE', help='write the stage timings, counters and entropy to this file')
+	parser.add_argument('--metrics-format', choices=['jsonl', 'prometheus'], default='jsonl',
+						help='append one JSON line per cycle, or rewrite a Prometheus text file every cycle')
+	args = parser.parse_args()
+	if args.trace is not None:
+		configure_tracing(args.trace)
+	run_metrics = None
+	if args.metrics is not None or args.trace is not None:
+		run_metrics = Metrics(args.metrics, args.metrics_format)
+	run_burst = {name: getattr(args, name) for name in Config.burst_options if getattr(args, name) is not None}
+	run_motion = None
+	if args.stay is not None:
+		run_motion = MotionModel(stay=args.stay)
+	if args.replay is not None:
+		replayed = replay(args.replay, multi_target=args.multi_target, log_space=args.log_space,
+						  sparse_floor=args.sparse, metrics=run_metrics, motion=run_motion)
+		print(f'estimate : {replayed.argmax()}')
+	else:
+		live_stream = None
+		if args.stream_port is not None or args.stream_file is not None:
+			live_stream = HeatmapStream(max_fps=args.stream_fps, path=args.stream_file, port=args.stream_port)
+			if live_stream.address() is not None:
+				print(f'live heatmap on {live_stream.address()}')
+		try:
+			run(pipelined=not args.sequential, adaptive=args.adaptive, loops=args.loops,
+				simulated_target=args.simulate, multi_target=args.multi_target, history_path=args.history,
+				record_path=args.record, sparse_floor=args.sparse, stream=live_stream, plot=not args.no_plot,
+				metrics=run_metrics, motion=run_motion, log_space=args.log_space, burst=run_burst)
+		finally:
+			if live_stream is not None:
+				live_stream.close()
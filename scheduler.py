@@ -0,0 +1,95 @@
+import numpy as np
+
+
+def entropy(probabilities):
+    """
+    Computes the Shannon entropy of a probability grid.
+    :param probabilities: ndarray of probabilities which sum to 1.
+    :return: float of the entropy (in bits).
+    """
+    probabilities = np.asarray(probabilities, dtype=float).ravel()
+    probabilities = probabilities[probabilities > 0]
+    return float(-np.sum(probabilities * np.log2(probabilities)))
+
+
+def binary_entropy(probability):
+    """
+    Computes the entropy of a binary event, elementwise.
+    :param probability: float or ndarray of the probability of the event.
+    :return: float or ndarray of the entropy (in bits).
+    """
+    probability = np.clip(probability, 1e-12, 1 - 1e-12)
+    return -(probability * np.log2(probability) + (1 - probability) * np.log2(1 - probability))
+
+
+class InformationGainScheduler:
+    """Information gain scheduler object
+
+    Picks the next facing of the search profile by the expected reduction of the posterior's entropy,
+    instead of running the whole search profile in order.
+
+    Each facing is scored with the vision profile and the sensor model of the algorithm: the target is detected with
+    probability p1 when it is in the facing's expected grid spaces and with probability p2 otherwise, or with the
+    per facing and grid space detection / false_detection tensors of the config when it has them. The expected
+    entropy reduction of the posterior is then the mutual information between the target's grid space and
+    that detection, which has a closed form in the posterior weighted read probabilities. This is the likelihood of
+    MultiTargetAlgorithm, so it should drive that algorithm (or SparseAlgorithm).
+
+    Attributes:
+        config: a config object that holds all relevant information from the config file.
+        vision_masks: boolean ndarray of the expected grid spaces for each facing.
+        read_probability: float ndarray of shape (facings, rows, cols) of the probability of detecting the target
+            in every grid space at every facing.
+        read_entropy: float ndarray of the binary entropy of that detection (in bits).
+        stop_probability: the posterior's max probability at which the search stops.
+    """
+
+    def __init__(self, config, stop_probability=0.9):
+        """
+        Initializes the scheduler.
+        :param config: a config object holding p1, p2, the vision masks and optionally the detection tensors.
+        :param stop_probability: float of the max probability at which the search stops.
+        """
+        self.config = config
+        self.vision_masks = config.vision_masks
+        detection = getattr(config, 'detection', None)
+        false_detection = getattr(config, 'false_detection', None)
+        self.read_probability = np.where(self.vision_masks, config.p1 if detection is None else detection,
+                                         config.p2 if false_detection is None else false_detection)
+        self.read_entropy = binary_entropy(self.read_probability)
+        self.stop_probability = stop_probability
+
+    def expected_information_gain(self, probabilities):
+        """
+        Computes the expected entropy reduction of every facing from the current grid.
+        For stacked (targets, rows, cols) grids the targets are detected independently, so their gains add up.
+        :param probabilities: 2d array of the current normalized probabilities, or 3d with one grid per target.
+        :return: ndarray of the expected information gain (in bits) of each facing.
+        """
+        probabilities = np.asarray(probabilities, dtype=float)
+        if probabilities.ndim == 2:
+            probabilities = probabilities[None]
+        detection = np.einsum('fxy,kxy->kf', self.read_probability, probabilities)
+        gain = binary_entropy(detection) - np.einsum('fxy,kxy->kf', self.read_entropy, probabilities)
+        return gain.sum(axis=0)
+
+    def should_stop(self, probabilities):
+        """
+        Checks the stop rule.
+        :param probabilities: 2d array of the current normalized probabilities, or 3d with one grid per target.
+        :return: boolean of whether the max probability (of every target) has passed the threshold.
+        """
+        probabilities = np.asarray(probabilities, dtype=float)
+        if probabilities.ndim == 2:
+            probabilities = probabilities[None]
+        return bool(np.all(probabilities.max(axis=(1, 2)) >= self.stop_probability))
+
+    def next_facing(self, probabilities):
+        """
+        Picks the facing with the highest expected information gain.
+        :param probabilities: 2d array of the current normalized probabilities, or 3d with one grid per target.
+        :return: int index of the facing in the search profile, or None when the search should stop.
+        """
+        if self.should_stop(probabilities):
+            return None
+        return int(np.argmax(self.expected_information_gain(probabilities)))
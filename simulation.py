@@ -0,0 +1,164 @@
+import collections
+import time
+
+import numpy as np
+
+from communication import MercuryHandler
+
+
+SimulatedTagRead = collections.namedtuple('SimulatedTagRead', ['epc', 'rssi', 'read_count'])
+
+
+class SimulatedArduinoHandler:
+    """Simulated Arduino Communication object
+
+    In-process stand-in for ArduinoHandler. Remembers the last angles sent so SimulatedMercuryHandler knows which
+    facing it is reading from, and counts the moves so every visit of a facing gets its own detections, even when
+    the same angles are sent twice in a row.
+
+    Attributes:
+        move_time: A float of the simulated time delay for a servo to move (in sec), 0 for no delay.
+        angles: The tuple of the last angles sent, or None.
+        moves: An integer of the number of moves made.
+    """
+
+    def __init__(self, move_time=0):
+        """
+        Initializes the simulated servos.
+        :param move_time: float of the simulated time delay for a servo to move (in sec)
+        """
+        self.move_time = move_time
+        self.angles = None
+        self.moves = 0
+
+    def send_angles(self, angles):
+        """
+        Simulates moving the servos to the given angles.
+        :param angles: tuple of angles to be sent.
+        """
+        if self.move_time:
+            time.sleep(self.move_time)
+        self.angles = tuple(angles)
+        self.moves = self.moves + 1
+
+
+class SimulatedMercuryHandler(MercuryHandler):
+    """Simulated Mercury RFID Reader Object
+
+    In-process stand-in for MercuryHandler which returns synthetic tag IDs from the p1/p2 detection model.
+    Whenever the servos move to a facing, every grid space (and every target id) is detected with probability p1
+    if it is in the facing's vision profile and p2 otherwise. Every reading at that facing then returns each
+    detected tag with probability read_rate, so a burst of readings recovers the facing's detections.
+
+    Attributes:
+        config: a config object holding the tag ids, target ids, profiles and p1/p2.
+        target_cells: dict of every target id to the tuple of its ground truth (row, col).
+        arduino: the SimulatedArduinoHandler whose angles give the current facing.
+        p1: the simulated detection probability.
+        p2: the simulated false detection probability.
+        read_rate: the probability a detected tag shows up in a single reading.
+        rng: the numpy random generator.
+        read_power: the last read power set.
+        facings: indexes of the facings of the search profile this reader's station owns.
+    """
+
+    def __init__(self, config, target_cell, arduino, p1=None, p2=None, read_rate=1.0, seed=None, read_timeout=0,
+                 read_delay=0, max_reads=6, patience=None, min_target_reads=None, min_target_rssi=None, facings=None):
+        """
+        Initializes the simulated reader.
+        :param config: a config object holding the tag ids, target ids, profiles and p1/p2.
+        :param target_cell: tuple of the ground truth (row, col) of every target id in the config,
+            or dict of target id to the tuple of its ground truth (row, col).
+        :param arduino: the SimulatedArduinoHandler whose angles give the current facing.
+        :param p1: float of the simulated detection probability, config.p1 when None.
+        :param p2: float of the simulated false detection probability, config.p2 when None.
+        :param read_rate: float of the probability a detected tag shows up in a single reading.
+        :param seed: seed of the random generator.
+        :param read_timeout: integer of the simulated duration of a single read (in millisec), 0 for no delay.
+        :param read_delay: float of the delay after every read (in sec), 0 for no delay.
+        :param facings: indexes of the facings of the search profile this reader's station owns, every facing when None.
+        The remaining parameters are the burst parameters of MercuryHandler.
+        """
+        self.config = config
+        if isinstance(target_cell, dict):
+            self.target_cells = {target: tuple(cell) for target, cell in target_cell.items()}
+        else:
+            self.target_cells = {target: tuple(target_cell) for target in config.target}
+        self.arduino = arduino
+        self.p1 = config.p1 if p1 is None else p1
+        self.p2 = config.p2 if p2 is None else p2
+        self.read_rate = read_rate
+        self.rng = np.random.default_rng(seed)
+        self.read_timeout = read_timeout
+        self.read_delay = read_delay
+        self.max_reads = max_reads
+        self.patience = patience
+        self.min_target_reads = min_target_reads
+        self.min_target_rssi = min_target_rssi
+        self.reads_used = 0
+        self.last_tag_reads = []
+        self.read_power = None
+        self.facings = range(len(config.search_profile)) if facings is None else facings
+        self.facing_move = None
+        self.detections = []
+
+    def set_read_power(self, read_power):
+        """
+        Sets the simulated read power (it does not change the detection model).
+        :param read_power: Integer of the new Read Power (in dB)
+        """
+        self.read_power = read_power
+
+    def check_connection(self):
+        return True
+
+    def facing_index(self, angles):
+        """
+        Looks up the facing of the search profile at the given angles, among the facings of this reader's station.
+        :param angles: tuple of the servo angles.
+        :return: int index of the facing, or None when the angles are not in the search profile.
+        """
+        for index in self.facings:
+            if tuple(self.config.search_profile[index]) == angles:
+                return index
+        return None
+
+    def detect(self):
+        """
+        Draws the detections of the current facing from the p1/p2 model.
+        :return: list of tuples of the detected tag ID and its RSSI.
+        """
+        rows, cols = self.config.grid_shape
+        facing = self.facing_index(self.arduino.angles)
+        if facing is None:
+            in_view = np.zeros((rows, cols), dtype=bool)
+        else:
+            in_view = self.config.vision_masks[facing]
+        detected = self.rng.random((rows, cols)) < np.where(in_view, self.p1, self.p2)
+        detections = []
+        for x, y in zip(*np.nonzero(detected)):
+            tag_ids = self.config.tag_ids[x][y]
+            detections.append((tag_ids[self.rng.integers(len(tag_ids))], -55 if in_view[x, y] else -70))
+        for target, cell in self.target_cells.items():
+            target_in_view = bool(in_view[cell])
+            if self.rng.random() < (self.p1 if target_in_view else self.p2):
+                detections.append((target, -55 if target_in_view else -70))
+        return detections
+
+    def read_tag_objects(self):
+        """
+        Simulates a reading at the current facing.
+        :return: List of SimulatedTagRead objects (epc, rssi and read_count)
+        """
+        if self.read_timeout:
+            time.sleep(self.read_timeout / 1000)
+        if self.read_delay:
+            time.sleep(self.read_delay)
+        if self.facing_move != self.arduino.moves:
+            self.facing_move = self.arduino.moves
+            self.detections = self.detect()
+        tag_reads = []
+        for epc, rssi in self.detections:
+            if self.rng.random() < self.read_rate:
+                tag_reads.append(SimulatedTagRead(epc.encode(), rssi + self.rng.normal(0, 3), 1))
+        return tag_reads
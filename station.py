@@ -0,0 +1,100 @@
+import time
+
+from communication import ArduinoHandler
+from communication import MercuryHandler
+from metrics import timed
+from simulation import SimulatedArduinoHandler
+from simulation import SimulatedMercuryHandler
+
+
+class Station:
+    """Reader Station object
+
+    One servo mount and one RFID reader, scanning its own facings of the combined search profile. Every station
+    talks to its own hardware, so the sweeps of several stations can run at the same time.
+
+    Attributes:
+        name: String of the name of the station.
+        arduino: the arduino handling object of the station.
+        mercury: the mercury RFID reader handling object of the station.
+        facings: list of the indexes of the station's facings in the combined search profile.
+        search_profile: list of the angles of those facings.
+        tag_reads: list of tuples of the timestamp, the angles and the tag reads of every facing of the last sweep,
+            the timestamp taken when the read burst ended.
+    """
+
+    def __init__(self, name, arduino, mercury, facings, search_profile):
+        """
+        Initializes the station.
+        :param name: String of the name of the station.
+        :param arduino: the arduino handling object of the station.
+        :param mercury: the mercury RFID reader handling object of the station.
+        :param facings: list of the indexes of the station's facings in the combined search profile.
+        :param search_profile: the combined search profile.
+        """
+        self.name = name
+        self.arduino = arduino
+        self.mercury = mercury
+        self.facings = list(facings)
+        self.search_profile = [search_profile[facing] for facing in self.facings]
+        self.tag_reads = []
+
+    def take_sweep(self, target=(), metrics=None):
+        """
+        Reads every facing of the station once.
+        :param target: tuple of the target tag IDs, passed on to the read bursts.
+        :param metrics: Metrics object timing the servo moves and read bursts, or None.
+        :return: list of the lists of tag IDs read at every facing.
+        """
+        raw_readings = []
+        self.tag_reads = []
+        for angles in self.search_profile:
+            reading, reads_used = read_facing(self.arduino, self.mercury, angles, target, metrics)
+            raw_readings.append(reading)
+            self.tag_reads.append((time.time(), angles, self.mercury.last_tag_reads))
+        return raw_readings
+
+
+def read_facing(arduino, mercury, angles, target=(), metrics=None):
+    """
+    Moves the servos to a facing and takes a read burst there.
+    :param arduino: arduino handling object.
+    :param mercury: mercury RFID reader handling object.
+    :param angles: tuple of the servo angles of the facing.
+    :param target: tuple of the target tag IDs, passed on to the read burst.
+    :param metrics: Metrics object timing the servo move and read burst and counting the reads per facing, or None.
+    :return: tuple of the list of tag IDs read and the number of reads used.
+    """
+    with timed(metrics, 'servo_move'):
+        arduino.send_angles(angles)
+    with timed(metrics, 'read_burst'):
+        reading, reads_used = mercury.make_read_burst(target)
+    if metrics is not None:
+        facing = ','.join(str(angle) for angle in angles)
+        metrics.count('reader_reads_total', reads_used, facing=facing)
+        metrics.count('tags_read_total', len(reading), facing=facing)
+    return reading, reads_used
+
+
+def build_stations(config, simulated_target=None, seed=None, move_time=0, **mercury_options):
+    """
+    Connects to the hardware of every station of the config.
+    :param config: the config object.
+    :param simulated_target: (row, col) of a simulated target, builds simulated hardware instead of the real one.
+    :param seed: seed of the simulated readers, each station gets its own stream.
+    :param move_time: float of the simulated servo move time (in sec).
+    :param mercury_options: keyword arguments of the (simulated) mercury handlers, e.g. patience.
+    :return: list of Station objects.
+    """
+    stations = []
+    for number, station in enumerate(config.stations):
+        if simulated_target is None:
+            arduino = ArduinoHandler(station['ips']['arduino'])
+            mercury = MercuryHandler(station['ips']['mercury'], **mercury_options)
+        else:
+            arduino = SimulatedArduinoHandler(move_time=move_time)
+            mercury = SimulatedMercuryHandler(config, simulated_target, arduino,
+                                              seed=None if seed is None else seed + number,
+                                              facings=station['facings'], **mercury_options)
+        stations.append(Station(station['name'], arduino, mercury, station['facings'], config.search_profile))
+    return stations
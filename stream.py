@@ -0,0 +1,297 @@
+import json
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+PAGE = b"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>heatmap</title></head>
+<body style="margin:0;background:#111;color:#ddd;font:14px monospace">
+<div id="info">waiting for the first frame</div><canvas id="map"></canvas>
+<script>
+var values = null, shape = null;
+var canvas = document.getElementById('map'), info = document.getElementById('info');
+function draw(frame) {
+    var panels = shape.length === 3 ? shape[0] : 1, rows = shape[shape.length - 2], cols = shape[shape.length - 1];
+    var size = Math.max(4, Math.floor(Math.min(window.innerWidth / (panels * (cols + 1)), (window.innerHeight - 30) / rows)));
+    canvas.width = panels * (cols + 1) * size;
+    canvas.height = rows * size;
+    var context = canvas.getContext('2d');
+    for (var p = 0; p < panels; p++) {
+        var peak = 0;
+        for (var i = 0; i < rows * cols; i++) peak = Math.max(peak, values[p * rows * cols + i]);
+        for (var i = 0; i < rows * cols; i++) {
+            var level = peak > 0 ? values[p * rows * cols + i] / peak : 0;
+            context.fillStyle = 'hsl(' + Math.round(240 - 240 * level) + ',80%,' + Math.round(15 + 45 * level) + '%)';
+            context.fillRect((p * (cols + 1) + i % cols) * size, Math.floor(i / cols) * size, size, size);
+        }
+    }
+    info.textContent = 'frame ' + frame.frame;
+}
+new EventSource('/events').onmessage = function (event) {
+    var frame = JSON.parse(event.data);
+    if (frame.key) {
+        shape = frame.shape;
+        values = Float64Array.from(frame.values);
+    } else if (values !== null) {
+        for (var i = 0; i < frame.cells.length; i++) values[frame.cells[i][0]] = frame.cells[i][1];
+    }
+    if (values !== null) draw(frame);
+};
+</script></body></html>
+"""
+
+
+class HeatmapStream:
+    """Heatmap Stream object
+
+    Pushes the normalized posterior after each update to live viewers, as compact JSON frames. A key frame holds
+    every value, a delta frame only the [flat index, value] of the grid spaces that changed by more than threshold
+    since the last frame sent. Frames are rate limited to max_fps: an update arriving too early is held back and sent
+    by a timer once 1 / max_fps has passed since the last frame, replaced by any later update in the meantime, so
+    viewers always end up on the latest posterior.
+
+    Frames are appended to a line-delimited JSON file that can be tailed, and/or served as Server-Sent Events by a
+    local HTTP server, which also serves a small page drawing the heatmap at /. Every new HTTP viewer starts with a
+    key frame.
+
+    Attributes:
+        max_fps: float of the maximum number of frames sent per second.
+        threshold: float of the smallest change of a grid space sent in a delta frame.
+        keyframe_interval: int of the number of frames between two key frames.
+        sent: flat float ndarray of the values the viewers hold, None before the first frame.
+        shape: tuple of the shape of the posterior.
+        frame: int of the number of frames sent.
+        pending: ndarray of the latest posterior held back by the rate limit, or None.
+        timer: threading.Timer sending the held back posterior, or None.
+        log: the open frame file, or None.
+        server: the HTTP server, or None.
+        subscribers: list of the queues of the connected HTTP viewers.
+    """
+
+    def __init__(self, max_fps=5.0, path=None, port=None, host='127.0.0.1', threshold=1e-4, keyframe_interval=100):
+        """
+        Opens the frame file and starts the HTTP server.
+        :param max_fps: float of the maximum number of frames sent per second, no limit when None or 0.
+        :param path: String of the path of the frame file, no file when None.
+        :param port: int of the port of the HTTP server, no server when None (0 picks a free port).
+        :param host: String of the address the HTTP server listens on.
+        :param threshold: float of the smallest change of a grid space sent in a delta frame.
+        :param keyframe_interval: int of the number of frames between two key frames.
+        """
+        self.max_fps = max_fps
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.sent = None
+        self.shape = None
+        self.frame = 0
+        self.last_sent = 0.0
+        self.pending = None
+        self.timer = None
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.log = None
+        if path is not None:
+            self.log = open(path, 'a')
+        self.server = None
+        if port is not None:
+            import http.server
+            self.server = http.server.ThreadingHTTPServer((host, port), self.handler())
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def address(self):
+        """
+        Gives the URL of the page drawing the heatmap.
+        :return: String of the URL, or None without a server.
+        """
+        if self.server is None:
+            return None
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def publish(self, posterior, force=False):
+        """
+        Sends the posterior to the viewers, unless the rate limit holds it back.
+        :param posterior: ndarray of the normalized posterior (2d, or stacked per target).
+        :param force: send it even if the last frame was sent less than 1 / max_fps ago.
+        :return: whether a frame was sent.
+        """
+        values = np.array(posterior, dtype=float)
+        with self.lock:
+            now = time.monotonic()
+            wait = 1 / self.max_fps - (now - self.last_sent) if self.max_fps else 0
+            if not force and wait > 0:
+                self.pending = values
+                if self.timer is None:
+                    self.timer = threading.Timer(wait, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return False
+            self.send_values(values, now)
+            return True
+
+    def flush(self):
+        """
+        Sends the update held back by the rate limit, if any.
+        :return: None
+        """
+        with self.lock:
+            if self.pending is not None:
+                self.send_values(self.pending, time.monotonic())
+
+    def send_values(self, values, now):
+        self.pending = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.last_sent = now
+        self.send(self.encode(values))
+
+    def encode(self, values):
+        """
+        Encodes the next frame, a key frame for the first frame, a new shape or every keyframe_interval frames.
+        :param values: ndarray of the posterior.
+        :return: dictionary of the frame.
+        """
+        flat = values.ravel()
+        self.frame = self.frame + 1
+        frame = {'frame': self.frame, 't': round(time.time(), 3)}
+        if self.sent is None or values.shape != self.shape or self.frame % self.keyframe_interval == 1:
+            self.shape = values.shape
+            self.sent = flat.copy()
+            frame.update(self.key_frame())
+            return frame
+        changed = np.flatnonzero(np.abs(flat - self.sent) > self.threshold)
+        self.sent[changed] = flat[changed]
+        frame['key'] = False
+        frame['cells'] = [[int(cell), round(float(value), 6)] for cell, value in zip(changed, flat[changed])]
+        return frame
+
+    def key_frame(self):
+        return {'key': True, 'shape': list(self.shape), 'values': [round(float(value), 6) for value in self.sent]}
+
+    def send(self, frame):
+        line = json.dumps(frame, separators=(',', ':'))
+        if self.log is not None:
+            self.log.write(line + '\n')
+            self.log.flush()
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.put_nowait(line)
+            except queue.Full:
+                self.subscribers.remove(subscriber)
+
+    def subscribe(self):
+        """
+        Registers an HTTP viewer, queueing a key frame of the values sent so far.
+        :return: the queue of the frames of the viewer.
+        """
+        subscriber = queue.Queue(maxsize=256)
+        with self.lock:
+            if self.sent is not None:
+                frame = {'frame': self.frame, 't': round(time.time(), 3)}
+                frame.update(self.key_frame())
+                subscriber.put_nowait(json.dumps(frame, separators=(',', ':')))
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def handler(self):
+        import http.server
+        stream = self
+
+        class HeatmapRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/':
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/html; charset=utf-8')
+                    self.send_header('Content-Length', str(len(PAGE)))
+                    self.end_headers()
+                    self.wfile.write(PAGE)
+                elif self.path == '/events':
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.send_header('Cache-Control', 'no-cache')
+                    self.end_headers()
+                    subscriber = stream.subscribe()
+                    try:
+                        while True:
+                            try:
+                                line = subscriber.get(timeout=15)
+                            except queue.Empty:
+                                self.wfile.write(b': keepalive\n\n')
+                                self.wfile.flush()
+                                continue
+                            if line is None:
+                                return
+                            self.wfile.write(f'data: {line}\n\n'.encode())
+                            self.wfile.flush()
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                    finally:
+                        stream.unsubscribe(subscriber)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        return HeatmapRequestHandler
+
+    def close(self):
+        """
+        Sends the held back update, disconnects the viewers and stops the server.
+        :return: None
+        """
+        self.flush()
+        with self.lock:
+            for subscriber in self.subscribers:
+                try:
+                    subscriber.put_nowait(None)
+                except queue.Full:
+                    pass
+            self.subscribers = []
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.log is not None:
+            self.log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_frames(path):
+    """
+    Rebuilds the posteriors from a frame file written by HeatmapStream.
+    :param path: String of the path of the frame file.
+    :return: list of the ndarrays of the posterior of every frame.
+    """
+    posteriors = []
+    values = None
+    shape = None
+    with open(path) as log:
+        for line in log:
+            if not line.strip():
+                continue
+            frame = json.loads(line)
+            if frame['key']:
+                shape = tuple(frame['shape'])
+                values = np.array(frame['values'], dtype=float)
+            elif values is not None:
+                values = values.copy()
+                for cell, value in frame['cells']:
+                    values[cell] = value
+            if values is not None:
+                posteriors.append(values.reshape(shape))
+    return posteriors
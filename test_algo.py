@@ -0,0 +1,178 @@
+"""
+Tests of the posterior engines of algo.py on simulated reads: every fast path must give the posterior of the plain
+one. Run with python -m pytest -q from the repository root.
+"""
+import contextlib
+import copy
+import io
+import os
+
+import numpy as np
+import pytest
+
+from algo import Algorithm
+from algo import MultiTargetAlgorithm
+from algo import SparseAlgorithm
+from algo import VectorizedAlgorithm
+from algo import pick_log_space
+from benchmark import synthetic_config
+from benchmark import take_raw_readings
+from data_obj import Config
+from data_obj import Grid
+from run_bayesian import parse_reading
+from simulation import SimulatedArduinoHandler
+from simulation import SimulatedMercuryHandler
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TOLERANCE = 1e-12
+
+
+@pytest.fixture(scope='module')
+def config():
+    return Config(os.path.join(ROOT, 'config.yaml'), use_cache=False)
+
+
+@pytest.fixture(scope='module')
+def sweeps(config):
+    """Raw tag ids read at every facing of four simulated sweeps, with the target at (1, 2)."""
+    arduino = SimulatedArduinoHandler()
+    mercury = SimulatedMercuryHandler(config, (1, 2), arduino, seed=3)
+    return [take_raw_readings(arduino, mercury, config) for _ in range(4)]
+
+
+@pytest.fixture(scope='module')
+def large_session():
+    """Synthetic 64x64 config and three simulated sweeps, the size the per facing terms underflow at."""
+    config = synthetic_config(64, 64)
+    arduino = SimulatedArduinoHandler()
+    mercury = SimulatedMercuryHandler(config, (20, 30), arduino, seed=1)
+    return config, [take_raw_readings(arduino, mercury, config) for _ in range(3)]
+
+
+def tensor_config(config):
+    """Copy of a config whose detection tensors hold its scalar p1 and p2."""
+    tensor = copy.copy(config)
+    tensor.detection = np.full(config.vision_masks.shape, config.p1)
+    tensor.false_detection = np.full(config.vision_masks.shape, config.p2)
+    return tensor
+
+
+def run_sweeps(algorithm, sweeps, config):
+    for raw_readings in sweeps:
+        algorithm.main([parse_reading(reading, algorithm.grid, config, algorithm.split_targets)
+                        for reading in raw_readings])
+    return algorithm
+
+
+def test_vectorized_matches_loop_engine(config, sweeps):
+    linear = Algorithm(Grid(config.tag_ids, config.grid_size), config)
+    log = Algorithm(Grid(config.tag_ids, config.grid_size), config, log_space=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for algorithm in (linear, log):
+            run_sweeps(algorithm, sweeps, config)
+    vectorized = run_sweeps(VectorizedAlgorithm(Grid(config.tag_ids, config.grid_size), config), sweeps, config)
+    # the loop engine leaves its linear posterior unnormalized
+    linear_posterior = np.array(linear.probabilities)
+    np.testing.assert_allclose(linear_posterior / linear_posterior.sum(), vectorized.prior, atol=TOLERANCE)
+    np.testing.assert_allclose(np.array(log.probabilities), vectorized.prior, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize('engine', [VectorizedAlgorithm, MultiTargetAlgorithm, SparseAlgorithm])
+def test_observe_matches_main(config, sweeps, engine):
+    swept = run_sweeps(engine(Grid(config.tag_ids, config.grid_size), config), sweeps, config)
+    observed = engine(Grid(config.tag_ids, config.grid_size), config)
+    for raw_readings in sweeps:
+        for facing_index, reading in enumerate(raw_readings):
+            observed.observe(facing_index, parse_reading(reading, observed.grid, config, observed.split_targets))
+        observed.commit()
+    np.testing.assert_allclose(observed.estimate(), swept.estimate(), atol=TOLERANCE)
+
+
+@pytest.mark.parametrize('engine', [VectorizedAlgorithm, MultiTargetAlgorithm])
+def test_linear_likelihood_stays_finite_on_large_grids(large_session, engine):
+    config, sweeps = large_session
+    linear = run_sweeps(engine(Grid(config.tag_ids, config.grid_size), config), sweeps, config)
+    log = run_sweeps(engine(Grid(config.tag_ids, config.grid_size), config, log_space=True), sweeps, config)
+    observed = engine(Grid(config.tag_ids, config.grid_size), config)
+    for raw_readings in sweeps:
+        for facing_index, reading in enumerate(raw_readings):
+            observed.observe(facing_index, parse_reading(reading, observed.grid, config, observed.split_targets))
+    assert np.all(np.isfinite(linear.prior))
+    np.testing.assert_allclose(linear.prior, log.prior, atol=TOLERANCE)
+    np.testing.assert_allclose(observed.prior, log.prior, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize('engine', [VectorizedAlgorithm, MultiTargetAlgorithm])
+@pytest.mark.parametrize('tensor', [False, True])
+def test_log_space_matches_linear(config, sweeps, engine, tensor):
+    if tensor:
+        config = tensor_config(config)
+    linear = run_sweeps(engine(Grid(config.tag_ids, config.grid_size), config), sweeps, config)
+    log = run_sweeps(engine(Grid(config.tag_ids, config.grid_size), config, log_space=True), sweeps, config)
+    np.testing.assert_allclose(log.prior, linear.prior, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize('engine', [VectorizedAlgorithm, MultiTargetAlgorithm, SparseAlgorithm])
+def test_tensor_matches_scalar(config, sweeps, engine):
+    scalar = run_sweeps(engine(Grid(config.tag_ids, config.grid_size), config), sweeps, config)
+    tensor = tensor_config(config)
+    tensor = run_sweeps(engine(Grid(tensor.tag_ids, tensor.grid_size), tensor), sweeps, tensor)
+    np.testing.assert_allclose(tensor.estimate(), scalar.estimate(), atol=TOLERANCE)
+
+
+def test_log_space_is_picked_on_large_grids(config, large_session):
+    large_config = large_session[0]
+    assert not pick_log_space(Grid(config.tag_ids, config.grid_size))
+    assert pick_log_space(Grid(large_config.tag_ids, large_config.grid_size))
+    assert not pick_log_space(Grid(large_config.tag_ids, large_config.grid_size), log_space=False)
+
+
+def synthetic_session(uniform):
+    """Synthetic 16x16 config, eight simulated sweeps and two grids holding a uniform or a random prior."""
+    config = synthetic_config(16, 16, seed=1)
+    arduino = SimulatedArduinoHandler()
+    mercury = SimulatedMercuryHandler(config, (5, 9), arduino, seed=2)
+    sweeps = [take_raw_readings(arduino, mercury, config) for _ in range(8)]
+    grids = [Grid(config.tag_ids, config.grid_size) for _ in range(2)]
+    if not uniform:
+        prior = np.random.default_rng(5).uniform(0.5, 1.5, grids[0].probabilities.shape)
+        for grid in grids:
+            grid.update_probabilities(prior)
+    return config, sweeps, grids
+
+
+@pytest.mark.parametrize('uniform', [True, False])
+def test_sparse_floor_zero_matches_dense(uniform):
+    config, sweeps, grids = synthetic_session(uniform)
+    dense = run_sweeps(MultiTargetAlgorithm(grids[0], config, log_space=True), sweeps, config)
+    sparse = run_sweeps(SparseAlgorithm(grids[1], config, floor=0), sweeps, config)
+    np.testing.assert_allclose(sparse.estimate(), dense.estimate(), atol=TOLERANCE)
+    assert sparse.argmax() == dense.argmax()
+
+
+def test_sparse_pruning_keeps_the_posterior():
+    config, sweeps, grids = synthetic_session(uniform=False)
+    dense = run_sweeps(MultiTargetAlgorithm(grids[0], config, log_space=True), sweeps, config)
+    sparse = run_sweeps(SparseAlgorithm(grids[1], config, floor=1e-3), sweeps, config)
+    assert all(len(cells) < sparse.cells for cells in sparse.active)
+    np.testing.assert_allclose(sparse.estimate().sum(axis=(1, 2)), 1)
+    np.testing.assert_allclose(sparse.estimate(), dense.estimate(), atol=1e-2)
+    assert sparse.argmax() == dense.argmax()
+
+
+def test_sparse_warns_on_per_cell_tensors(caplog):
+    config, sweeps, grids = synthetic_session(uniform=True)
+    scalar = SparseAlgorithm(grids[0], config)
+    assert len(scalar.pattern_log_read) < scalar.cells / 2
+    assert not caplog.records
+    rng = np.random.default_rng(7)
+    config = copy.copy(config)
+    config.detection = rng.uniform(0.6, 0.9, config.vision_masks.shape)
+    config.false_detection = rng.uniform(0.01, 0.1, config.vision_masks.shape)
+    dense = run_sweeps(MultiTargetAlgorithm(Grid(config.tag_ids, config.grid_size), config, log_space=True), sweeps,
+                       config)
+    sparse = run_sweeps(SparseAlgorithm(grids[1], config, floor=0), sweeps, config)
+    assert len(sparse.pattern_log_read) == sparse.cells
+    assert 'vision patterns' in caplog.text
+    np.testing.assert_allclose(sparse.estimate(), dense.estimate(), atol=TOLERANCE)
@@ -0,0 +1,70 @@
+"""
+Tests of the detection model estimate of calibration.py.
+Run with python -m pytest -q from the repository root.
+"""
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from calibration import estimate_detection_model
+
+
+@pytest.fixture
+def counts():
+    """Two facings of a 1x2 grid: facing 0 expects grid space (0, 0), facing 1 grid space (0, 1)."""
+    vision_masks = np.array([[[True, False]], [[False, True]]])
+    trials = np.array([[[10.0, 10.0]], [[30.0, 0.0]]])
+    detections = np.array([[[9.0, 1.0]], [[3.0, 0.0]]])
+    return trials, detections, vision_masks
+
+
+def test_global_rates(counts):
+    model = estimate_detection_model(*counts)
+    assert model == {'p1': pytest.approx(0.9), 'p2': pytest.approx(4 / 40)}
+
+
+def test_facing_rates_are_smoothed_towards_the_pooled_rate(counts):
+    trials, detections, vision_masks = counts
+    model = estimate_detection_model(trials, detections, vision_masks, mode='facing', prior_strength=10)
+    # facing 1 has no trials in view, so its p1 is the pooled one
+    np.testing.assert_allclose(model['detection'][:, 0, 0], [0.9, 0.9])
+    np.testing.assert_allclose(model['false_detection'][:, 0, 0], [(1 + 10 * 0.1) / 20, (3 + 10 * 0.1) / 40])
+
+
+def test_cell_rates_without_smoothing(counts):
+    trials, detections, vision_masks = counts
+    model = estimate_detection_model(trials, detections, vision_masks, mode='cell', prior_strength=0)
+    assert np.all(np.isfinite(model['detection'])) and np.all(np.isfinite(model['false_detection']))
+    np.testing.assert_allclose(model['detection'], [[[0.9, 0.9]], [[0.9, 0.9]]])
+    np.testing.assert_allclose(model['false_detection'], [[[0.1, 0.1]], [[0.1, 0.1]]])
+    smoothed = estimate_detection_model(trials, detections, vision_masks, mode='cell', prior_strength=1)
+    np.testing.assert_allclose(smoothed['detection'][0, 0, 0], (9 + 0.9) / 11)
+
+
+def test_rates_stay_off_0_and_1():
+    vision_masks = np.array([[[True, False]]])
+    model = estimate_detection_model(np.full((1, 1, 2), 5.0), np.array([[[5.0, 0.0]]]), vision_masks, mode='cell',
+                                     prior_strength=0, epsilon=1e-3)
+    assert model['p1'] == model['detection'][0, 0, 0] == pytest.approx(1 - 1e-3)
+    assert model['p2'] == model['false_detection'][0, 0, 1] == pytest.approx(1e-3)
+
+
+def test_defaults_without_trials():
+    vision_masks = np.array([[[True, False]]])
+    model = estimate_detection_model(np.zeros((1, 1, 2)), np.zeros((1, 1, 2)), vision_masks, defaults=(0.7, 0.05))
+    assert model == {'p1': 0.7, 'p2': 0.05}
+
+
+def test_unknown_mode(counts):
+    with pytest.raises(ValueError):
+        estimate_detection_model(*counts, mode='station')
+
+
+def test_calibration_does_not_load_the_runtime():
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, calibration; print(sorted(sys.modules))'],
+                            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    for module in ('batch_eval', 'run_bayesian', 'algo', 'communication'):
+        assert f"'{module}'" not in loaded
@@ -0,0 +1,201 @@
+"""
+Tests of the connection handling of communication.py, against fake devices on socket pairs.
+Run with python -m pytest -q from the repository root.
+"""
+import socket
+import threading
+import time
+
+import pytest
+
+import communication
+from communication import ArduinoHandler
+from communication import ConnectionManager
+from communication import MercuryHandler
+from data_obj import Config
+from simulation import SimulatedTagRead
+
+
+class FakeArduino:
+    """Device end of a socket pair, echoing every angle it receives on a line after delay (in sec)."""
+
+    def __init__(self, connection, delay):
+        self.connection = connection
+        self.delay = delay
+        self.angles = []
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        buffer = b''
+        while True:
+            data = self.connection.recv(64)
+            if not data:
+                return
+            buffer = buffer + data
+            while b'\r' in buffer:
+                angle, _, buffer = buffer.partition(b'\r')
+                self.angles.append(angle.decode('utf-8'))
+                threading.Timer(self.delay, self.reply, (angle + b'\n',)).start()
+
+    def reply(self, line):
+        try:
+            self.connection.sendall(line)
+        except OSError:
+            pass
+
+
+class FakeReader:
+    """Stand-in for mercury.Reader, returning the scripted (tag ID, RSSI, read count) reads of every reading."""
+
+    def __init__(self, readings):
+        self.readings = list(readings)
+        self.calls = 0
+
+    def read(self, timeout):
+        self.calls = self.calls + 1
+        reads = self.readings.pop(0) if self.readings else []
+        return [SimulatedTagRead(epc.encode(), rssi, count) for epc, rssi, count in reads]
+
+    def set_read_powers(self, antennas, powers):
+        pass
+
+    def get_model(self):
+        return 'fake'
+
+
+@pytest.fixture
+def fake_reader(monkeypatch):
+    """Builds a MercuryHandler reading from a FakeReader with the given readings, without any delay."""
+
+    def build(readings, **options):
+        reader = FakeReader(readings)
+        monkeypatch.setattr(MercuryHandler, 'open_reader', lambda handler: reader)
+        return MercuryHandler('fake', read_timeout=0, read_delay=0, **options), reader
+
+    return build
+
+
+@pytest.fixture
+def fake_arduino(monkeypatch):
+    """Builds an ArduinoHandler connected to a FakeArduino acking after delay (in sec)."""
+    sockets = []
+
+    def build(delay, **options):
+        handler_end, device_end = socket.socketpair()
+        sockets.extend((handler_end, device_end))
+        monkeypatch.setattr(communication.socket, 'create_connection', lambda address, timeout: handler_end)
+        device = FakeArduino(device_end, delay)
+        return ArduinoHandler('fake', **options), device
+
+    yield build
+    for end in sockets:
+        end.close()
+
+
+def test_move_returns_on_the_ack(fake_arduino):
+    arduino, device = fake_arduino(0.01, move_time=2)
+    start = time.monotonic()
+    arduino.send_angles((20, 50))
+    assert time.monotonic() - start < 1
+    assert arduino.acks == 2
+    assert device.angles == ['20', '50']
+
+
+def test_late_ack_does_not_confirm_the_next_move(fake_arduino):
+    arduino, device = fake_arduino(0.3, move_time=0.2)
+    start = time.monotonic()
+    arduino.send_angles((20, 50))
+    # neither move was confirmed in time, so each got the whole move time
+    assert time.monotonic() - start >= 0.4
+    assert arduino.acks == 0
+    time.sleep(0.3)
+    arduino.send_angles((110,))
+    assert arduino.acks == 0
+
+
+def test_ack_sent_before_the_command_is_discarded(fake_arduino):
+    arduino, device = fake_arduino(0.05, move_time=1, echo=False)
+    device.connection.sendall(b'stale\n')
+    time.sleep(0.05)
+    start = time.monotonic()
+    arduino.send_angles((20,))
+    assert time.monotonic() - start >= 0.05
+    assert arduino.acks == 1
+
+
+BURST = [[('a', -60, 1)], [('a', -60, 1), ('b', -62, 1)], [('a', -60, 1)], [('b', -61, 1)], [('target', -50, 2)],
+         [('c', -70, 1)]]
+
+
+def test_burst_makes_every_reading_by_default(fake_reader):
+    mercury, reader = fake_reader(BURST)
+    tags, reads_used = mercury.make_read_burst()
+    assert reads_used == reader.calls == 6
+    assert tags == ['a', 'a', 'b', 'a', 'b', 'target', 'c']
+    assert [read[3] for read in mercury.last_tag_reads] == [0, 1, 1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize('options, reads_used', [
+    ({'patience': 2}, 4),
+    ({'patience': 3}, 6),
+    ({'min_target_reads': 2}, 5),
+    ({'min_target_reads': 3}, 6),
+    ({'min_target_rssi': -55}, 5),
+    ({'max_reads': 3}, 3),
+])
+def test_burst_stop_rules(fake_reader, options, reads_used):
+    mercury, reader = fake_reader(BURST, **options)
+    tags, used = mercury.make_read_burst(target=('target',))
+    assert used == reads_used == reader.calls
+    assert len(tags) == sum(len(reading) for reading in BURST[:reads_used])
+
+
+def test_burst_section_of_the_config():
+    config_data = {'tags': {'grid_tags': {'row': [('a',)]}, 'grid_size': 1, 'target_tag': ['target']},
+                   'cycles': 1, 'ips': {}, 'search_profile': [], 'vision_profile': [],
+                   'probabilities': {'p1': 0.9, 'p2': 0.1}}
+    assert Config.from_dict(config_data).burst == {}
+    config_data['burst'] = {'patience': 2, 'max_reads': 4}
+    assert Config.from_dict(config_data).burst == {'patience': 2, 'max_reads': 4}
+    config_data['burst']['pacience'] = 2
+    with pytest.raises(ValueError, match='pacience'):
+        Config.from_dict(config_data)
+
+
+def test_manager_retries_with_exponential_backoff(monkeypatch):
+    delays = []
+    monkeypatch.setattr(communication.time, 'sleep', delays.append)
+    failures = [OSError('refused')] * 3
+
+    def connect():
+        if failures:
+            raise failures.pop()
+        return 'connection'
+
+    manager = ConnectionManager('device', connect, max_retries=5, backoff=0.5, max_backoff=1.5)
+    assert manager.call(lambda connection: connection.upper()) == 'CONNECTION'
+    assert delays == [0.5, 1.0, 1.5]
+    assert manager.reconnects == 3
+
+
+def test_manager_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(communication.time, 'sleep', lambda delay: None)
+    disconnected = []
+
+    def broken(connection):
+        raise OSError('reset')
+
+    manager = ConnectionManager('device', object, disconnect=disconnected.append, max_retries=2)
+    with pytest.raises(ConnectionError):
+        manager.call(broken)
+    assert len(disconnected) == 3
+    assert manager.connection is None
+
+
+def test_manager_drops_an_unhealthy_connection():
+    connections = iter(['first', 'second'])
+    manager = ConnectionManager('device', lambda: next(connections), health_check=lambda connection: False)
+    assert manager.get() == 'first'
+    assert not manager.check()
+    assert manager.get() == 'second'
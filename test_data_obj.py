@@ -0,0 +1,97 @@
+"""
+Tests of the parsed config cache of data_obj.py.
+Run with python -m pytest -q from the repository root.
+"""
+import os
+import shutil
+
+import numpy as np
+import pytest
+import yaml
+
+from data_obj import Config
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = tmp_path / 'config.yaml'
+    shutil.copy(os.path.join(ROOT, 'config.yaml'), path)
+    return str(path)
+
+
+@pytest.fixture
+def parses(monkeypatch):
+    """List growing by one every time a config file is parsed rather than restored from its cache."""
+    calls = []
+    load = Config.load
+
+    def counting_load(self, config_data, base_path='.'):
+        calls.append(base_path)
+        load(self, config_data, base_path)
+
+    monkeypatch.setattr(Config, 'load', counting_load)
+    return calls
+
+
+def rewrite(path, change):
+    with open(path) as config_file:
+        config_data = yaml.load(config_file, Loader=yaml.FullLoader)
+    change(config_data)
+    with open(path, 'w') as config_file:
+        yaml.dump(config_data, config_file)
+
+
+def test_cache_is_reused(config_path, parses):
+    parsed = Config(config_path)
+    assert os.path.exists(Config.cache_path(config_path))
+    cached = Config(config_path)
+    assert len(parses) == 1
+    assert cached.search_profile == parsed.search_profile
+    np.testing.assert_array_equal(cached.vision_masks, parsed.vision_masks)
+
+
+def test_edited_config_is_parsed_again(config_path, parses):
+    Config(config_path)
+    rewrite(config_path, lambda config_data: config_data['probabilities'].update(p1=0.5))
+    assert Config(config_path).p1 == 0.5
+    assert len(parses) == 2
+
+
+def test_new_detection_model_is_loaded_again(config_path, parses):
+    model_path = os.path.join(os.path.dirname(config_path), 'model.npz')
+    shape = Config(config_path, use_cache=False).vision_masks.shape
+    np.savez(model_path, detection=np.full(shape, 0.7))
+    rewrite(config_path, lambda config_data: config_data['probabilities'].update(detection_model='model.npz'))
+    assert Config(config_path).detection[0, 0, 0] == 0.7
+    np.savez(model_path, detection=np.full(shape, 0.6))
+    # make sure the modification time moves, whatever the file system resolution
+    stat = os.stat(model_path)
+    os.utime(model_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert Config(config_path).detection[0, 0, 0] == 0.6
+    assert len(parses) == 3
+
+
+def test_cache_of_another_version_is_ignored(config_path, parses, monkeypatch):
+    Config(config_path)
+    monkeypatch.setattr(Config, 'cache_version', Config.cache_version + 1)
+    Config(config_path)
+    Config(config_path)
+    assert len(parses) == 2
+
+
+def test_broken_cache_is_ignored(config_path, parses):
+    with open(Config.cache_path(config_path), 'wb') as cache:
+        cache.write(b'not a pickle')
+    assert Config(config_path).search_profile
+    Config(config_path)
+    assert len(parses) == 1
+
+
+def test_no_cache(config_path, parses):
+    Config(config_path, use_cache=False)
+    Config(config_path, use_cache=False)
+    assert len(parses) == 2
+    assert not os.path.exists(Config.cache_path(config_path))
@@ -0,0 +1,61 @@
+"""
+Tests of the posterior history of history.py: a saved history must replay to the posterior of the run it came from.
+Run with python -m pytest -q from the repository root.
+"""
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+import run_bayesian
+from algo import MultiTargetAlgorithm
+from algo import VectorizedAlgorithm
+from data_obj import Config
+from data_obj import Grid
+from history import PosteriorHistory
+from motion import MotionModel
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope='module')
+def config():
+    return Config(os.path.join(ROOT, 'config.yaml'), use_cache=False)
+
+
+@pytest.mark.parametrize('options', [{'pipelined': False}, {'pipelined': True, 'multi_target': True},
+                                     {'adaptive': True}, {'adaptive': True, 'motion': MotionModel(0.9)}])
+def test_history_round_trip(tmp_path, monkeypatch, config, options):
+    monkeypatch.chdir(ROOT)
+    history_path = str(tmp_path / 'history.npz')
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_bayesian.run(loops=3, simulated_target=(1, 2), plot=False, history_path=history_path, **options)
+    grid = Grid(config.tag_ids, config.grid_size)
+    history = PosteriorHistory.load(history_path, grid=grid)
+    multi_target = options.get('adaptive') or options.get('multi_target')
+    engine = MultiTargetAlgorithm if multi_target else VectorizedAlgorithm
+    estimates = history.replay(engine(grid, config, motion=options.get('motion')))
+    assert len(estimates) == 3
+    for cycle, estimate in enumerate(estimates):
+        # the snapshots are float32
+        np.testing.assert_allclose(estimate, history[cycle + 1], atol=1e-6)
+
+
+def test_ring_buffer_keeps_the_latest_cycles(tmp_path):
+    history = PosteriorHistory(capacity=3, initial=np.zeros((2, 2)))
+    for cycle in range(1, 5):
+        history.append(np.full((2, 2), cycle))
+    assert len(history) == 3 and history.count == 5
+    np.testing.assert_array_equal(history.ordered_snapshots()[:, 0, 0], [2, 3, 4])
+    np.testing.assert_array_equal(history.latest(), np.full((2, 2), 4))
+    np.testing.assert_array_equal(history[-3], history[0])
+    with pytest.raises(IndexError):
+        history[3]
+    path = str(tmp_path / 'history.npz')
+    history.save(path)
+    loaded = PosteriorHistory.load(path)
+    assert loaded.count == 5
+    np.testing.assert_array_equal(loaded.ordered_snapshots(), history.ordered_snapshots())
@@ -0,0 +1,65 @@
+"""
+Tests of the JSON-lines and Prometheus output of metrics.py.
+Run with python -m pytest -q from the repository root.
+"""
+import json
+
+import pytest
+
+from metrics import Metrics
+from metrics import series_name
+from metrics import timed
+
+
+def fill(metrics):
+    metrics.record('update', 0.25)
+    metrics.record('update', 0.5)
+    metrics.record('read', 1.0)
+    metrics.count('reader_reads_total', 3, facing='20,50')
+    metrics.count('reader_reads_total', 2, facing='20,50')
+    metrics.count('unknown_epcs_total')
+    metrics.gauge('posterior_entropy_bits', 1.5, target='E2')
+
+
+def test_series_name():
+    assert series_name('reads_total', ()) == 'reads_total'
+    assert series_name('reads_total', (('facing', 3), ('station', 'north'))) == 'reads_total{facing="3",station="north"}'
+
+
+def test_jsonl_line_per_cycle(tmp_path):
+    path = tmp_path / 'metrics.jsonl'
+    metrics = Metrics(str(path))
+    fill(metrics)
+    assert metrics.end_cycle() == {'update': 0.75, 'read': 1.0}
+    with timed(metrics, 'update'):
+        pass
+    metrics.end_cycle()
+    first, second = [json.loads(line) for line in path.read_text().splitlines()]
+    assert first['cycle'] == 1 and second['cycle'] == 2
+    assert first['stages'] == {'update': 0.75, 'read': 1.0}
+    assert list(second['stages']) == ['update']
+    assert first['counters'] == {'reader_reads_total{facing="20,50"}': 5, 'unknown_epcs_total': 1}
+    assert first['gauges'] == {'posterior_entropy_bits{target="E2"}': 1.5}
+    assert metrics.snapshot()['stages']['update']['count'] == 3
+
+
+def test_prometheus_text(tmp_path):
+    path = tmp_path / 'metrics.prom'
+    metrics = Metrics(str(path), format='prometheus')
+    fill(metrics)
+    metrics.end_cycle()
+    lines = path.read_text().splitlines()
+    assert '# TYPE rfid_stage_seconds summary' in lines
+    assert 'rfid_stage_seconds_count{stage="update"} 2' in lines
+    assert 'rfid_stage_seconds_sum{stage="update"} 0.75' in lines
+    assert 'rfid_stage_seconds_max{stage="update"} 0.5' in lines
+    assert 'rfid_cycles_total 1' in lines
+    assert lines.count('# TYPE rfid_reader_reads_total counter') == 1
+    assert 'rfid_reader_reads_total{facing="20,50"} 5' in lines
+    assert 'rfid_posterior_entropy_bits{target="E2"} 1.5' in lines
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        Metrics(format='csv')
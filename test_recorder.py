@@ -0,0 +1,110 @@
+"""
+Tests of the session files of recorder.py: a recorded session must replay to the posterior of the live run.
+Run with python -m pytest -q from the repository root.
+"""
+import json
+import os
+
+import numpy as np
+import pytest
+import yaml
+
+import run_bayesian
+from algo import MultiTargetAlgorithm
+from algo import VectorizedAlgorithm
+from data_obj import Config
+from data_obj import Grid
+from motion import MotionModel
+from recorder import ReadRecorder
+from recorder import load_cycles
+from run_bayesian import take_readings_adaptive
+from run_bayesian import take_readings_stations
+from scheduler import InformationGainScheduler
+from simulation import SimulatedArduinoHandler
+from simulation import SimulatedMercuryHandler
+from station import build_stations
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TOLERANCE = 1e-12
+
+
+@pytest.fixture(scope='module')
+def config():
+    return Config(os.path.join(ROOT, 'config.yaml'), use_cache=False)
+
+
+@pytest.fixture
+def stations_config_path(tmp_path):
+    """Copy of config.yaml with its search profile split between two reader stations."""
+    with open(os.path.join(ROOT, 'config.yaml')) as config_file:
+        config_data = yaml.load(config_file, Loader=yaml.FullLoader)
+    search_profile = config_data.pop('search_profile')
+    vision_profile = config_data.pop('vision_profile')
+    half = len(search_profile) // 2
+    config_data['stations'] = [
+        {'name': 'north', 'search_profile': search_profile[:half], 'vision_profile': vision_profile[:half]},
+        {'name': 'south', 'search_profile': search_profile[half:], 'vision_profile': vision_profile[half:]},
+    ]
+    path = tmp_path / 'config.yaml'
+    with open(path, 'w') as config_file:
+        yaml.dump(config_data, config_file)
+    return str(path)
+
+
+@pytest.mark.parametrize('multi_target', [False, True])
+@pytest.mark.parametrize('stay', [None, 0.8])
+def test_recorder_replay_matches_live(tmp_path, stations_config_path, multi_target, stay):
+    config = Config(stations_config_path, use_cache=False)
+    motion = None if stay is None else MotionModel(stay)
+    grid = Grid(config.tag_ids, config.grid_size)
+    engine = MultiTargetAlgorithm if multi_target else VectorizedAlgorithm
+    algorithm = engine(grid, config, motion=motion)
+    stations = build_stations(config, (1, 2), seed=4, patience=2)
+    record_path = str(tmp_path / 'session.jsonl')
+    with ReadRecorder(record_path) as recorder:
+        for cycle in range(4):
+            recorder.new_cycle()
+            take_readings_stations(stations, grid, config, algorithm, recorder=recorder)
+    replayed = run_bayesian.replay(record_path, multi_target=multi_target, config_path=stations_config_path,
+                                   motion=motion)
+    np.testing.assert_allclose(replayed.estimate(), algorithm.estimate(), atol=TOLERANCE)
+
+
+def test_adaptive_replay_matches_live(tmp_path, config):
+    motion = MotionModel(0.95)
+    arduino = SimulatedArduinoHandler()
+    mercury = SimulatedMercuryHandler(config, (1, 2), arduino, seed=0, patience=2)
+    grid = Grid(config.tag_ids, config.grid_size)
+    algorithm = MultiTargetAlgorithm(grid, config, motion=motion)
+    scheduler = InformationGainScheduler(config)
+    record_path = str(tmp_path / 'session.jsonl')
+    with ReadRecorder(record_path) as recorder:
+        for cycle in range(8):
+            recorder.new_cycle()
+            take_readings_adaptive(arduino, mercury, grid, config, algorithm, scheduler, recorder=recorder)
+    # cycles that met the stop rule right after the predict step still predict on replay
+    assert [] in load_cycles(record_path)
+    replayed = run_bayesian.replay(record_path, multi_target=True, config_path=os.path.join(ROOT, 'config.yaml'),
+                                   motion=motion)
+    np.testing.assert_allclose(replayed.estimate(), algorithm.estimate(), atol=TOLERANCE)
+
+
+def test_station_reads_keep_their_read_time(tmp_path, stations_config_path):
+    config = Config(stations_config_path, use_cache=False)
+    grid = Grid(config.tag_ids, config.grid_size)
+    algorithm = VectorizedAlgorithm(grid, config)
+    move_time = 0.05
+    stations = build_stations(config, (1, 2), seed=4, move_time=move_time)
+    record_path = str(tmp_path / 'session.jsonl')
+    with ReadRecorder(record_path) as recorder:
+        recorder.new_cycle()
+        take_readings_stations(stations, grid, config, algorithm, recorder=recorder)
+    with open(record_path) as session:
+        events = [json.loads(line) for line in session][1:]
+    for station in stations:
+        times = [event['t'] for event in events if event['sweep'] == stations.index(station) + 1]
+        assert len(times) == len(station.facings)
+        assert times == sorted(times)
+        # every facing waits for its servo move, so the reads are spread over the sweep, not written at once
+        assert min(np.diff(times)) >= move_time * 0.9
@@ -0,0 +1,77 @@
+"""
+Tests of the run and replay loops of run_bayesian.py on simulated hardware.
+Run with python -m pytest -q from the repository root.
+"""
+import contextlib
+import io
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+import yaml
+
+import run_bayesian
+from benchmark import synthetic_config_data
+from data_obj import Config
+from data_obj import Grid
+from history import PosteriorHistory
+from stream import HeatmapStream
+from stream import load_frames
+
+
+ROOT = Path(__file__).resolve().parent
+
+
+@pytest.fixture
+def small_floor(tmp_path, monkeypatch):
+    """Working directory holding a copy of the repository's config.yaml."""
+    shutil.copy(ROOT / 'config.yaml', tmp_path / 'config.yaml')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def large_floor(tmp_path, monkeypatch):
+    """Working directory holding the config.yaml of a synthetic 64x64 floor."""
+    with open(tmp_path / 'config.yaml', 'w') as config_file:
+        yaml.dump(synthetic_config_data(64, 64), config_file)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.mark.parametrize('multi_target', [False, True])
+@pytest.mark.parametrize('log_space', [None, False])
+def test_live_run_on_a_large_floor(large_floor, multi_target, log_space):
+    history_path = str(large_floor / 'history.npz')
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_bayesian.run(loops=2, simulated_target=(20, 30), multi_target=multi_target, history_path=history_path,
+                         plot=False, log_space=log_space)
+    snapshots = PosteriorHistory.load(history_path).ordered_snapshots()
+    assert np.all(np.isfinite(snapshots))
+    np.testing.assert_allclose(snapshots[-1].sum(axis=(-2, -1)), 1, rtol=1e-4)
+
+
+@pytest.mark.parametrize('options', [{'pipelined': False}, {'pipelined': True}, {'adaptive': True}])
+def test_stream_follows_every_update(small_floor, options):
+    frames_path = str(small_floor / 'frames.jsonl')
+    history_path = str(small_floor / 'history.npz')
+    stream = HeatmapStream(max_fps=None, path=frames_path, threshold=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_bayesian.run(loops=2, simulated_target=(1, 2), history_path=history_path, stream=stream, plot=False,
+                         **options)
+    stream.close()
+    config = Config('config.yaml', use_cache=False)
+    history = PosteriorHistory.load(history_path, grid=Grid(config.tag_ids, config.grid_size))
+    facings = sum(len(sweep) for cycle in history.readings[1:len(history)] for sweep in cycle)
+    posteriors = load_frames(frames_path)
+    expected = 2 if options == {'pipelined': False} else facings
+    assert len(posteriors) == expected
+    np.testing.assert_allclose(posteriors[-1], history.ordered_snapshots()[-1], atol=1e-6)
+
+
+def test_adaptive_fix_is_logged(small_floor, caplog, capsys):
+    with caplog.at_level('INFO', logger='run_bayesian'):
+        run_bayesian.run(adaptive=True, loops=2, simulated_target=(1, 2), plot=False)
+    assert 'fix' not in capsys.readouterr().out
+    assert sum(record.getMessage().startswith('fix ') for record in caplog.records) == 2
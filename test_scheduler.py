@@ -0,0 +1,86 @@
+"""
+Tests of the facing choice and stop rule of scheduler.py.
+Run with python -m pytest -q from the repository root.
+"""
+import copy
+import os
+
+import numpy as np
+import pytest
+
+from data_obj import Config
+from scheduler import InformationGainScheduler
+from scheduler import binary_entropy
+from scheduler import entropy
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope='module')
+def config():
+    return Config(os.path.join(ROOT, 'config.yaml'), use_cache=False)
+
+
+def brute_force_gain(probabilities, read_probability):
+    """Expected entropy reduction of every facing, from the posterior after a detection and after a miss."""
+    gains = []
+    for read in read_probability:
+        detection = np.sum(probabilities * read)
+        after_read = probabilities * read / detection
+        after_miss = probabilities * (1 - read) / (1 - detection)
+        gains.append(entropy(probabilities) - detection * entropy(after_read) - (1 - detection) * entropy(after_miss))
+    return np.array(gains)
+
+
+def test_gain_matches_brute_force(config):
+    probabilities = np.random.default_rng(0).random(config.grid_shape)
+    probabilities = probabilities / probabilities.sum()
+    scheduler = InformationGainScheduler(config)
+    read_probability = np.where(config.vision_masks, config.p1, config.p2)
+    np.testing.assert_allclose(scheduler.expected_information_gain(probabilities),
+                               brute_force_gain(probabilities, read_probability), atol=1e-9)
+
+
+def test_gain_uses_the_detection_tensors(config):
+    rng = np.random.default_rng(1)
+    tensor = copy.copy(config)
+    tensor.detection = rng.uniform(0.5, 0.95, config.vision_masks.shape)
+    tensor.false_detection = rng.uniform(0.01, 0.2, config.vision_masks.shape)
+    probabilities = np.full(config.grid_shape, 1 / config.grid_size)
+    read_probability = np.where(config.vision_masks, tensor.detection, tensor.false_detection)
+    gain = InformationGainScheduler(tensor).expected_information_gain(probabilities)
+    np.testing.assert_allclose(gain, brute_force_gain(probabilities, read_probability), atol=1e-9)
+    assert not np.allclose(gain, InformationGainScheduler(config).expected_information_gain(probabilities))
+
+
+def test_targets_add_up(config):
+    rng = np.random.default_rng(2)
+    probabilities = rng.random((2,) + config.grid_shape)
+    probabilities = probabilities / probabilities.sum(axis=(1, 2), keepdims=True)
+    scheduler = InformationGainScheduler(config)
+    np.testing.assert_allclose(scheduler.expected_information_gain(probabilities),
+                               scheduler.expected_information_gain(probabilities[0])
+                               + scheduler.expected_information_gain(probabilities[1]))
+
+
+def test_known_target_gains_nothing(config):
+    probabilities = np.zeros(config.grid_shape)
+    probabilities[1, 2] = 1
+    np.testing.assert_allclose(InformationGainScheduler(config).expected_information_gain(probabilities), 0,
+                               atol=1e-9)
+    assert binary_entropy(0.5) == pytest.approx(1)
+
+
+def test_stop_rule(config):
+    scheduler = InformationGainScheduler(config, stop_probability=0.9)
+    uniform = np.full(config.grid_shape, 1 / config.grid_size)
+    facing = scheduler.next_facing(uniform)
+    assert facing == int(np.argmax(scheduler.expected_information_gain(uniform)))
+    found = np.full(config.grid_shape, 0.05 / (config.grid_size - 1))
+    found[1, 2] = 0.95
+    assert scheduler.should_stop(found)
+    assert scheduler.next_facing(found) is None
+    # every target has to pass the threshold
+    assert not scheduler.should_stop(np.stack([found, uniform]))
+    assert scheduler.next_facing(np.stack([found, uniform])) is not None
@@ -0,0 +1,65 @@
+"""
+Tests of the frame encoding and rate limit of stream.py.
+Run with python -m pytest -q from the repository root.
+"""
+import json
+import time
+
+import numpy as np
+
+from stream import HeatmapStream
+from stream import load_frames
+
+
+def read_frames(path):
+    with open(path) as frame_file:
+        return [json.loads(line) for line in frame_file if line.strip()]
+
+
+def test_frames_round_trip(tmp_path):
+    path = str(tmp_path / 'frames.jsonl')
+    rng = np.random.default_rng(0)
+    posteriors = [rng.random((4, 5)) for _ in range(6)]
+    posteriors.append(posteriors[-1].copy())
+    with HeatmapStream(max_fps=None, path=path, keyframe_interval=4) as stream:
+        for posterior in posteriors:
+            stream.publish(posterior)
+    frames = read_frames(path)
+    assert [frame['key'] for frame in frames] == [True, False, False, False, True, False, False]
+    assert frames[-1]['cells'] == []
+    for loaded, posterior in zip(load_frames(path), posteriors):
+        np.testing.assert_allclose(loaded, posterior, atol=1e-6)
+
+
+def test_delta_frame_skips_small_changes(tmp_path):
+    path = str(tmp_path / 'frames.jsonl')
+    posterior = np.full((2, 2), 0.25)
+    with HeatmapStream(max_fps=None, path=path, threshold=1e-3) as stream:
+        stream.publish(posterior)
+        stream.publish(posterior + [[1e-4, 0], [0, 0.1]])
+    assert read_frames(path)[1]['cells'] == [[3, 0.35]]
+
+
+def test_new_shape_sends_a_key_frame(tmp_path):
+    path = str(tmp_path / 'frames.jsonl')
+    with HeatmapStream(max_fps=None, path=path) as stream:
+        stream.publish(np.full((2, 2), 0.25))
+        stream.publish(np.full((2, 2, 2), 0.25))
+    frames = read_frames(path)
+    assert frames[1]['key'] and frames[1]['shape'] == [2, 2, 2]
+    assert load_frames(path)[-1].shape == (2, 2, 2)
+
+
+def test_held_back_frame_is_sent_by_the_timer(tmp_path):
+    path = str(tmp_path / 'frames.jsonl')
+    with HeatmapStream(max_fps=10, path=path) as stream:
+        start = time.monotonic()
+        assert stream.publish(np.full((2, 2), 0.25))
+        assert not stream.publish(np.array([[0.7, 0.1], [0.1, 0.1]]))
+        assert not stream.publish(np.array([[0.1, 0.7], [0.1, 0.1]]))
+        assert len(read_frames(path)) == 1
+        time.sleep(0.2)
+        frames = read_frames(path)
+        assert len(frames) == 2
+        assert stream.last_sent - start < 0.15
+    np.testing.assert_allclose(load_frames(path)[-1], [[0.1, 0.7], [0.1, 0.1]])